@@ -1,12 +1,23 @@
-from .anidbconnector import AnidbConnector
-from .libed2k import get_ed2k_link,hash_file
-from .cli import main
-from .protocol import FileRequest, AnimeAmaskField, FileFmaskField, FileAmaskField, AnimeDescRequest
+import importlib
+
+# Loaded on first use, so that importing the package (or running the CLI entry
+# point) doesn't pull in the connector and everything it depends on.
+_LAZY_NAMES = {
+	'AnidbConnector': 'anidbcli.anidbconnector',
+	'get_ed2k_link': 'anidbcli.libed2k',
+	'hash_file': 'anidbcli.libed2k',
+	'main': 'anidbcli.cli',
+	'FileRequest': 'anidbcli.protocol',
+	'AnimeAmaskField': 'anidbcli.protocol',
+	'FileFmaskField': 'anidbcli.protocol',
+	'FileAmaskField': 'anidbcli.protocol',
+	'AnimeDescRequest': 'anidbcli.protocol',
+}
 
 __all__ = [
 	'AnidbConnector',
 	'AnimeAmaskField',
-	'AnimeDescRequest'
+	'AnimeDescRequest',
 	'FileAmaskField',
 	'FileFmaskField',
 	'FileRequest',
@@ -14,3 +25,16 @@ __all__ = [
 	'hash_file',
 	'main',
 ]
+
+
+def __getattr__(name):
+	module = _LAZY_NAMES.get(name)
+	if module is None:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	value = getattr(importlib.import_module(module), name)
+	globals()[name] = value
+	return value
+
+
+def __dir__():
+	return sorted(set(globals()) | set(_LAZY_NAMES))
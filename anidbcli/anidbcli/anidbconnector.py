@@ -5,67 +5,67 @@ import hashlib
 import time
 import os
 import json
-from datetime import datetime, timedelta
-import sqlite3
-from collections import namedtuple
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from collections import Counter, OrderedDict, namedtuple
 
 import anidbcli.encryptors as encryptors
-from anidbcli.protocol import AnidbApiCall, AnidbApiBanned, AnidbResponse, FileKeyED2K, FileKeyFID, FileRequest, AnidbApiNotFound
-
-from sqlalchemy.sql.expression import func
-import sqlalchemy.engine
-from sqlalchemy.dialects.sqlite import insert
-from sqlalchemy import create_engine, text, MetaData, Table, Column, Integer, String, DateTime, Text, select, Index, UniqueConstraint, delete
-from sqlalchemy.schema import CreateTable
-from sqlalchemy.sql.functions import count
-
-
-metadata_obj = MetaData()
-anidb_file_negative_cache = Table(
-    "anidb_file_negative_cache",
-    metadata_obj,
-    Column("id", Integer, primary_key=True),
-    Column("ed2k", Text, nullable=False),
-    Column("size", Integer, nullable=False),
-    Column("expiration", Integer, nullable=False),
-    UniqueConstraint("ed2k", "size", name="anidb_key"),
-)
-Index("anidb_file_negative_cache_expiration", anidb_file_negative_cache.c.expiration)
-
-anidb_file_negative_cache2 = Table(
-    "anidb_file_negative_cache2",
-    metadata_obj,
-    Column("id", Integer, primary_key=True),
-    Column("ed2k", Text, nullable=False),
-    Column("size", Integer, nullable=False),
-    Column("failure_count", Integer, nullable=False),
-    Column("failed_on", Integer, nullable=False),
-    Column("synthesize_failure_until", Integer, nullable=False),
-    Column("expiration", Integer, nullable=False),
-    UniqueConstraint("ed2k", "size", name="anidb_key"),
-)
-Index("anidb_file_negative_cache2_expiration", anidb_file_negative_cache.c.expiration)
-
-anidb_files = Table(
-    "anidb_files",
-    metadata_obj,
-    Column("id", Integer, primary_key=True),
-    Column("fid", Integer, nullable=False),
-    Column("ed2k", Text, nullable=False),
-    Column("size", Integer, nullable=False),
-    Column("expiration", Integer, nullable=False),
-    UniqueConstraint("ed2k", "size", name="anidb_key"),
-)
-Index("anidb_files_fid", anidb_files.c.expiration)
-Index("anidb_files_expiration", anidb_files.c.expiration)
-
-anidb_metadata = Table(
-    "metadata",
-    metadata_obj,
-    Column("object_prop_key", Text, primary_key=True),
-    Column("prop_value", Text, nullable=False),
-    Column("expiration", Integer, nullable=False),
-)
+from anidbcli.fieldplanner import FieldPackingPlanner
+from anidbcli.refresher import BackgroundRefresher
+from anidbcli.scheduler import PriorityScheduler, RequestPriority
+from anidbcli.protocol import AnidbApiCall, AnidbApiBanned, AnidbResponse, FileKeyED2K, FileKeyFID, FileRequest, AnidbApiNotFound, FileFmaskField, FileAmaskField, FILE_ENTITY_ID_FIELDS, file_field_by_name
+
+
+# The SQLite cache lives in anidbcli.sqlcache, so commands that don't use it
+# don't pay for importing sqlalchemy; its names are still importable from here.
+SQLCACHE_NAMES = {
+    'AnidbCacheSqlAlchemy',
+    'open_default_cache',
+    'metadata_obj',
+    'anidb_file_negative_cache',
+    'anidb_file_negative_cache2',
+    'anidb_files',
+    'anidb_objects',
+    'anidb_mylist',
+    'anidb_cache_state',
+    'anidb_field_sizes',
+}
+
+
+def __getattr__(name):
+    if name in SQLCACHE_NAMES:
+        import anidbcli.sqlcache as sqlcache
+        return getattr(sqlcache, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+OBJECT_TYPE_FILE = 'file'
+
+# the lifetime of the rows of the legacy metadata table; how long cached objects
+# are kept now is up to cachepolicy.FieldTtlPolicy.expiration
+METADATA_TTL = timedelta(days=300)
+FILE_IDENTIFIER_TTL = timedelta(days=1200)
+NEGATIVE_CACHE_TTL = timedelta(days=300)
+# AniDB is asked about a file it didn't know again after this, and an hour later
+# for every further failure (up to NEGATIVE_CACHE_MAX_RETRY)
+NEGATIVE_CACHE_FIRST_RETRY = timedelta(hours=1)
+NEGATIVE_CACHE_MAX_RETRY = timedelta(days=30)
+# mylist entries can be changed on the website; past this they're checked with AniDB again
+MYLIST_ENTRY_TTL = timedelta(days=30)
+CACHE_FLUSH_EVERY_FILES = 50
+# keeps IN (...) lists well below SQLite's bound parameter limit
+PREFETCH_CHUNK_SIZE = 500
+CACHE_FLUSH_INTERVAL_SECONDS = 1.0
+LRU_CACHE_MAX_ENTRIES = 10000
+# how long the LRU takes the wrapped cache's word on whether a file is unknown to AniDB
+LRU_NEGATIVE_RECHECK = timedelta(minutes=1)
+# expired rows are dropped every SWEEP_EVERY_WRITES writes, and on close if the last
+# sweep is older than SWEEP_INTERVAL.
+SWEEP_EVERY_WRITES = 1000
+SWEEP_INTERVAL = timedelta(days=1)
+# when over max_size, evict down to this fraction of it so we don't evict on every sweep
+EVICTION_TARGET_RATIO = 0.9
 
 API_ADDRESS = "api.anidb.net"
 API_PORT = 9000
@@ -104,12 +104,140 @@ class ImplicitField(namedtuple('_ImplicitField', ['name'])):
     pass
 
 
+class CachedFileLookup(namedtuple('_CachedFileLookup', ['negative', 'values'])):
+    """Result of a batch cache lookup for one file key.
+
+    values is a list of (field, value) pairs like locally_service_field_values returns.
+    """
+
+    def field_names(self):
+        return {f.name for (f, _) in self.values}
+
+    def covers(self, fields):
+        """Whether a FILE request for fields can be answered from this alone."""
+        return self.negative or {f.name for f in fields} <= self.field_names()
+
+
+# Stored payloads give the fetch time shared by most of their fields once, under
+# this key, and only pair the other fields' values with a fetch time of their own.
+PAYLOAD_FETCHED_KEY = ''
+
+
+def _encode_payload(payload):
+    """Serializes {field name: [raw value, fetched at]}."""
+    compact = {}
+    if payload:
+        (fetched_at, _) = Counter(fetched for (_, fetched) in payload.values()).most_common(1)[0]
+        compact[PAYLOAD_FETCHED_KEY] = fetched_at
+        for (name, (value, fetched)) in payload.items():
+            compact[name] = value if fetched == fetched_at else [value, fetched]
+    return json.dumps(compact, separators=(',', ':'), ensure_ascii=False)
+
+
+def _decode_payload(text):
+    """Parses a payload stored by _encode_payload, or an older one pairing every value with its fetch time."""
+    compact = json.loads(text)
+    fetched_at = compact.pop(PAYLOAD_FETCHED_KEY, None)
+    return {name: v if isinstance(v, list) else [v, fetched_at] for (name, v) in compact.items()}
+
+
+def _field_masks(fields):
+    """Returns (fmask, amask) with the bits of fields set, like the masks of a FILE request."""
+    fmask = 0
+    amask = 0
+    for f in fields:
+        if isinstance(f, FileFmaskField):
+            fmask |= f.to_bitfield()
+        elif isinstance(f, FileAmaskField):
+            amask |= f.to_bitfield()
+    return (fmask, amask)
+
+
+def _payload_masks(payload):
+    return _field_masks(file_field_by_name(name) for name in payload)
+
+
+def _entity_ids(values):
+    """Returns {entity: object id} for the aid/eid/gid present in {field name: value}."""
+    out = {}
+    for (entity, id_field) in FILE_ENTITY_ID_FIELDS.items():
+        try:
+            out[entity] = int(values[id_field])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return out
+
+
+def _payload_entity_ids(payload):
+    return _entity_ids({name: v[0] for (name, v) in payload.items()})
+
+
+def _split_by_object(fid, values, entity_ids):
+    """Splits {field: [raw value, fetched at]} of one file into {object type: {object id: {name: ...}}}.
+
+    Anime, episode and group fields are stored with the object they describe so
+    other files of the same anime/episode/group can be served from them; they stay
+    with the file if its aid/eid/gid isn't known.
+    """
+    out = {}
+    for (f, value) in values.items():
+        (object_type, object_id) = (OBJECT_TYPE_FILE, fid)
+        if isinstance(f, FileAmaskField) and f.entity() in entity_ids:
+            (object_type, object_id) = (f.entity(), entity_ids[f.entity()])
+        out.setdefault(object_type, {}).setdefault(object_id, {})[f.name] = value
+    return out
+
+
+def _iter_payload_entries(payload, entity_payloads, fields):
+    """Yields (field, [raw value, fetched at]) for the fields a file payload can serve."""
+    entity_ids = _payload_entity_ids(payload)
+    for f in fields:
+        source = payload
+        if f.name not in source and isinstance(f, FileAmaskField):
+            source = entity_payloads.get((f.entity(), entity_ids.get(f.entity())), {})
+        if f.name in source:
+            yield f, source[f.name]
+
+
+def _add_stale_fields(stale, fid, fields, entity_ids):
+    """Notes fields of fid served although stale in stale ({refresh key: (fid, fields)}).
+
+    Anime, episode and group fields are keyed by their object, so they're refreshed
+    once for all files of the same anime/episode/group, through the first file
+    they went stale for.
+    """
+    for f in fields:
+        key = fid
+        if isinstance(f, FileAmaskField) and f.entity() in entity_ids:
+            key = (f.entity(), entity_ids[f.entity()])
+        stale.setdefault(key, (fid, set()))[1].add(f)
+
+
+def _stale_fields_by_fid(stale):
+    out = {}
+    for (fid, fields) in stale.values():
+        out.setdefault(fid, set()).update(fields)
+    return out
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 def _convert_return_iter_to_list(func):
     def wrapper(*args, **kwargs):
         return list(func(*args, **kwargs))
     return wrapper
 
 
+def _locked(func):
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 class AnidbCacheNoop:
     def check_negative_cache(self, req):
         return False
@@ -120,166 +248,188 @@ class AnidbCacheNoop:
     def locally_service_field_values(self, key, fields):
         return []
 
+    def load_field_size_stats(self):
+        return {}
 
-class AnidbCacheSqlAlchemy:
-    def __init__(self, engine_url):
-        self._sqlite_engine = create_engine(engine_url, echo=False)
-        with self._sqlite_engine.connect() as conn:
-            metadata_obj.create_all(conn)
-            conn.commit()
+    def store_field_size_stats(self, stats):
+        return
 
-    def _inject_negative_cache_record(self, req):
-        if hasattr(req, 'key') and isinstance(req.key, FileKeyED2K):
-            return self._inject_negative_cache_record_file_key_ed2k(req.key.ed2k, req.key.size)
-        print("want to insert negative cache record for {!r}, but type is not understood", file=sys.stderr)
-
-    def _inject_negative_cache_record_file_key_ed2k(self, ed2k, size):
-        with self._sqlite_engine.connect() as conn:
-            metadata_obj.create_all(conn)
-            conn.commit()
-            now = datetime.now()
-            max_negative_ttl = now + timedelta(days=30)
-            expiration = now + timedelta(days=300)
-            my_upsert = insert(anidb_file_negative_cache).values(
-                ed2k=ed2k,
-                size=size,
-                expiration=int(expiration.timestamp())
-            ).on_conflict_do_update(
-                index_elements=['ed2k', 'size'],
-                set_={'expiration': int(expiration.timestamp())}
-            )
-            conn.execute(my_upsert)
-            conn.commit()
-            ##
-            failure_count_default = 1
-            failed_on = int(now.timestamp())
-            insert_stmt = insert(anidb_file_negative_cache2).values(
-                ed2k=ed2k,
-                size=size,
-                failure_count=failure_count_default,
-                failed_on=failed_on,
-                synthesize_failure_until=failed_on + 3600 * failure_count_default,
-                expiration=int(expiration.timestamp()))
-
-            in_one_hour = now + timedelta(hours=1)
-            synthesize_failure_until = func.min(
-                max_negative_ttl.timestamp(),
-                int(in_one_hour.timestamp()) + 3600 * anidb_file_negative_cache2.c.failure_count)
-            my_upsert = insert_stmt.on_conflict_do_update(
-                index_elements=['ed2k', 'size'],
-                set_={
-                    'failure_count': anidb_file_negative_cache2.c.failure_count + 1,
-                    'synthesize_failure_until': synthesize_failure_until,
-                    'expiration': int(expiration.timestamp()),
-                })
-            conn.execute(my_upsert)
-            conn.commit()
-
-    def _inject_cache_file_identifier(self, req, accumulated_response):
-        now = datetime.now()
-        if hasattr(req, 'key') and isinstance(req.key, FileKeyED2K):
-            with self._sqlite_engine.connect() as conn:
-                query = insert(anidb_files).values(
-                    fid=accumulated_response.decoded['fid'],
-                    ed2k=req.key.ed2k,
-                    size=req.key.size,
-                    expiration=int((now + timedelta(days=1200)).timestamp()),
-                )
-                conn.execute(query)
-                conn.commit()
-
-    def _inject_cache_file(self, req, accumulated_response):
-        object_key = f"f{accumulated_response.decoded['fid']}"
-        expiration = datetime.now() + timedelta(days=300)
-        with self._sqlite_engine.connect() as conn:
-            for (k, v) in accumulated_response.iter_raw_kv(req, suppress_truncation_error=True):
-                conn.execute(insert(anidb_metadata).values(**{
-                    'object_prop_key': f'{object_key}:{k.name}',
-                    'prop_value': v,
-                    'expiration': int(expiration.timestamp()),
-                }))
-            conn.commit()
+    def prefetch_file_keys(self, keys, fields):
+        return {}
+
+    def take_stale_fields(self):
+        return {}
+
+    def sweep(self):
+        return 0
 
+    def lookup_mylist_entry(self, key):
+        return None
+
+    def record_mylist_entry(self, key, *, lid, state, viewed, fid=None):
+        return
+
+    def forget_mylist_entry(self, key):
+        return
+
+    def flush(self):
+        return
+
+    def close(self):
+        return
+
+
+class AnidbCacheLru:
+    """Bounded in-memory LRU in front of another cache, with write-through semantics.
+
+    Remembers negative lookups and ed2k->fid mappings, so looking the same file up
+    several times in one run only checks the database for it once.  Field values
+    are always read from the wrapped cache (by fid once it's known), which keeps
+    track of their staleness and of when objects were last used.  Everything else
+    is passed through to the wrapped cache.
+    """
+
+    def __init__(self, inner, *, max_entries=LRU_CACHE_MAX_ENTRIES, report_stats=None):
+        self.inner = inner
+        self.max_entries = max_entries
+        self.report_stats = bool(os.getenv("ANIDBCLI_CACHE_STATS")) if report_stats is None else report_stats
+        self._lock = threading.RLock()
+        # ('negative', FileKeyED2K) -> (bool, unix time until which it holds) and
+        # ('fid', FileKeyED2K) -> fid
+        self._entries = OrderedDict()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = 0
+
+    def _get(self, kind, key):
+        try:
+            value = self._entries[(kind, key)]
+        except KeyError:
+            self.misses[kind] += 1
+            return None
+        self._entries.move_to_end((kind, key))
+        self.hits[kind] += 1
+        return value
+
+    def _put(self, kind, key, value):
+        self._entries[(kind, key)] = value
+        self._entries.move_to_end((kind, key))
+        while self.max_entries < len(self._entries):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def ttl_policy(self):
+        return self.inner.ttl_policy
+
+    @ttl_policy.setter
+    def ttl_policy(self, value):
+        self.inner.ttl_policy = value
+
+    @property
+    def max_size(self):
+        return self.inner.max_size
+
+    @max_size.setter
+    def max_size(self, value):
+        self.inner.max_size = value
+
+    @_locked
     def check_negative_cache(self, req):
-        """
-        returns true if we think this record does not exist,
-        returns false if the record may exist
-        """
-        hash_key = None
-        if isinstance(req, FileRequest):
-            if isinstance(req.key, FileKeyFID):
-                # If we have a File ID, then this file cannot be unknown.
-                return False
-            assert isinstance(req.key, FileKeyED2K)
-            hash_key = req.key
-        elif isinstance(req, dict):
-            ed2k = req.get('ed2k', None)
-            size = req.get('size', None)
-            if ed2k is not None and size is not None:
-                hash_key = FileKeyED2K(ed2k, size)
-        elif hash_key is None:
-            return False
-        now = datetime.now()
-        if isinstance(hash_key, FileKeyED2K):
-            with self._sqlite_engine.connect() as conn:
-                conn.execute(delete(anidb_file_negative_cache2).where(anidb_file_negative_cache2.c.expiration <= int(now.timestamp())))
-                conn.commit()
-                query = select(anidb_file_negative_cache2.c.synthesize_failure_until).where(
-                    (anidb_file_negative_cache2.c.ed2k == hash_key.ed2k)
-                    & (anidb_file_negative_cache2.c.size == hash_key.size)
-                    & (int(now.timestamp()) <= anidb_file_negative_cache2.c.synthesize_failure_until))
-                with conn.execute(query) as cursor:
-                    for _ in cursor:
-                        return True
-        # if isinstance(hash_key, FileKeyED2K):
-        #     with self._sqlite_engine.connect() as conn:
-        #         conn.execute(delete(anidb_file_negative_cache).where(anidb_file_negative_cache.c.expiration < int(now.timestamp())))
-        #         conn.commit()
-        #         query = select(anidb_file_negative_cache.c.expiration).where(
-        #             (anidb_file_negative_cache.c.ed2k == hash_key.ed2k)
-        #             & (anidb_file_negative_cache.c.size == hash_key.size)
-        #             & (int(now.timestamp()) <= anidb_file_negative_cache.c.expiration))
-        #         with conn.execute(query) as cursor:
-        #             for _ in cursor:
-        #                 return True
-        elif isinstance(hash_key, FileKeyFID):
-            # If we have a File ID, then this file cannot be unknown.
-            return False
-        else:
-            cls_name = "{0.__class__.__module__}.{0.__class__.__name__}".format(hash_key)
-            allowed = {FileKeyED2K, FileKeyFID}
-            raise TypeError("expected hash key (in {0!r}), got {1}: {2}".format(allowed, cls_name, hash_key))
-        return False
+        key = None
+        if isinstance(req, FileRequest) and isinstance(req.key, FileKeyED2K):
+            key = req.key
+        elif isinstance(req, dict) and req.get('ed2k') is not None and req.get('size') is not None:
+            key = FileKeyED2K(req['ed2k'], req['size'])
+        if key is None:
+            return self.inner.check_negative_cache(req)
+        now = time.time()
+        entry = self._get('negative', key)
+        if entry is not None and now < entry[1]:
+            return entry[0]
+        negative = self.inner.check_negative_cache(req)
+        # the wrapped cache's answer changes once the file may be retried, which
+        # this doesn't know, so it's only taken as is for a while
+        self._put('negative', key, (negative, now + LRU_NEGATIVE_RECHECK.total_seconds()))
+        return negative
+
+    @_locked
+    def _inject_negative_cache_record(self, req):
+        self.inner._inject_negative_cache_record(req)
+        if hasattr(req, 'key') and isinstance(req.key, FileKeyED2K):
+            self._put('negative', req.key, (True, time.time() + NEGATIVE_CACHE_FIRST_RETRY.total_seconds()))
 
+    @_locked
     def inject_cache(self, req, res):
-        if isinstance(req, FileRequest):
-            self._inject_cache_file_identifier(req, res)
-            self._inject_cache_file(req, res)
+        self.inner.inject_cache(req, res)
+        if isinstance(req, FileRequest) and isinstance(req.key, FileKeyED2K) and res.decoded and 'fid' in res.decoded:
+            self._put('fid', req.key, res.decoded['fid'])
 
-    @_convert_return_iter_to_list
+    @_locked
     def locally_service_field_values(self, key, fields):
         if isinstance(key, FileKeyED2K):
-            with self._sqlite_engine.connect() as conn:
-                query = select(anidb_files.c.fid).where(
-                    (anidb_files.c.ed2k == key.ed2k)
-                    & (anidb_files.c.size == key.size)
-                )
-                with conn.execute(query) as iterator:
-                    for (fid,) in iterator:
-                        key = FileKeyFID(fid)
-                        break
-        if key is None:
-            return
-        if isinstance(key, FileKeyFID):
-            yield ImplicitField('fid'), key.fid
-            field_query_fields_by_key = {"{}:{}".format(key, f.name): f for f in fields}
-            obj_prop_keys = list(field_query_fields_by_key.keys())
-            with self._sqlite_engine.connect() as conn:
-                query = select(anidb_metadata).where(anidb_metadata.c.object_prop_key.in_(obj_prop_keys))
-                with conn.execute(query) as iterator:
-                    for a_metadata in iterator:
-                        f = field_query_fields_by_key[a_metadata.object_prop_key]
-                        yield f, f.filter_value(a_metadata.prop_value)
+            fid = self._get('fid', key)
+            if fid is not None:
+                return self.inner.locally_service_field_values(FileKeyFID(fid), fields)
+        values = self.inner.locally_service_field_values(key, fields)
+        if isinstance(key, FileKeyED2K):
+            self._remember_fid(key, values)
+        return values
+
+    @_locked
+    def prefetch_file_keys(self, keys, fields):
+        found = self.inner.prefetch_file_keys(keys, fields)
+        expires = time.time() + LRU_NEGATIVE_RECHECK.total_seconds()
+        for (key, lookup) in found.items():
+            self._put('negative', key, (lookup.negative, expires))
+            self._remember_fid(key, lookup.values)
+        return found
+
+    def _remember_fid(self, key, values):
+        for (f, v) in values:
+            if isinstance(f, ImplicitField) and f.name == 'fid':
+                self._put('fid', key, v)
+
+    @_locked
+    def forget(self):
+        """Drops everything held in memory, e.g. after the cache was changed behind our back."""
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': sum(self.hits.values()),
+            'misses': sum(self.misses.values()),
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+        }
+
+    @_locked
+    def close(self):
+        if self.report_stats:
+            print("cache lru: {hits} hits, {misses} misses, {evictions} evictions, {entries} entries".format(**self.stats()), file=sys.stderr)
+        self.inner.close()
+
+    def __getattr__(self, name):
+        # mylist, field size statistics, sweeping and the like
+        return getattr(self.inner, name)
+
+    def _repr_fields(self):
+        yield ('inner', self.inner)
+        yield ('max_entries', self.max_entries)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+class _InflightRequest(object):
+    """A request on its way to AniDB, whose answer identical requests wait for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        # an undecoded copy of the answer, None if sending failed
+        self.response = None
+
 
 class AnidbConnector:
     DEFAULT_SLEEP_INTERVAL_SECONDS = 2.0
@@ -302,6 +452,18 @@ class AnidbConnector:
         self._cache = cache_impl
         if self._cache is None:
             self._cache = AnidbCacheNoop()
+        # CachedFileLookups from prefetch(), by FileKeyED2K and FileKeyFID
+        self._prefetched = {}
+        self.field_planner = FieldPackingPlanner(self._cache.load_field_size_stats())
+        # the refresher thread (and the daemon's workers) send requests too; the scheduler
+        # lets them through one request/response at a time, most important first
+        self.scheduler = PriorityScheduler(lambda: self._last_sent_request + self._sleep_interval)
+        # RequestPriority of FILE requests sent by each thread, see prioritized()
+        self._thread_priority = threading.local()
+        # serialized FILE request -> _InflightRequest
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.refresher = BackgroundRefresher(self)
         if self._persistent:
             self._load_persistence()
         if self._salt and api_key:
@@ -339,18 +501,16 @@ class AnidbConnector:
         self._socket.connect(remote_addr)
         self._socket.settimeout(SOCKET_TIMEOUT)
 
+    @property
+    def cache(self):
+        return self._cache
+
     @classmethod
-    def create_plain(cls, username, password):
+    def create_plain(cls, username, password, *, cache_impl=None):
         """Creates unencrypted UDP API connection using the provided credenitals."""
-        cache_impl = AnidbCacheSqlAlchemy(engine_url = sqlalchemy.engine.URL(
-            drivername='sqlite+pysqlite',
-            username=None,
-            password=None,
-            host=None,
-            port=None,
-            database=get_cache_path(),
-            query={},
-        ))
+        if cache_impl is None:
+            from anidbcli.sqlcache import open_default_cache
+            cache_impl = AnidbCacheLru(open_default_cache())
         return cls((username, password), cache_impl=cache_impl)
 
     def _send_request_raw(self, data, suppress_encryption=False):
@@ -360,7 +520,7 @@ class AnidbConnector:
         since_last_sent = now - self._last_sent_request
         if since_last_sent < self._sleep_interval:
             time.sleep(self._sleep_interval - since_last_sent)
-        self._last_sent_request = now
+        self._last_sent_request = time.monotonic()
 
         if not suppress_encryption:
             data = self._crypto.Encrypt(data)
@@ -370,9 +530,11 @@ class AnidbConnector:
             raise AnidbApiBanned(
                 response.decode('utf-8'),
                 code_received=555)
+        # the truncation check is about the datagram, not what's left after decrypting and stripping it
+        wire_size = len(response)
         if not suppress_encryption:
             response = self._crypto.Decrypt(response)
-        return AnidbResponse.parse(response.rstrip("\n"))
+        return AnidbResponse.parse(response.rstrip("\n"), wire_size=wire_size)
 
     def _login(self):
         if self._suppress_network_activity:
@@ -390,14 +552,66 @@ class AnidbConnector:
             raise Exception(response.data)
 
     def close(self):
+        self.refresher.close()
+        self._cache.store_field_size_stats(self.field_planner.stats())
+        self._cache.close()
         if not self._session:
             return  # already closed.
         self._send_request_raw(API_ENDPOINT_LOGOUT % self._session)
         self._session = None
         self._socket.close()
 
-    def send_request_helper_legacy(self, content):
+    def send_request_helper_legacy(self, content, priority=RequestPriority.PIPELINE, cost=0):
         """Sends request to the API and returns a dictionary containing response code and data."""
+        with self.scheduler.slot(priority, cost):
+            return self._send_request_with_retries(content)
+
+    @contextmanager
+    def prioritized(self, priority):
+        """FILE requests sent by this thread within the block get priority (a RequestPriority)."""
+        previous = getattr(self._thread_priority, 'value', None)
+        self._thread_priority.value = priority
+        try:
+            yield
+        finally:
+            self._thread_priority.value = previous
+
+    def _request_priority(self, req, refresh):
+        if refresh:
+            return RequestPriority.BACKGROUND
+        if isinstance(req, str) and req.startswith("MYLISTADD "):
+            return RequestPriority.MYLIST
+        priority = getattr(self._thread_priority, 'value', None)
+        return RequestPriority.PIPELINE if priority is None else priority
+
+    def _send_coalesced(self, content, priority, cost):
+        """send_request_helper_legacy, except that callers sending the same request
+        at the same time share one answer.
+
+        Returns (response, shared), shared meaning it's a copy of the answer to
+        another caller's request.
+        """
+        with self._inflight_lock:
+            inflight = self._inflight.get(content)
+            first = inflight is None
+            if first:
+                inflight = self._inflight[content] = _InflightRequest()
+        if not first:
+            inflight.done.wait()
+            if inflight.response is not None:
+                print(f"shared the answer to an identical request: {content}", file=sys.stderr)
+                return (inflight.response.undecoded_copy(), True)
+            return (self.send_request_helper_legacy(content, priority, cost), False)
+        try:
+            res = self.send_request_helper_legacy(content, priority, cost)
+            inflight.response = res.undecoded_copy()
+            return (res, False)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[content]
+            inflight.done.set()
+
+    def _send_request_with_retries(self, content):
         tries = RETRY_COUNT
         while 0 < tries:
             if not self._session:
@@ -407,6 +621,9 @@ class AnidbConnector:
                 response = self._send_request_raw(f"{content}&s={self._session}")
                 if response.code == AnidbResponse.CODE_LOGIN_FIRST:
                     self._session = None
+                    # the session expired (e.g. a long idle 'anidbcli serve'), log in again
+                    if 0 < tries:
+                        continue
                 return response
             except socket.timeout:
                 if tries == 0:
@@ -414,44 +631,110 @@ class AnidbConnector:
                 else:
                     continue
 
-    def send_request(self, req):
-        if self._cache.check_negative_cache(req):
+    def prefetch(self, keys, fields):
+        """Looks up a whole batch of file keys in the cache up front.
+
+        Later FILE requests for these keys are answered from the prefetched results
+        instead of querying the cache one file at a time.  Returns {key: CachedFileLookup}.
+        Results are kept until their file is fetched from AniDB, so this is for a batch
+        about to be looked up; to just ask whether the cache covers a file, use
+        cache.prefetch_file_keys.
+        """
+        found = self._cache.prefetch_file_keys(keys, fields)
+        for (key, lookup) in found.items():
+            self._prefetched[key] = lookup
+            for (f, v) in lookup.values:
+                if isinstance(f, ImplicitField) and f.name == 'fid':
+                    self._prefetched[FileKeyFID(v)] = lookup
+        self._queue_stale_refreshes()
+        return found
+
+    def _queue_stale_refreshes(self):
+        stale = self._cache.take_stale_fields()
+        if self._suppress_network_activity:
+            return
+        for (fid, fields) in stale.items():
+            self.refresher.queue(fid, fields)
+
+    def _forget_prefetched(self, req, res):
+        self._prefetched.pop(req.key, None)
+        if res.decoded and 'fid' in res.decoded:
+            self._prefetched.pop(FileKeyFID(res.decoded['fid']), None)
+
+    def send_request(self, req, *, refresh=False):
+        """Answers req from the cache where possible and from AniDB otherwise.
+
+        With refresh set the cache isn't consulted, which is how stale values get
+        re-fetched.
+        """
+        prefetched = None
+        if isinstance(req, FileRequest) and not refresh:
+            prefetched = self._prefetched.get(req.key)
+        if refresh:
+            pass
+        elif prefetched is not None:
+            if prefetched.negative:
+                return AnidbResponse(AnidbResponse.CODE_RESULT_NO_SUCH_FILE, 'NO SUCH FILE (cached)')
+        elif self._cache.check_negative_cache(req):
             return AnidbResponse(AnidbResponse.CODE_RESULT_NO_SUCH_FILE, 'NO SUCH FILE (cached)')
 
         locally_serviced_fields = {}
-        want_fields = set(req.fields)
-        if isinstance(req, FileRequest):
+        if isinstance(req, FileRequest) and not refresh:
+            want_fields = set(req.fields)
             locally_serviced_fields_keys = []
-            for (f, v) in self._cache.locally_service_field_values(req.key, req.fields):
+            if prefetched is not None:
+                cached_values = [(f, v) for (f, v) in prefetched.values if isinstance(f, ImplicitField) or f in want_fields]
+            else:
+                cached_values = self._cache.locally_service_field_values(req.key, req.fields)
+            for (f, v) in cached_values:
                 locally_serviced_fields[f.name] = v
                 if not isinstance(f, ImplicitField):
                     locally_serviced_fields_keys.append(f)
                     want_fields.remove(f)
             locally_serviced_fields_msg = ', '.join(f.short_code() for f in locally_serviced_fields_keys)
             print(f"locally_serviced_fields: {locally_serviced_fields_msg}", file=sys.stderr)
-
-        req.fields = [f for f in req.fields if f in want_fields]
-        if isinstance(req, FileRequest) and not req.fields:
-            return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, '', decoded=locally_serviced_fields)
-        
-        need_network_access_for = ', '.join(f.short_code() for f in req.fields)
-        print(f"need network access for: {need_network_access_for}", file=sys.stderr)
-        if isinstance(req, FileRequest) and self._suppress_network_activity:
-            return AnidbResponse(AnidbResponse.CODE_RESULT_NO_SUCH_FILE, 'NO SUCH FILE (suppressed query and not cached)')
+            self._queue_stale_refreshes()
+
+            req.fields = [f for f in req.fields if f in want_fields]
+            # with nothing left to fetch the cache answers, but only if it knows the file;
+            # otherwise an empty request still finds out whether it exists and its fid
+            if not req.fields and 'fid' in locally_serviced_fields:
+                return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, '', decoded=locally_serviced_fields)
+
+            need_network_access_for = ', '.join(f.short_code() for f in req.fields)
+            print(f"need network access for: {need_network_access_for}", file=sys.stderr)
+            if self._suppress_network_activity:
+                return AnidbResponse(AnidbResponse.CODE_RESULT_NO_SUCH_FILE, 'NO SUCH FILE (suppressed query and not cached)')
         
         is_rich = False
+        priority = self._request_priority(req, refresh)
         if isinstance(req, AnidbApiCall):
             # if hasattr(req, 'next_request'):
             #     return self.send_request_helper2(req)
             is_rich = True
-            res = self.send_request_helper_legacy(req.serialize())
+            shared = False
+            if isinstance(req, FileRequest):
+                # the same file can be looked up for several paths at once (copies, hardlinks)
+                # for shortest-job-first: the fields this lookup still has to fetch
+                cost = len(req.fields) + len(req.deferred_fields)
+                (res, shared) = self._send_coalesced(req.serialize(), priority, cost)
+            else:
+                res = self.send_request_helper_legacy(req.serialize(), priority)
             try:
                 req.validate_response_has_valid_code(res)
             except AnidbApiNotFound as e:
-                self._cache._inject_negative_cache_record(req)
+                if not shared:
+                    self._cache._inject_negative_cache_record(req)
+                return res
         else:
-            res = self.send_request_helper_legacy(req)
+            res = self.send_request_helper_legacy(req, priority)
         if is_rich:
             res.decode_with_query(req, suppress_truncation_error=True)
-            self._cache.inject_cache(req, res)
+            if isinstance(req, FileRequest) and res.code == AnidbResponse.CODE_RESULT_FILE:
+                if not shared:
+                    self.field_planner.observe(req, res)
+                res.decoded.update(locally_serviced_fields)
+                self._forget_prefetched(req, res)
+            if not shared:
+                self._cache.inject_cache(req, res)
         return res
@@ -0,0 +1,224 @@
+import bisect
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Integer, Text, Index, delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+import anidbcli.libed2k as libed2k
+from anidbcli.anidbconnector import AnidbConnector, _chunks
+from anidbcli.operations import GetFileInfoOperation
+from anidbcli.protocol import FileKeyED2K
+
+# The backfill tables live in the cache database, so queued files survive crashes
+# and reboots along with everything looked up so far.
+backfill_metadata = MetaData()
+anidb_backfill_queue = Table(
+    "anidb_backfill_queue",
+    backfill_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("path", Text, nullable=False, unique=True),
+    # filled in once hashed, so a resumed run doesn't hash the file again
+    Column("ed2k", Text, nullable=True),
+    Column("size", Integer, nullable=True),
+    Column("attempts", Integer, nullable=False, server_default="0"),
+    # unix time before which a failed file isn't tried again
+    Column("not_before", Integer, nullable=False, server_default="0"),
+    Column("added", Integer, nullable=False),
+)
+
+# when the requests of backfill runs were sent, for the request budget; pruned after a day
+anidb_backfill_sent = Table(
+    "anidb_backfill_sent",
+    backfill_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("sent_at", Integer, nullable=False),
+)
+Index("anidb_backfill_sent_sent_at", anidb_backfill_sent.c.sent_at)
+
+HOUR = 3600
+DAY = 24 * HOUR
+MAX_ATTEMPTS = 5
+RETRY_DELAY = HOUR
+REPORT_EVERY_FILES = 100
+ADD_BATCH_SIZE = 1000
+
+
+class BackfillEntry(namedtuple('_BackfillEntry', ['id', 'path', 'ed2k', 'size', 'attempts'])):
+    pass
+
+
+class BackfillBudget(namedtuple('_BackfillBudget', ['per_hour', 'per_day'])):
+    """At most per_hour requests in any hour and per_day in any day, None meaning no limit.
+
+    Requests are spread out evenly instead of using up the budget in a burst and
+    then waiting for the rest of the window: one every interval() seconds.
+    """
+
+    def interval(self):
+        return max([0] + [window / limit for (limit, window) in ((self.per_hour, HOUR), (self.per_day, DAY)) if limit])
+
+    def next_allowed(self, sent, now):
+        """Unix time from which the next request may be sent, given the sorted times of the ones sent so far."""
+        at = now
+        if sent:
+            at = max(at, sent[-1] + self.interval())
+        for (limit, window) in ((self.per_hour, HOUR), (self.per_day, DAY)):
+            if limit is None:
+                continue
+            recent = sent[bisect.bisect_right(sent, now - window):]
+            if limit <= len(recent):
+                at = max(at, recent[len(recent) - limit] + window)
+        return at
+
+    def seconds_per_request(self):
+        return max(AnidbConnector.DEFAULT_SLEEP_INTERVAL_SECONDS, self.interval())
+
+
+class BackfillQueue(object):
+    """Files waiting to be looked up, kept in the cache database."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        with cache.connection() as conn:
+            backfill_metadata.create_all(conn)
+
+    def add(self, paths):
+        """Queues files by path, skipping the ones already queued; returns how many were added."""
+        now = int(time.time())
+        added = 0
+        stmt = insert(anidb_backfill_queue).on_conflict_do_nothing(index_elements=['path'])
+        with self.cache.connection() as conn:
+            for chunk in _chunks([os.path.abspath(p) for p in paths], ADD_BATCH_SIZE):
+                added += conn.execute(stmt, [{'path': p, 'added': now} for p in chunk]).rowcount
+        return added
+
+    def pending(self):
+        with self.cache.connection() as conn:
+            return conn.execute(select(func.count()).select_from(anidb_backfill_queue)).scalar()
+
+    def next_entry(self, now):
+        """The oldest queued file that isn't waiting to be retried, or None."""
+        q = anidb_backfill_queue
+        with self.cache.connection() as conn:
+            row = conn.execute(select(q.c.id, q.c.path, q.c.ed2k, q.c.size, q.c.attempts).where(
+                q.c.not_before <= now).order_by(q.c.id).limit(1)).first()
+        return BackfillEntry(*row) if row is not None else None
+
+    def hashed(self, entry, ed2k, size):
+        with self.cache.connection() as conn:
+            conn.execute(update(anidb_backfill_queue).where(anidb_backfill_queue.c.id == entry.id).values(ed2k=ed2k, size=size))
+        return entry._replace(ed2k=ed2k, size=size)
+
+    def done(self, entry, requests):
+        with self.cache.connection() as conn:
+            conn.execute(delete(anidb_backfill_queue).where(anidb_backfill_queue.c.id == entry.id))
+        self.cache.set_state('backfill_files', self.cache.get_state('backfill_files', 0) + 1)
+        self.cache.set_state('backfill_requests', self.cache.get_state('backfill_requests', 0) + requests)
+
+    def retry_later(self, entry, now):
+        """Puts a failed file back for later; returns False if it was dropped after MAX_ATTEMPTS."""
+        q = anidb_backfill_queue
+        with self.cache.connection() as conn:
+            if MAX_ATTEMPTS <= entry.attempts + 1:
+                conn.execute(delete(q).where(q.c.id == entry.id))
+                return False
+            conn.execute(update(q).where(q.c.id == entry.id).values(
+                attempts=entry.attempts + 1, not_before=int(now + RETRY_DELAY * 2 ** entry.attempts)))
+        return True
+
+    def record_sent(self, times):
+        if not times:
+            return
+        with self.cache.connection() as conn:
+            conn.execute(anidb_backfill_sent.insert(), [{'sent_at': int(t)} for t in times])
+
+    def recent_sent(self, now):
+        """Sorted times of the requests sent within the last day."""
+        sent = anidb_backfill_sent
+        with self.cache.connection() as conn:
+            conn.execute(delete(sent).where(sent.c.sent_at <= now - DAY))
+            return list(conn.execute(select(sent.c.sent_at).order_by(sent.c.sent_at)).scalars())
+
+    def requests_per_file(self):
+        """Average requests a file took so far (cache hits counting as none), 1 before any was done."""
+        files = self.cache.get_state('backfill_files', 0)
+        if not files:
+            return 1.0
+        return self.cache.get_state('backfill_requests', 0) / files
+
+    def eta(self, budget):
+        """Seconds until all queued files are looked up at the budget's pace."""
+        return self.pending() * self.requests_per_file() * budget.seconds_per_request()
+
+
+def format_eta(seconds):
+    (hours, rest) = divmod(int(seconds), HOUR)
+    (days, hours) = divmod(hours, 24)
+    if days:
+        return f"{days}d {hours}h"
+    return f"{hours}h {rest // 60}m"
+
+
+def report_progress(queue, budget, output):
+    pending = queue.pending()
+    output.info(f"{pending} files left in the backfill queue, done in about {format_eta(queue.eta(budget))}.")
+
+
+def _retry_later(queue, entry, now, output):
+    if not queue.retry_later(entry, now):
+        output.warning(f"Gave up on {entry.path!r} after {MAX_ATTEMPTS} attempts.")
+
+
+def run_backfill(queue, connector, output, budget, *, fields=None, no_wait=False, max_files=None, report_every=REPORT_EVERY_FILES):
+    """Looks up queued files until the queue is empty (or max_files were done) within the budget.
+
+    Files leave the queue only once their info is in the cache, so an interrupted
+    run picks up where it stopped.  The budget is checked before each file; its
+    follow-up requests count against it afterwards.  With no_wait, stops instead
+    of waiting once the budget is used up.  Returns the number of files done.
+    """
+    # the queue holds each file once, so there's nothing to reuse answers for
+    lookup = GetFileInfoOperation(connector, output, fields, remember_results=False)
+    sent = queue.recent_sent(time.time())
+    processed = 0
+    report_progress(queue, budget, output)
+    while max_files is None or processed < max_files:
+        now = time.time()
+        entry = queue.next_entry(now)
+        if entry is None:
+            break
+        if entry.ed2k is None:
+            try:
+                entry = queue.hashed(entry, libed2k.hash_file(entry.path), os.path.getsize(entry.path))
+            except (OSError, ValueError) as e:
+                output.error(f"Failed to hash {entry.path!r}: {e}")
+                _retry_later(queue, entry, now, output)
+                continue
+        key = FileKeyED2K(entry.ed2k, entry.size)
+        cached = connector.cache.prefetch_file_keys([key], lookup.fields).get(key)
+        if cached is None or not cached.covers(lookup.fields):
+            at = budget.next_allowed(sent, now)
+            if now < at:
+                if no_wait:
+                    output.info("The request budget is used up for now.")
+                    break
+                output.info(f"Waiting for the request budget until {datetime.fromtimestamp(at):%H:%M:%S}.")
+                time.sleep(at - now)
+        before = sum(connector.scheduler.granted.values())
+        ok = lookup({"file_path": entry.path, "ed2k": entry.ed2k, "size": entry.size})
+        requests = sum(connector.scheduler.granted.values()) - before
+        now = time.time()
+        sent.extend([now] * requests)
+        queue.record_sent([now] * requests)
+        if ok:
+            queue.done(entry, requests)
+        else:
+            _retry_later(queue, entry, now, output)
+        processed += 1
+        if processed % report_every == 0:
+            del sent[:bisect.bisect_right(sent, now - DAY)]
+            report_progress(queue, budget, output)
+    return processed
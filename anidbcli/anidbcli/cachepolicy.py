@@ -0,0 +1,177 @@
+import re
+from datetime import timedelta
+
+from anidbcli.protocol import file_field_by_name
+
+TTL_CLASS_IMMUTABLE = 'immutable'
+TTL_CLASS_STABLE = 'stable'
+TTL_CLASS_VOLATILE = 'volatile'
+
+# None means cached values never go stale.
+DEFAULT_CLASS_TTLS = {
+    TTL_CLASS_IMMUTABLE: None,
+    TTL_CLASS_STABLE: timedelta(days=300),
+    TTL_CLASS_VOLATILE: timedelta(days=7),
+}
+
+# How long the sweep keeps values after they went stale (they're served and
+# refreshed meanwhile), and values that never go stale after they were fetched,
+# like the file identifiers.
+STALE_RETENTION = timedelta(days=300)
+IMMUTABLE_RETENTION = timedelta(days=1200)
+
+# Fields that can't change for a given file (or anime/episode/group).
+IMMUTABLE_FIELDS = {
+    'aid',
+    'eid',
+    'gid',
+    'size',
+    'ed2k',
+    'md5',
+    'sha1',
+    'crc32',
+}
+
+# Fields that keep changing, mostly while an anime is airing.
+VOLATILE_FIELDS = {
+    'lid',
+    'other_episodes',
+    'IsDeprecated',
+    'file_state',
+    'mylist_state',
+    'mylist_filestate',
+    'mylist_viewed',
+    'mylist_viewdate',
+    'mylist_storage',
+    'mylist_source',
+    'mylist_other',
+    'ep_total',
+    'ep_last',
+    'related_aid_list',
+    'related_aid_type',
+    'a_categories',
+    'a_english',
+    'a_other',
+    'a_short',
+    'a_synonyms',
+    'ep_english',
+    'episode_rating',
+    'episode_vote_count',
+    'date_aid_record_updated',
+}
+
+SIZE_PATTERN = re.compile(r'(\d+)([kmg]?)i?b?')
+SIZE_UNITS = {
+    '': 1,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+}
+
+DURATION_PATTERN = re.compile(r'(\d+)([smhdw])')
+DURATION_UNITS = {
+    's': 'seconds',
+    'm': 'minutes',
+    'h': 'hours',
+    'd': 'days',
+    'w': 'weeks',
+}
+
+
+class TtlPolicyError(ValueError):
+    pass
+
+
+# the cache settings besides TTLs (like sizes) raise the same error
+CachePolicyError = TtlPolicyError
+
+
+def parse_duration(text):
+    """Parses '12h', '30d', '1w2d' etc. into a timedelta, or 'never' into None."""
+    text = text.strip().lower()
+    if text == 'never':
+        return None
+    if not text or DURATION_PATTERN.sub('', text):
+        raise TtlPolicyError(f"invalid duration {text!r}, expected e.g. 12h, 30d or never")
+    ttl = timedelta()
+    for (amount, unit) in DURATION_PATTERN.findall(text):
+        ttl += timedelta(**{DURATION_UNITS[unit]: int(amount)})
+    return ttl
+
+
+def parse_size(text):
+    """Parses '512M', '2G', '2GiB' etc. into a number of bytes."""
+    m = SIZE_PATTERN.fullmatch(text.strip().lower())
+    if m is None:
+        raise CachePolicyError(f"invalid size {text!r}, expected e.g. 512M or 2G")
+    return int(m.group(1)) * SIZE_UNITS[m.group(2)]
+
+
+class FieldTtlPolicy(object):
+    """How long cached FILE field values count as fresh.
+
+    Every field belongs to one of the immutable, stable and volatile classes, each
+    with its own TTL; single fields can be given a TTL of their own as well.  Stale
+    values are still served, but get re-fetched in the background.
+    """
+
+    def __init__(self, class_ttls=None, field_ttls=None):
+        self.class_ttls = dict(DEFAULT_CLASS_TTLS)
+        self.class_ttls.update(class_ttls or {})
+        self.field_ttls = dict(field_ttls or {})
+
+    @classmethod
+    def parse(cls, specs):
+        """Builds a policy from CLASS=DURATION or FIELD=DURATION strings."""
+        class_ttls = {}
+        field_ttls = {}
+        for spec in specs:
+            (name, sep, duration) = spec.partition('=')
+            name = name.strip()
+            if not sep:
+                raise TtlPolicyError(f"invalid TTL {spec!r}, expected NAME=DURATION")
+            if name in DEFAULT_CLASS_TTLS:
+                class_ttls[name] = parse_duration(duration)
+            elif file_field_by_name(name) is not None:
+                field_ttls[name] = parse_duration(duration)
+            else:
+                raise TtlPolicyError(f"unknown field or TTL class {name!r}")
+        return cls(class_ttls, field_ttls)
+
+    def field_class(self, field):
+        if field.name in IMMUTABLE_FIELDS:
+            return TTL_CLASS_IMMUTABLE
+        if field.name in VOLATILE_FIELDS:
+            return TTL_CLASS_VOLATILE
+        return TTL_CLASS_STABLE
+
+    def ttl(self, field):
+        if field.name in self.field_ttls:
+            return self.field_ttls[field.name]
+        return self.class_ttls[self.field_class(field)]
+
+    def is_stale(self, field, fetched, now):
+        """fetched and now are unix timestamps."""
+        ttl = self.ttl(field)
+        return ttl is not None and fetched + ttl.total_seconds() <= now
+
+    def expiration(self, payload):
+        """Unix time from which the sweep may drop a cached object, given its
+        {field name: [raw value, fetched at]}: once all of its fields are past
+        their retention."""
+        until = 0
+        for (name, (_, fetched)) in payload.items():
+            field = file_field_by_name(name)
+            ttl = self.ttl(field) if field is not None else timedelta()
+            keep = IMMUTABLE_RETENTION if ttl is None else ttl + STALE_RETENTION
+            until = max(until, fetched + int(keep.total_seconds()))
+        return until
+
+    def _repr_fields(self):
+        yield ('class_ttls', self.class_ttls)
+        if self.field_ttls:
+            yield ('field_ttls', self.field_ttls)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
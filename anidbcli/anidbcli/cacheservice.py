@@ -0,0 +1,364 @@
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from datetime import datetime
+
+from anidbcli.anidbconnector import AnidbCacheLru, AnidbCacheNoop, CachedFileLookup, ImplicitField, PREFETCH_CHUNK_SIZE, _chunks, _locked
+from anidbcli.protocol import AnidbResponse, FileKeyED2K, FileKeyFID, FileRequest, MylistEntry, file_field_by_name
+
+# Clients send one JSON object per line, {"op": name, ...arguments}, and get one
+# line back for each: {"ok": true, ...results} or {"ok": false, "error": message}.
+# File keys are {"ed2k": ..., "size": ...} or {"fid": ...}, fields go by name and
+# field values are passed raw, as received from AniDB.
+PUT_BATCH_SIZE = 50
+CONNECT_TIMEOUT = 10
+# how long a client waits for the answer to a call before giving up on the server
+CALL_TIMEOUT = 30
+
+
+class CacheServiceError(Exception):
+    pass
+
+
+def parse_address(text):
+    """'host:port' (or ':port') for TCP, anything else is taken as a Unix socket path."""
+    (host, sep, port) = text.rpartition(':')
+    if sep and port.isdigit() and '/' not in text:
+        return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+    return (socket.AF_UNIX, text)
+
+
+def _encode_key(key):
+    if isinstance(key, FileKeyED2K):
+        return {'ed2k': key.ed2k, 'size': key.size}
+    return {'fid': key.fid}
+
+
+def _decode_key(obj):
+    if 'fid' in obj:
+        return FileKeyFID(obj['fid'])
+    return FileKeyED2K(obj['ed2k'], obj['size'])
+
+
+def _fields(names):
+    fields = []
+    for name in names:
+        f = file_field_by_name(name)
+        if f is None:
+            raise CacheServiceError(f"unknown field {name!r}")
+        fields.append(f)
+    return fields
+
+
+def _encode_values(values):
+    """(fid, {name: raw value}) from locally_service_field_values style pairs."""
+    fid = None
+    out = {}
+    for (f, v) in values:
+        if isinstance(f, ImplicitField):
+            fid = v
+        else:
+            out[f.name] = v
+    return (fid, out)
+
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+                handler = getattr(self, 'op_' + str(req.pop('op', None)), None)
+                if handler is None:
+                    raise CacheServiceError("unknown op")
+                res = {'ok': True}
+                res.update(handler(self.server.cache, **req) or {})
+            except Exception as e:
+                res = {'ok': False, 'error': f"{e.__class__.__name__}: {e}"}
+            self.wfile.write(json.dumps(res, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def op_get(self, cache, keys, fields):
+        keys = [_decode_key(k) for k in keys]
+        fields = _fields(fields)
+        found = cache.prefetch_file_keys([k for k in keys if isinstance(k, FileKeyED2K)], fields, raw=True)
+        files = []
+        for key in keys:
+            if isinstance(key, FileKeyED2K):
+                lookup = found.get(key, CachedFileLookup(False, []))
+            else:
+                lookup = CachedFileLookup(False, cache.locally_service_field_values(key, fields, raw=True))
+            (fid, values) = _encode_values(lookup.values)
+            files.append({'negative': lookup.negative, 'fid': fid, 'values': values})
+        return {'files': files}
+
+    def op_put(self, cache, files):
+        for f in files:
+            values = dict(zip(_fields(f['values']), f['values'].values()))
+            cache.inject_file_values(_decode_key(f['key']), f['fid'], values)
+
+    def op_put_negative(self, cache, keys):
+        for key in keys:
+            cache._inject_negative_cache_record(FileRequest(key=_decode_key(key), fields=[]))
+
+    def op_take_stale(self, cache):
+        return {'stale': [[fid, [f.name for f in fields]] for (fid, fields) in cache.take_stale_fields().items()]}
+
+    def op_get_field_sizes(self, cache):
+        return {'stats': cache.load_field_size_stats()}
+
+    def op_put_field_sizes(self, cache, stats):
+        cache.store_field_size_stats({name: tuple(v) for (name, v) in stats.items()})
+
+    def op_get_mylist(self, cache, key):
+        entry = cache.lookup_mylist_entry(_decode_key(key))
+        if entry is None:
+            return {'entry': None}
+        return {'entry': entry._replace(updated=int(entry.updated.timestamp()))._asdict()}
+
+    def op_put_mylist(self, cache, key, lid, state, viewed, fid=None):
+        cache.record_mylist_entry(_decode_key(key), lid=lid, state=state, viewed=viewed, fid=fid)
+
+    def op_forget_mylist(self, cache, key):
+        cache.forget_mylist_entry(_decode_key(key))
+
+    def op_flush(self, cache):
+        cache.flush()
+
+
+def _socket_in_use(path):
+    """Whether something accepts connections on the Unix socket at path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+    return True
+
+
+def _remove_stale_socket(path):
+    """Removes the socket left behind by a server that's gone, so path can be bound again."""
+    if _socket_in_use(path):
+        raise CacheServiceError(f"a cache server is already listening on {path}")
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+class _TcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class CacheServer(object):
+    """Serves a cache (normally an AnidbCacheSqlAlchemy) to AnidbCacheRemote clients.
+
+    Every client connection gets a thread of its own; the cache serializes them.
+    """
+
+    def __init__(self, cache, address):
+        (family, addr) = parse_address(address)
+        if family == socket.AF_UNIX:
+            _remove_stale_socket(addr)
+        server_cls = _TcpServer if family == socket.AF_INET else _UnixServer
+        self.server = server_cls(addr, _CacheRequestHandler)
+        self.server.cache = cache
+        self.cache = cache
+
+    @property
+    def address(self):
+        addr = self.server.server_address
+        if isinstance(addr, tuple):
+            return "{}:{}".format(*addr[:2])
+        return addr
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.server.server_address, str):
+            os.unlink(self.server.server_address)
+
+    def _repr_fields(self):
+        yield ('address', self.address)
+        yield ('cache', self.cache)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+class AnidbCacheRemote(AnidbCacheNoop):
+    """Cache client for an 'anidbcli cache-serve' process, shared by several hosts.
+
+    Lookups are sent in batches, and so are writes: they're buffered until
+    put_batch_size files are pending, until flush(), or until one of them is
+    looked up again.  Wrap it in an AnidbCacheLru (see connect()) so repeated
+    lookups don't go over the network.
+    """
+
+    def __init__(self, address, *, put_batch_size=PUT_BATCH_SIZE, call_timeout=CALL_TIMEOUT):
+        (family, addr) = parse_address(address)
+        self.address = address
+        self.put_batch_size = put_batch_size
+        self._lock = threading.RLock()
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            self._sock.connect(addr)
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.settimeout(call_timeout)
+        self._file = self._sock.makefile('rwb')
+        # FileKey -> {"fid": ..., "values": {...}} waiting to be sent
+        self._pending = {}
+
+    @classmethod
+    def connect(cls, address, **kwargs):
+        return AnidbCacheLru(cls(address, **kwargs))
+
+    def _call(self, op, **args):
+        with self._lock:
+            if self._sock is None:
+                raise CacheServiceError(f"not connected to the cache server at {self.address}")
+            try:
+                self._file.write(json.dumps({'op': op, **args}, ensure_ascii=False).encode('utf-8') + b'\n')
+                self._file.flush()
+                line = self._file.readline()
+            except OSError as e:
+                # an answer still on its way would be taken for the answer to the next call
+                self._disconnect()
+                raise CacheServiceError(f"cache server at {self.address} didn't answer: {e}")
+        if not line:
+            raise CacheServiceError(f"cache server at {self.address} closed the connection")
+        res = json.loads(line)
+        if not res.pop('ok'):
+            raise CacheServiceError(f"cache server at {self.address}: {res['error']}")
+        return res
+
+    def _send_pending(self, keys=None):
+        if keys is not None and not any(k in self._pending for k in keys):
+            return
+        if self._pending:
+            files = [{'key': _encode_key(key), **f} for (key, f) in self._pending.items()]
+            # kept for the next try if the server doesn't take them
+            self._call('put', files=files)
+            self._pending = {}
+
+    def _get(self, keys, fields):
+        out = []
+        for chunk in _chunks(keys, PREFETCH_CHUNK_SIZE):
+            self._send_pending(chunk)
+            res = self._call('get', keys=[_encode_key(k) for k in chunk], fields=[f.name for f in fields])
+            by_name = {f.name: f for f in fields}
+            for (key, found) in zip(chunk, res['files']):
+                values = []
+                if found['fid'] is not None:
+                    values.append((ImplicitField('fid'), found['fid']))
+                    values.extend((by_name[n], by_name[n].filter_value(v)) for (n, v) in found['values'].items())
+                out.append((key, CachedFileLookup(found['negative'], values)))
+        return out
+
+    @_locked
+    def check_negative_cache(self, req):
+        key = None
+        if isinstance(req, FileRequest) and isinstance(req.key, FileKeyED2K):
+            key = req.key
+        elif isinstance(req, dict) and req.get('ed2k') is not None and req.get('size') is not None:
+            key = FileKeyED2K(req['ed2k'], req['size'])
+        if key is None:
+            return False
+        return self._get([key], [])[0][1].negative
+
+    @_locked
+    def _inject_negative_cache_record(self, req):
+        if hasattr(req, 'key') and isinstance(req.key, FileKeyED2K):
+            self._call('put_negative', keys=[_encode_key(req.key)])
+
+    @_locked
+    def inject_cache(self, req, res):
+        if not isinstance(req, FileRequest) or res.code != AnidbResponse.CODE_RESULT_FILE:
+            return
+        values = {f.name: v for (f, v) in res.iter_raw_kv(req, suppress_truncation_error=True)}
+        pending = self._pending.setdefault(req.key, {'fid': res.decoded['fid'], 'values': {}})
+        pending['values'].update(values)
+        if self.put_batch_size <= len(self._pending):
+            self._send_pending()
+
+    @_locked
+    def locally_service_field_values(self, key, fields):
+        if not isinstance(key, (FileKeyED2K, FileKeyFID)):
+            return []
+        return self._get([key], fields)[0][1].values
+
+    @_locked
+    def prefetch_file_keys(self, keys, fields):
+        return dict(self._get([k for k in keys if isinstance(k, FileKeyED2K)], fields))
+
+    @_locked
+    def take_stale_fields(self):
+        return {fid: set(_fields(names)) for (fid, names) in self._call('take_stale')['stale']}
+
+    @_locked
+    def load_field_size_stats(self):
+        return {name: tuple(v) for (name, v) in self._call('get_field_sizes')['stats'].items()}
+
+    @_locked
+    def store_field_size_stats(self, stats):
+        if stats:
+            self._call('put_field_sizes', stats=stats)
+
+    @_locked
+    def lookup_mylist_entry(self, key):
+        entry = self._call('get_mylist', key=_encode_key(key))['entry']
+        if entry is None:
+            return None
+        entry['updated'] = datetime.fromtimestamp(entry['updated'])
+        return MylistEntry(**entry)
+
+    @_locked
+    def record_mylist_entry(self, key, *, lid, state, viewed, fid=None):
+        self._call('put_mylist', key=_encode_key(key), lid=lid, state=state, viewed=viewed, fid=fid)
+
+    @_locked
+    def forget_mylist_entry(self, key):
+        self._call('forget_mylist', key=_encode_key(key))
+
+    @_locked
+    def flush(self):
+        self._send_pending()
+        self._call('flush')
+
+    def _disconnect(self):
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+
+    @_locked
+    def close(self):
+        if self._sock is None:
+            return
+        try:
+            self.flush()
+        except (OSError, CacheServiceError) as e:
+            print(f"could not write the last entries to the cache server: {e}", file=sys.stderr)
+        if self._sock is not None:
+            self._disconnect()
+
+    def _repr_fields(self):
+        yield ('address', self.address)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
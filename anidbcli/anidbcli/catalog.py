@@ -0,0 +1,140 @@
+import os
+import time
+from collections import namedtuple
+
+from sqlalchemy import MetaData, Table, Column, Integer, Text, Index, delete, select
+from sqlalchemy.dialects.sqlite import insert
+
+from anidbcli.operations import Operation
+
+# Kept in the cache database: one row per file an 'api --sync' run went all the
+# way through, under the path the file is at now.
+catalog_metadata = MetaData()
+anidb_library_catalog = Table(
+    "anidb_library_catalog",
+    catalog_metadata,
+    Column("path", Text, primary_key=True),
+    Column("inode", Integer, nullable=False),
+    Column("size", Integer, nullable=False),
+    Column("mtime", Integer, nullable=False),
+    Column("ed2k", Text, nullable=False),
+    Column("fid", Integer, nullable=True),
+    # what was done last: hashed, mylisted, renamed or linked
+    Column("last_action", Text, nullable=False),
+    # where the file was renamed or linked to, if it was
+    Column("target_path", Text, nullable=True),
+    Column("updated", Integer, nullable=False),
+)
+Index("anidb_library_catalog_inode", anidb_library_catalog.c.inode)
+
+
+class CatalogEntry(namedtuple('_CatalogEntry', ['path', 'inode', 'size', 'mtime', 'ed2k', 'fid', 'last_action', 'target_path', 'updated'])):
+
+    def matches(self, st):
+        return (self.inode, self.size, self.mtime) == (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class SyncPlan(namedtuple('_SyncPlan', ['added', 'changed', 'moved', 'deleted', 'unchanged'])):
+    """What a walk found compared to the catalog.
+
+    added and changed are paths, moved is {new path: CatalogEntry of the old one},
+    deleted the CatalogEntries of files that are gone and unchanged a count.
+    """
+
+    def to_process(self):
+        return sorted(self.added + self.changed + list(self.moved))
+
+
+class LibraryCatalog(object):
+    """The files processed by earlier syncs, so later ones only process what's new."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        with cache.connection() as conn:
+            catalog_metadata.create_all(conn)
+
+    def entries(self):
+        with self.cache.connection() as conn:
+            return {r.path: CatalogEntry(*r) for r in conn.execute(select(anidb_library_catalog))}
+
+    def plan(self, paths):
+        """Compares files found by a walk with the catalog; returns a SyncPlan.
+
+        A file counts as moved if it's new to the catalog, but has the inode, size
+        and mtime of a cataloged file that's gone.  Cataloged files outside the
+        walk that still exist are left alone, and renamed or linked copies made by
+        earlier syncs aren't picked up as new files.
+        """
+        entries = self.entries()
+        targets = {e.target_path for e in entries.values() if e.target_path}
+        (added, changed, unknown) = ([], [], {})
+        (seen, unchanged) = (set(), 0)
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = entries.get(path)
+            if entry is not None:
+                seen.add(path)
+                if entry.matches(st):
+                    unchanged += 1
+                else:
+                    changed.append(path)
+            elif path in targets:
+                unchanged += 1
+            else:
+                unknown[path] = st
+        gone = {(e.inode, e.size, e.mtime): e for e in entries.values()
+                if e.path not in seen and not os.path.exists(e.path)}
+        moved = {}
+        for (path, st) in unknown.items():
+            entry = gone.pop((st.st_ino, st.st_size, st.st_mtime_ns), None)
+            if entry is not None:
+                moved[path] = entry
+            else:
+                added.append(path)
+        return SyncPlan(added, changed, moved, sorted(gone.values()), unchanged)
+
+    def record(self, path, file, last_action, target_path=None, *, replaces=None):
+        """Catalogs a file that went through the pipeline, now at path."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        row = {
+            'path': path,
+            'inode': st.st_ino,
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'ed2k': file['ed2k'],
+            'fid': file.get('info', {}).get('fid'),
+            'last_action': last_action,
+            'target_path': os.path.abspath(target_path) if target_path else None,
+            'updated': int(time.time()),
+        }
+        upsert = insert(anidb_library_catalog)
+        upsert = upsert.on_conflict_do_update(index_elements=['path'], set_={c: upsert.excluded[c] for c in row if c != 'path'})
+        with self.cache.connection() as conn:
+            if replaces is not None and replaces != path:
+                conn.execute(delete(anidb_library_catalog).where(anidb_library_catalog.c.path == replaces))
+            conn.execute(upsert, row)
+
+    def forget(self, paths):
+        with self.cache.connection() as conn:
+            conn.execute(delete(anidb_library_catalog).where(anidb_library_catalog.c.path.in_(list(paths))))
+
+
+class KnownHashOperation(Operation):
+    """Takes ed2k and size from known ({path: CatalogEntry}) instead of hashing files again."""
+
+    def __init__(self, operation, known):
+        self.operation = operation
+        self.known = known
+
+    def __call__(self, file):
+        entry = self.known.get(os.path.abspath(file["file_path"]))
+        if entry is None:
+            return self.operation(file)
+        file['ed2k'] = entry.ed2k
+        file['size'] = entry.size
+        return True
@@ -5,13 +5,13 @@ import sys
 import json
 from base64 import b64encode, b64decode
 
-import pyperclip
 import anidbcli.libed2k as libed2k
-import anidbcli.anidbconnector as anidbconnector
 import anidbcli.output as output
-import anidbcli.operations as operations
-import traceback
-import multiprocessing as mp
+from anidbcli.cachepolicy import FieldTtlPolicy, CachePolicyError, TtlPolicyError, parse_size
+from anidbcli.protocol import FileKeyED2K
+
+# Everything else (the connector, the SQLite cache, pycryptodome, pyperclip) is
+# imported by the commands that use it, so that 'anidbcli ed2k' and --help start fast.
 
 
 @click.group(name="anidbcli")
@@ -45,13 +45,14 @@ def ed2k(ctx , files, clipboard):
         print(link)
         links.append(link)
     if clipboard:
+        import pyperclip
         pyperclip.copy("\n".join(links))
         ctx.obj["output"].success("All links were copied to clipboard.")
 
 @cli.command(help="Utilize the anidb API. You can add files to mylist and/or organize them to directories using "
 + "information obtained from AniDB.")
-@click.option('--username', "-u", prompt=True)
-@click.option('--password', "-p", prompt=True, hide_input=True)
+@click.option('--username', "-u", default=None, help="Prompted for unless the work is forwarded to 'anidbcli serve'.")
+@click.option('--password', "-p", default=None, help="Prompted for unless the work is forwarded to 'anidbcli serve'.")
 @click.option('--apikey', "-k")
 @click.option("--api2", "-2", is_flag=True, default=False, help="Use new implementation")
 @click.option("--api-2x", is_flag=True, default=False, help="Use new implementation x")
@@ -68,9 +69,39 @@ def ed2k(ctx , files, clipboard):
 @click.option("--state", default=0, help="Specify the file state. (0-4)")
 @click.option("--show-ed2k", default=False, is_flag=True, help="Show ed2k link of processed file (while adding or renaming files).")
 @click.option("--suppress-network-activity", default=False, is_flag=True, help="suppress network activity")
+@click.option("--cache-ttl", multiple=True, metavar="NAME=DURATION", help="How long cached values stay fresh, per TTL class "
++ "(immutable, stable, volatile) or field, e.g. volatile=3d or a_english=never. Stale values are used and re-fetched in the background.")
+@click.option("--cache-max-size", default=None, metavar="SIZE", help="Evict the least recently used cache entries beyond this size, e.g. 512M.")
+@click.option("--cache-server", default=None, metavar="ADDRESS", envvar="ANIDBCLI_CACHE_SERVER", help="Use the cache of an "
++ "'anidbcli cache-serve' process (HOST:PORT or a Unix socket path) instead of the local one.")
+@click.option("--cache-backend", type=click.Choice(["sqlite", "kv"]), default="sqlite", show_default=True, envvar="ANIDBCLI_CACHE_BACKEND",
+              help="Keep the local cache in SQLite, or in a faster key-value store that the cache and query commands can't read.")
+@click.option("--no-daemon", is_flag=True, default=False, help="Do the work in this process even if 'anidbcli serve' is running.")
+@click.option("--shortest-job-first", is_flag=True, default=False, help="Among requests of the same priority, send the ones "
++ "with the fewest fields left to fetch first.")
+@click.option("--resume", is_flag=True, default=False, help="Skip what the journal of an earlier, interrupted run "
++ "has as done for a file (hashing, mylist adds and renames).")
+@click.option("--journal", "journal_path", default=None, type=click.Path(dir_okay=False), help="Journal of the run, "
++ "by default run-journal.jsonl in the settings folder. Give each of several parallel runs its own.")
+@click.option("--sync", is_flag=True, default=False, help="Only process files that are new, changed or moved since "
++ "the last --sync run, and report the ones that are gone.")
 @click.argument("files", nargs=-1, type=click.Path(exists=True))
 @click.pass_context
-def api(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, files, keep_structure, date_format, delete_empty, link, softlink, persistent, abort, state, show_ed2k, suppress_network_activity):
+def api(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, files, keep_structure, date_format, delete_empty, link, softlink, persistent, abort, state, show_ed2k, suppress_network_activity, cache_ttl, cache_max_size, cache_server, cache_backend, no_daemon, shortest_job_first, resume, journal_path, sync):
+    import anidbcli.operations as operations
+    import anidbcli.journal as journal
+    ctx.obj["cache_settings"] = parse_cache_settings(cache_ttl, cache_max_size)
+    ctx.obj["shortest_job_first"] = shortest_job_first
+    ctx.obj["cache_server"] = cache_server
+    ctx.obj["cache_backend"] = cache_backend
+    if cache_server is not None and ctx.obj["cache_settings"]:
+        raise click.UsageError("--cache-ttl and --cache-max-size can't change the cache of a cache server, "
+                               "pass them to 'cache-serve' instead.")
+    if sync and (api2 or api_2x):
+        raise click.UsageError("--sync doesn't work with --api2 or --api-2x.")
+    ctx.obj["daemon"] = None if no_daemon or suppress_network_activity else connect_daemon(ctx)
+    if ctx.obj["daemon"] is not None:
+        check_daemon_options(ctx)
     if api_2x:
         return api_2x_impl(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, files, keep_structure, date_format, delete_empty, link, softlink, persistent, abort, state, show_ed2k, suppress_network_activity)
     if api2:
@@ -78,21 +109,68 @@ def api(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, f
     if not add and not rename:
         ctx.obj["output"].info("Nothing to do.")
         return
-    try:
-        conn = get_connector(apikey, username, password, persistent)
-    except Exception as e:
-        raise e
-        ctx.obj["output"].error(e)
-        exit(1)
+    template = compile_rename_template(rename) if rename else None
+    if ctx.obj["daemon"] is not None:
+        import anidbcli.daemon as daemon
+        conn = ctx.obj["daemon"]
+        hash_operation = daemon.DaemonHashOperation(conn, ctx.obj["output"], show_ed2k)
+        mylist_add_operation = daemon.DaemonMylistAddOperation
+        file_info_operation = daemon.DaemonGetFileInfoOperation
+    else:
+        try:
+            conn = get_connector(apikey, username, password, persistent, ctx.obj.get("cache_settings"), cache_server=ctx.obj.get("cache_server"), cache_backend=ctx.obj.get("cache_backend"), shortest_job_first=ctx.obj.get("shortest_job_first", False))
+        except Exception as e:
+            raise e
+            ctx.obj["output"].error(e)
+            exit(1)
+        hash_operation = operations.HashOperation(ctx.obj["output"], show_ed2k)
+        mylist_add_operation = operations.MylistAddOperation
+        file_info_operation = operations.GetFileInfoOperation
+    to_process = get_files_to_process(files, ctx)
+    (catalog, catalog_cache, moved) = (None, None, {})
+    if sync:
+        import anidbcli.catalog as catalog_module
+        (catalog, catalog_cache) = open_catalog(conn)
+        plan = catalog.plan(to_process)
+        for entry in plan.deleted:
+            ctx.obj["output"].warning(f"Gone since the last sync: {entry.path!r}")
+        catalog.forget(entry.path for entry in plan.deleted)
+        ctx.obj["output"].info(f"{len(plan.added)} new, {len(plan.changed)} changed, {len(plan.moved)} moved, "
+                               + f"{len(plan.deleted)} gone and {plan.unchanged} unchanged files.")
+        to_process = plan.to_process()
+        moved = plan.moved
+        # moved files keep their ed2k
+        hash_operation = catalog_module.KnownHashOperation(hash_operation, moved)
+    last_action = "linked" if rename and (link or softlink) else "renamed" if rename else "mylisted" if add else "hashed"
+    run_journal = journal.RunJournal(journal_path or journal.get_journal_path(), resume=resume)
+    def journaled(operation, stage):
+        return journal.JournaledOperation(operation, run_journal, stage, skip=resume)
     pipeline = []
-    pipeline.append(operations.HashOperation(ctx.obj["output"], show_ed2k))
+    stages = [journal.STAGE_HASHED]
+    pipeline.append(journaled(hash_operation, journal.STAGE_HASHED))
+    # with --sync, files whose mylist add is still going on in the background are
+    # cataloged once it succeeded: (path, file_obj) waiting and the paths added
+    (awaiting_mylist, mylisted) = (None, set())
     if add:
-        pipeline.append(operations.MylistAddOperation(conn, ctx.obj["output"], state, unwatched))
+        mylist_add = journaled(mylist_add_operation(conn, ctx.obj["output"], state, unwatched), journal.STAGE_MYLISTED)
+        if ctx.obj["daemon"] is None:
+            # mylist adds go on in the background, taking the rate limit slots lookups leave free
+            def mylist_added(file, res):
+                if file.get("mylisted"):
+                    mylisted.add(file["file_path"])
+            mylist_add = operations.DeferredOperation(mylist_add, on_done=mylist_added)
+            awaiting_mylist = []
+        pipeline.append(mylist_add)
+        stages.append(journal.STAGE_MYLISTED)
     if rename:
-        pipeline.append(operations.GetFileInfoOperation(conn, ctx.obj["output"]))
-        pipeline.append(operations.RenameOperation(ctx.obj["output"], rename, date_format, delete_empty, keep_structure, softlink, link, abort))
-    to_process = get_files_to_process(files, ctx)
+        pipeline.append(journaled(file_info_operation(conn, ctx.obj["output"], fields=template.required_fields()), journal.STAGE_LOOKED_UP))
+        pipeline.append(journaled(operations.RenameOperation(ctx.obj["output"], template, date_format, delete_empty, keep_structure, softlink, link, abort), journal.STAGE_RENAMED))
+        stages.append(journal.STAGE_RENAMED)
+    skipped = 0
     for file in to_process:
+        if resume and run_journal.finished(file, stages):
+            skipped += 1
+            continue
         file_obj = {}
         file_obj["file_path"] = file
         ctx.obj["output"].info("Processing file \"" + file +"\"")
@@ -101,68 +179,423 @@ def api(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, f
             res = operation(file_obj)
             if not res: # Critical error, cannot proceed with pipeline
                 break
+        else:
+            if catalog is not None and awaiting_mylist is not None:
+                awaiting_mylist.append((file, file_obj))
+            elif catalog is not None:
+                catalog_file(ctx, catalog, file, file_obj, last_action, moved)
+    for operation in pipeline:
+        if isinstance(operation, operations.DeferredOperation):
+            operation.close()
+    if catalog is not None:
+        for (file, file_obj) in awaiting_mylist or []:
+            if file in mylisted:
+                catalog_file(ctx, catalog, file, file_obj, last_action, moved)
+    run_journal.close()
+    if catalog_cache is not None:
+        catalog_cache.close()
     conn.close()
+    if skipped:
+        ctx.obj["output"].info(f"Skipped {skipped} files done by an earlier run.")
 
 
 
-def api_2x_impl(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, files, keep_structure, date_format, delete_empty, link, softlink, persistent, abort, state, show_ed2k, suppress_network_activity):
-    conn = get_connector(apikey, username, password, persistent)
-    conn._suppress_network_activity = suppress_network_activity
+@cli.group(help="Manage the local mirror of your mylist.")
+def mylist():
+    pass
 
-    pipeline = []
-    pipeline.append(operations.GetFileInfoOperation(conn, ctx.obj["output"]))
-    
-    file_objs_to_process = []
-    for line in sys.stdin:
+
+@mylist.command(name="import", help="Load an AniDB mylist export (archive or table) into the local cache, so later "
++ "lookups of those files need no network access.")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def mylist_import(ctx, path):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.mylistexport as mylistexport
+    cache = sqlcache.open_default_cache()
+    try:
+        (count, skipped) = cache.bulk_import_export_records(mylistexport.iter_export_records(path))
+    except mylistexport.MylistExportError as e:
+        ctx.obj["output"].error(f"Failed to import {path!r}: {e}")
+        exit(1)
+    finally:
+        cache.close()
+    if skipped:
+        ctx.obj["output"].warning(f"Skipped {skipped} files with invalid values.")
+    ctx.obj["output"].success(f"Imported {count} files from {path!r}.")
+
+
+@cli.group(name="cache", help="Maintain the local cache.")
+def cache_group():
+    pass
+
+
+@cache_group.command(name="maintain", help="Drop expired entries (and the least recently used ones beyond --max-size), "
++ "then vacuum and re-analyze the cache database.")
+@click.option("--max-size", default=None, metavar="SIZE", help="Evict the least recently used entries beyond this size, e.g. 512M.")
+@click.pass_context
+def cache_maintain(ctx, max_size):
+    import anidbcli.sqlcache as sqlcache
+    cache = sqlcache.open_default_cache()
+    try:
+        if max_size is not None:
+            cache.max_size = parse_cache_size(max_size, "--max-size")
+        (before, after) = cache.maintain()
+    finally:
+        cache.close()
+    ctx.obj["output"].success(f"Cache maintained, {before / 2**20:.1f} MiB -> {after / 2**20:.1f} MiB.")
+
+
+@cache_group.command(name="build-index", help="Build or update the compact ed2k index used by runs with "
++ "--suppress-network-activity, which then don't need to open the cache database.")
+@click.option("--full", is_flag=True, default=False, help="Rebuild from scratch, dropping files no longer in the cache.")
+@click.pass_context
+def cache_build_index(ctx, full):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.fidindex as fidindex
+    cache = sqlcache.open_default_cache()
+    try:
+        (total, changed) = fidindex.build_index(cache, fidindex.get_index_path(), full=full)
+    finally:
+        cache.close()
+    ctx.obj["output"].success(f"Index holds {total} files ({changed} added or updated).")
+
+
+@cache_group.command(name="export", help="Write the cache (files, metadata, negative cache and mylist) "
++ "to a compressed snapshot another host can import.")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--since", "since_snapshot", default=None, type=click.Path(exists=True, dir_okay=False),
+              help="Only export what changed since this earlier snapshot was made.")
+@click.pass_context
+def cache_export(ctx, path, since_snapshot):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.snapshot as snapshot
+    since = 0
+    if since_snapshot is not None:
+        try:
+            since = snapshot.read_snapshot_header(since_snapshot).watermark
+        except snapshot.SnapshotError as e:
+            raise click.BadParameter(str(e), param_hint="--since")
+    cache = sqlcache.open_default_cache()
+    try:
+        (_, counts) = snapshot.export_snapshot(cache, path, since=since)
+    finally:
+        cache.close()
+    ctx.obj["output"].success("Exported {} files, {} objects, {} negative cache and {} mylist entries.".format(*counts))
+
+
+@cache_group.command(name="import", help="Merge snapshots made by 'cache export' into the cache, "
++ "keeping whichever side's entries are newer.")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.pass_context
+def cache_import(ctx, paths):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.snapshot as snapshot
+    cache = sqlcache.open_default_cache()
+    try:
+        for path in paths:
+            try:
+                (_, counts) = snapshot.import_snapshot(cache, path)
+            except snapshot.SnapshotError as e:
+                ctx.obj["output"].error(str(e))
+                continue
+            ctx.obj["output"].success("Merged {} files, {} objects, {} negative cache and {} mylist entries from {}.".format(*counts, path))
+    finally:
+        cache.close()
+
+
+@cli.group(name="backfill", help="Look up large libraries over days, within a request budget: files are queued "
++ "in the cache database and 'backfill run' resumes where the last run stopped.")
+def backfill_group():
+    pass
+
+
+def backfill_budget_options(command):
+    command = click.option("--per-day", type=int, default=None, envvar="ANIDBCLI_BACKFILL_PER_DAY",
+                           help="Send at most this many requests in any 24 hours.")(command)
+    command = click.option("--per-hour", type=int, default=None, envvar="ANIDBCLI_BACKFILL_PER_HOUR",
+                           help="Send at most this many requests in any hour.")(command)
+    return command
+
+
+@backfill_group.command(name="add", help="Queue files for 'backfill run'.")
+@click.argument("files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.pass_context
+def backfill_add(ctx, files):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.backfill as backfill
+    cache = sqlcache.open_default_cache()
+    try:
+        queue = backfill.BackfillQueue(cache)
+        added = queue.add(get_files_to_process(files, ctx))
+        pending = queue.pending()
+    finally:
+        cache.close()
+    ctx.obj["output"].success(f"Queued {added} files, {pending} are waiting.")
+
+
+@backfill_group.command(name="status", help="Show how many files are queued and when they'll be done.")
+@backfill_budget_options
+@click.pass_context
+def backfill_status(ctx, per_hour, per_day):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.backfill as backfill
+    cache = sqlcache.open_default_cache()
+    try:
+        backfill.report_progress(backfill.BackfillQueue(cache), backfill.BackfillBudget(per_hour, per_day), ctx.obj["output"])
+    finally:
+        cache.close()
+
+
+@backfill_group.command(name="run", help="Hash and look up queued files, spreading the requests out to stay within the budget.")
+@click.option('--username', "-u", prompt=True)
+@click.option('--password', "-p", prompt=True, hide_input=True)
+@backfill_budget_options
+@click.option("--no-wait", is_flag=True, default=False, help="Stop once the budget is used up instead of waiting for it, e.g. when run from cron.")
+@click.option("--max-files", type=int, default=None, help="Stop after this many files.")
+@click.pass_context
+def backfill_run(ctx, username, password, per_hour, per_day, no_wait, max_files):
+    import anidbcli.backfill as backfill
+    budget = backfill.BackfillBudget(per_hour, per_day)
+    conn = get_connector(None, username, password, False)
+    try:
+        queue = backfill.BackfillQueue(conn.cache)
+        try:
+            done = backfill.run_backfill(queue, conn, ctx.obj["output"], budget, no_wait=no_wait, max_files=max_files)
+            ctx.obj["output"].success(f"Looked up {done} files.")
+        except KeyboardInterrupt:
+            ctx.obj["output"].info("Interrupted, the next 'backfill run' goes on from here.")
+        backfill.report_progress(queue, budget, ctx.obj["output"])
+    finally:
+        conn.close()
+
+
+@cli.command(name="cache-serve", help="Share the local cache with other hosts, which use it with --cache-server.")
+@click.option("--listen", default="127.0.0.1:9740", show_default=True, metavar="ADDRESS",
+              help="HOST:PORT to listen on, or the path of a Unix socket.")
+@click.option("--cache-ttl", multiple=True, metavar="NAME=DURATION", help="How long cached values stay fresh, per TTL class "
++ "(immutable, stable, volatile) or field, e.g. volatile=3d or a_english=never.")
+@click.option("--cache-max-size", default=None, metavar="SIZE", help="Evict the least recently used cache entries beyond this size, e.g. 512M.")
+@click.pass_context
+def cache_serve(ctx, listen, cache_ttl, cache_max_size):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.cacheservice as cacheservice
+    settings = parse_cache_settings(cache_ttl, cache_max_size)
+    cache = sqlcache.open_default_cache()
+    for (name, value) in settings.items():
+        setattr(cache, name, value)
+    try:
+        try:
+            server = cacheservice.CacheServer(cache, listen)
+        except (OSError, cacheservice.CacheServiceError) as e:
+            ctx.obj["output"].error(f"Can't listen on {listen}: {e}")
+            return
+        ctx.obj["output"].info(f"Serving the cache on {server.address}.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.shutdown()
+    finally:
+        cache.close()
+
+
+@cli.command(help="Keep one AniDB session, cache and rate limit for every anidbcli on this host: "
++ "'anidbcli api' forwards its lookups, mylist adds and hashing here while it runs.")
+@click.option('--username', "-u", prompt=True)
+@click.option('--password', "-p", prompt=True, hide_input=True)
+@click.option("--socket", "socket_path", default=None, metavar="PATH", help="Unix socket to listen on, "
++ "by default $ANIDBCLI_DAEMON_SOCKET or ~/.anidbcli/daemon.sock.")
+@click.option("--cache-server", default=None, metavar="ADDRESS", envvar="ANIDBCLI_CACHE_SERVER", help="Use the cache of an "
++ "'anidbcli cache-serve' process instead of the local one.")
+@click.option("--cache-backend", type=click.Choice(["sqlite", "kv"]), default="sqlite", show_default=True, envvar="ANIDBCLI_CACHE_BACKEND",
+              help="Keep the local cache in SQLite or in the key-value store.")
+@click.option("--shortest-job-first", is_flag=True, default=False, help="Among requests of the same priority, send the ones "
++ "with the fewest fields left to fetch first.")
+@click.pass_context
+def serve(ctx, username, password, socket_path, cache_server, cache_backend, shortest_job_first):
+    import anidbcli.daemon as daemon
+    socket_path = socket_path or daemon.get_daemon_socket_path()
+    conn = get_connector(None, username, password, False, cache_server=cache_server, cache_backend=cache_backend, shortest_job_first=shortest_job_first)
+    try:
+        try:
+            server = daemon.Daemon(conn, socket_path, output=ctx.obj["output"])
+        except (OSError, daemon.DaemonError) as e:
+            ctx.obj["output"].error(f"Can't listen on {socket_path}: {e}")
+            return
+        ctx.obj["output"].info(f"Serving on {server.address}.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.shutdown()
+    finally:
+        conn.close()
+
+
+@cli.command(help="Search the files in the local cache by anime, group or episode name, without any network access.")
+@click.argument("text", nargs=-1)
+@click.option("--aid", type=int, default=None, help="Only files of this anime.")
+@click.option("--eid", type=int, default=None, help="Only files of this episode.")
+@click.option("--gid", type=int, default=None, help="Only files by this group.")
+@click.option("--resolution", default=None, help="Only files with this resolution, e.g. 1920x1080.")
+@click.option("--codec", default=None, help="Only files with this video codec, e.g. H264/AVC.")
+@click.option("--limit", type=int, default=50, show_default=True, help="Maximum number of files to list.")
+@click.option("--json", "as_json", is_flag=True, default=False, help="Print one JSON object per file.")
+@click.pass_context
+def query(ctx, text, aid, eid, gid, resolution, codec, limit, as_json):
+    import anidbcli.sqlcache as sqlcache
+    import anidbcli.search as search
+    cache = sqlcache.open_default_cache()
+    try:
+        results = search.search(cache, ' '.join(text), aid=aid, eid=eid, gid=gid, resolution=resolution, codec=codec, limit=limit)
+    finally:
+        cache.close()
+    for r in results:
+        if as_json:
+            click.echo(json.dumps(r._asdict()))
+        else:
+            click.echo(f"{r.title} - {r.ep_no} [{r.group_name}] ({r.resolution}, {r.video_codec}) fid={r.fid} {r.ed2k}-{r.size}")
+    if not results:
+        ctx.obj["output"].info("No matching files in the cache.")
+
+
+def api_2x_impl(ctx, username, password, apikey, api2, api_2x, add, unwatched, rename, files, keep_structure, date_format, delete_empty, link, softlink, persistent, abort, state, show_ed2k, suppress_network_activity):
+    """Answers "LOOKUP [ID] ED2K-SIZE" lines from stdin until "END" (or EOF).
+
+    Each lookup gets a "SUCC [ID] ED2K-SIZE JSON" or "FAIL [ID] ED2K-SIZE" line as
+    soon as it's done: the ones the cache can answer right away, the others as
+    AniDB answers them, so this can run as a long-lived co-process.
+    """
+    import queue
+    import threading
+    import traceback
+    import anidbcli.operations as operations
+    from anidbcli.scheduler import RequestPriority
+    fields = operations.DEFAULT_FILE_INFO_FIELDS
+    print_lock = threading.Lock()
+
+    def answer(file_obj):
+        tag = "" if file_obj['id'] is None else f" {file_obj['id']}"
+        if 'info' in file_obj:
+            line = f"SUCC{tag} {file_obj['ed2k']}-{file_obj['size']} {json.dumps(file_obj['info'], default=json_serial)}"
+        else:
+            line = f"FAIL{tag} {file_obj['ed2k']}-{file_obj['size']}"
+        with print_lock:
+            print(line, flush=True)
+
+    def run(file_obj):
+        try:
+            operation(file_obj)
+        except Exception as e:
+            ctx.obj["output"].error(f"error running {operation!r} on file_obj={file_obj!r}: {e}")
+            print(traceback.format_exc(), file=sys.stderr)
+
+    def work():
+        while True:
+            key = misses.get()
+            if key is None:
+                return
+            with waiting_lock:
+                file_obj = waiting[key][0]
+            # there's a caller waiting on every one of these
+            with conn.prioritized(RequestPriority.INTERACTIVE):
+                run(file_obj)
+            with waiting_lock:
+                file_objs = waiting.pop(key)
+            for other in file_objs:
+                if 'info' in file_obj:
+                    other['info'] = dict(file_obj['info'])
+                answer(other)
+
+    if ctx.obj.get("daemon") is not None:
+        import anidbcli.daemon as daemon
+        conn = ctx.obj["daemon"]
+        # the daemon answers what its cache knows first
+        stream = daemon.DaemonLookupStream(conn, ctx.obj["output"], answer)
+        dispatch = stream.submit
+        finish = stream.close
+    else:
+        conn = get_connector(apikey, username, password, persistent, ctx.obj.get("cache_settings"), offline=suppress_network_activity, cache_server=ctx.obj.get("cache_server"), cache_backend=ctx.obj.get("cache_backend"), shortest_job_first=ctx.obj.get("shortest_job_first", False))
+        conn._suppress_network_activity = suppress_network_activity
+        # this runs for as long as stdin stays open, so results aren't kept around;
+        # duplicate lookups join the one already queued instead.
+        operation = operations.GetFileInfoOperation(conn, ctx.obj["output"], remember_results=False)
+        # lookups that need AniDB go to a thread of their own, so cache hits don't wait behind them
+        misses = queue.Queue()
+        # FileKeyED2K -> file_objs waiting for the queued lookup of that file
+        waiting = {}
+        waiting_lock = threading.Lock()
+        worker = threading.Thread(target=work, name="anidbcli-api-2x", daemon=True)
+        worker.start()
+
+        def dispatch(file_obj):
+            key = FileKeyED2K(file_obj['ed2k'], file_obj['size'])
+            with waiting_lock:
+                if key in waiting:
+                    waiting[key].append(file_obj)
+                    return
+            # straight from the cache: answers the connector kept for every line would pile up
+            lookup = conn.cache.prefetch_file_keys([key], fields).get(key)
+            if lookup is not None and lookup.covers(fields):
+                run(file_obj)
+                answer(file_obj)
+                return
+            with waiting_lock:
+                waiting[key] = [file_obj]
+            misses.put(key)
+
+        def finish():
+            misses.put(None)
+            worker.join()
+
+    for line in iter(sys.stdin.readline, ''):
         line = line.strip()
         if not line:
             continue
         if line == "END":
             break
-        if line.startswith("LOOKUP "):
-            line = line.removeprefix("LOOKUP ")
-            (ed2k, size) = line.split('-')
-            size = int(size)
-            doc = {
-                'ed2k': ed2k,
-                'size': size,
-            }
-            file_objs_to_process.append(doc)
-            print(f"register {doc!r}", file=sys.stderr)
-
-    for file_obj in file_objs_to_process:
-        for operation in pipeline:
-            try:
-                res = operation(file_obj)
-            except Exception as e:
-                if 'file_path' in file_obj:
-                    ctx.obj["output"].error(f"error running {operation!r} on {file_obj['file_path']!r}: {e}")
-                else:
-                    ctx.obj["output"].error(f"error running {operation!r} on file_obj={file_obj!r}: {e}")
-                    print(traceback.format_exc(), file=sys.stderr)
-                    break
-            if not res:  # Critical error, cannot proceed with pipeline
-                break
-    for file_obj in file_objs_to_process:
-        if 'info' in file_obj:
-            print(f"SUCC {file_obj['ed2k']}-{file_obj['size']} {json.dumps(file_obj['info'], default=json_serial)}")
-    for file_obj in file_objs_to_process:
-        if 'info' not in file_obj:
-            print(f"FAIL {file_obj['ed2k']}-{file_obj['size']}")
+        if not line.startswith("LOOKUP "):
+            print(f"ignoring {line!r}", file=sys.stderr)
+            continue
+        words = line.removeprefix("LOOKUP ").split()
+        request_id = words[0] if len(words) == 2 else None
+        (ed2k, _, size) = words[-1].partition('-')
+        doc = {
+            'id': request_id,
+            'ed2k': ed2k,
+            'size': size,
+        }
+        try:
+            doc['size'] = int(size)
+        except ValueError:
+            answer(doc)
+            continue
+        print(f"register {doc!r}", file=sys.stderr)
+        dispatch(doc)
+    finish()
     conn.close()
 
 
 def api2impl(ctx, username, password, apikey, api2, add, unwatched, rename, files, keep_structure, date_format, delete_empty, link, softlink, persistent, abort, state, show_ed2k, suppress_network_activity):
+    import traceback
+    import anidbcli.operations as operations
     if not rename:
         ctx.obj["output"].info("Nothing to do.")
         return
-    conn = get_connector(apikey, username, password, persistent)
-    conn._suppress_network_activity = suppress_network_activity
-
+    template = compile_rename_template(rename)
     pipeline = []
-    pipeline.append(operations.HashOperation(ctx.obj["output"], show_ed2k))
-    pipeline.append(operations.GetFileInfoOperation(conn, ctx.obj["output"]))
-    pipeline.append(operations.RenameOperation(ctx.obj["output"], rename, date_format, delete_empty, keep_structure, softlink, link, abort))
+    if ctx.obj.get("daemon") is not None:
+        import anidbcli.daemon as daemon
+        conn = ctx.obj["daemon"]
+        pipeline.append(daemon.DaemonHashOperation(conn, ctx.obj["output"], show_ed2k))
+        pipeline.append(daemon.DaemonGetFileInfoOperation(conn, ctx.obj["output"], fields=template.required_fields()))
+    else:
+        conn = get_connector(apikey, username, password, persistent, ctx.obj.get("cache_settings"), offline=suppress_network_activity, cache_server=ctx.obj.get("cache_server"), cache_backend=ctx.obj.get("cache_backend"), shortest_job_first=ctx.obj.get("shortest_job_first", False))
+        conn._suppress_network_activity = suppress_network_activity
+        pipeline.append(operations.HashOperation(ctx.obj["output"], show_ed2k))
+        pipeline.append(operations.GetFileInfoOperation(conn, ctx.obj["output"], fields=template.required_fields()))
+    pipeline.append(operations.RenameOperation(ctx.obj["output"], template, date_format, delete_empty, keep_structure, softlink, link, abort))
     
     file_objs_to_process = []
     for file_path in get_files_to_process(files, ctx):
@@ -213,7 +646,8 @@ def decorate_with_cached(file_objs):
                 print(f"obj = {obj!r}", file=sys.stderr)
 
 
-def get_connector(apikey, username, password, persistent):
+def get_connector(apikey, username, password, persistent, cache_settings=None, offline=False, cache_server=None, cache_backend=None, shortest_job_first=False):
+    import anidbcli.anidbconnector as anidbconnector
     conn = None
     if persistent:
         path = anidbconnector.get_persistent_file_path()
@@ -223,14 +657,143 @@ def get_connector(apikey, username, password, persistent):
                 data = json.loads(lines)
                 if ((time.time() - data["timestamp"]) < 60 * 10):
                     conn = anidbconnector.AnidbConnector.create_from_session(data["session_key"], data["sockaddr"], apikey, data["salt"])
-    if (conn != None): return conn
-    if apikey:
-        conn = anidbconnector.AnidbConnector.create_secure(username, password, apikey)
-    else:
-        conn = anidbconnector.AnidbConnector.create_plain(username, password)
+    if (conn == None):
+        if username is None:
+            username = click.prompt("Username")
+        if password is None:
+            password = click.prompt("Password", hide_input=True)
+        if apikey:
+            conn = anidbconnector.AnidbConnector.create_secure(username, password, apikey)
+        else:
+            conn = anidbconnector.AnidbConnector.create_plain(username, password, cache_impl=open_cache(offline, cache_server, cache_backend))
+    for (name, value) in (cache_settings or {}).items():
+        setattr(conn.cache, name, value)
+    conn.scheduler.shortest_job_first = shortest_job_first
     return conn
 
 
+def open_catalog(conn):
+    """The library catalog of --sync, in the connector's cache database if it uses one.
+
+    Returns (catalog, the cache opened for it, which the caller closes, or None).
+    """
+    import anidbcli.catalog as catalog
+    cache = getattr(conn, "cache", None)
+    if hasattr(cache, "connection"):
+        return (catalog.LibraryCatalog(cache), None)
+    import anidbcli.sqlcache as sqlcache
+    cache = sqlcache.open_default_cache()
+    return (catalog.LibraryCatalog(cache), cache)
+
+
+def catalog_file(ctx, catalog, file, file_obj, last_action, moved):
+    """Catalogs a file --sync processed, under the path it was moved to if it was renamed."""
+    old_path = moved[file].path if file in moved else os.path.abspath(file)
+    target = file_obj["file_path"] if last_action in ("renamed", "linked") else None
+    path = target if last_action == "renamed" else file
+    try:
+        catalog.record(path, file_obj, last_action, target, replaces=old_path)
+    except OSError as e:
+        ctx.obj["output"].warning(f"Couldn't add {path!r} to the catalog: {e}")
+
+
+# api options for the session of this process, which work forwarded to the
+# daemon doesn't need, and ones for its cache and scheduling, which the daemon's
+# own settings would silently override
+DAEMON_IGNORED_OPTIONS = ("username", "password", "apikey", "persistent")
+DAEMON_REFUSED_OPTIONS = ("cache_ttl", "cache_max_size", "cache_server", "cache_backend", "shortest_job_first")
+
+
+def check_daemon_options(ctx):
+    """Refuses options given on the command line that would change what the daemon ctx.obj["daemon"] does.
+
+    The session options it goes without are only noted.
+    """
+    from click.core import ParameterSource
+    def given(names):
+        return [max(p.opts, key=len) for p in ctx.command.params
+                if p.name in names and ctx.get_parameter_source(p.name) == ParameterSource.COMMANDLINE]
+    client = ctx.obj["daemon"]
+    refused = given(DAEMON_REFUSED_OPTIONS)
+    if refused:
+        raise click.UsageError(f"{', '.join(refused)} can't apply to the work forwarded to the daemon at {client.path}, "
+                               "pass --no-daemon to do it in this process.")
+    ignored = given(DAEMON_IGNORED_OPTIONS)
+    if ignored:
+        ctx.obj["output"].info(f"Ignoring {', '.join(ignored)}, the daemon uses its own session.")
+
+
+def connect_daemon(ctx):
+    """A client of the running 'anidbcli serve', or None if there isn't one."""
+    import anidbcli.daemon as daemon
+    client = daemon.DaemonClient.connect_if_running()
+    if client is not None:
+        # closed however the command ends, early returns and usage errors included
+        ctx.call_on_close(client.close)
+        ctx.obj["output"].info(f"Forwarding to the daemon at {client.path}.")
+    return client
+
+
+def open_cache(offline, cache_server, cache_backend=None):
+    """The cache_impl for a connector, None meaning the default local cache."""
+    if cache_server is not None:
+        import anidbcli.anidbconnector as anidbconnector
+        import anidbcli.cacheservice as cacheservice
+        try:
+            return cacheservice.AnidbCacheRemote.connect(cache_server)
+        except OSError as e:
+            print(f"can't reach the cache server at {cache_server} ({e}), going on without a cache", file=sys.stderr)
+            return anidbconnector.AnidbCacheNoop()
+    if cache_backend == "kv":
+        import anidbcli.kvcache as kvcache
+        try:
+            return kvcache.open_default_kv_cache()
+        except kvcache.KvCacheError as e:
+            raise click.ClickException(str(e))
+    if offline:
+        return open_offline_cache()
+    return None
+
+
+def open_offline_cache():
+    """The fid index if there is one (see 'cache build-index'), which read-only runs can use instead of the database."""
+    import anidbcli.fidindex as fidindex
+    path = fidindex.get_index_path()
+    if not os.path.exists(path):
+        return None
+    index = fidindex.FidIndex.open(path)
+    print(f"using {index!r}", file=sys.stderr)
+    return fidindex.AnidbCacheFidIndex(index)
+
+
+def compile_rename_template(rename):
+    from anidbcli.template import RenameTemplate, TemplateSyntaxError
+    try:
+        return RenameTemplate.compile(rename)
+    except TemplateSyntaxError as e:
+        raise click.BadParameter(str(e), param_hint="--rename")
+
+
+def parse_cache_settings(cache_ttl, cache_max_size):
+    """The attributes --cache-ttl and --cache-max-size set on a cache."""
+    settings = {}
+    try:
+        if cache_ttl:
+            settings["ttl_policy"] = FieldTtlPolicy.parse(cache_ttl)
+    except TtlPolicyError as e:
+        raise click.BadParameter(str(e), param_hint="--cache-ttl")
+    if cache_max_size is not None:
+        settings["max_size"] = parse_cache_size(cache_max_size, "--cache-max-size")
+    return settings
+
+
+def parse_cache_size(text, param_hint):
+    try:
+        return parse_size(text)
+    except CachePolicyError as e:
+        raise click.BadParameter(str(e), param_hint=param_hint)
+
+
 def get_files_to_process(files, ctx):
     to_process = []
     for file in files:
@@ -0,0 +1,504 @@
+import collections
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+from datetime import date, datetime
+
+import anidbcli.operations as operations
+from anidbcli.anidbconnector import get_persistence_base_path
+from anidbcli.cacheservice import _socket_in_use
+from anidbcli.protocol import FileKeyED2K, file_field_by_name
+from anidbcli.scheduler import RequestPriority
+
+# Clients send one JSON object per line, {"id": ..., "op": name, ...arguments}, and
+# may send more before the first is answered.  Every request gets one line back,
+# carrying its id, once it's done (so not necessarily in order):
+#   {"id": ..., "ok": true, "messages": [[level, text], ...], ...results}
+#   {"id": ..., "ok": false, "error": text, "messages": [...]}
+# The messages are what the operation printed, for the client to show.
+#   lookup      {"ed2k", "size", "fields": [names] (optional)} -> {"info": {...}}
+#   mylist_add  {"ed2k", "size", "state", "viewed"} -> {}
+#   hash        {"path": absolute path} -> {"ed2k", "size"}
+#   ping        {} -> {}
+DAEMON_SOCKET_NAME = "daemon.sock"
+
+
+class DaemonError(Exception):
+    pass
+
+
+def get_daemon_socket_path():
+    return os.getenv("ANIDBCLI_DAEMON_SOCKET") or os.path.join(get_persistence_base_path(), DAEMON_SOCKET_NAME)
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"{obj.__class__.__name__} is not JSON serializable")
+
+
+def _file_key(args):
+    try:
+        return FileKeyED2K(str(args['ed2k']).lower(), int(args['size']))
+    except (KeyError, TypeError, ValueError):
+        raise DaemonError("ed2k and size are required")
+
+
+def _fields(names):
+    if names is None:
+        return list(operations.DEFAULT_FILE_INFO_FIELDS)
+    fields = []
+    for name in names:
+        f = file_field_by_name(name)
+        if f is None:
+            raise DaemonError(f"unknown field {name!r}")
+        fields.append(f)
+    return fields
+
+
+class FairQueue(object):
+    """Jobs of many clients, handed out by priority, then round-robin by client.
+
+    Jobs with a lower priority value always go first.  Among jobs of the same
+    priority, one client queueing a whole library doesn't hold up the others:
+    each of them gets its next job run after at most one job of every other
+    waiting client.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # priority -> client -> deque of jobs, clients in the order they get their next turn
+        self._queues = {}
+        self._closed = False
+
+    def put(self, client, job, priority=0):
+        with self._cond:
+            clients = self._queues.setdefault(int(priority), collections.OrderedDict())
+            clients.setdefault(client, collections.deque()).append(job)
+            self._cond.notify()
+
+    def get(self):
+        """The next job, or None once the queue is closed."""
+        with self._cond:
+            while not self._closed and not self._queues:
+                self._cond.wait()
+            if self._closed:
+                return None
+            priority = min(self._queues)
+            clients = self._queues[priority]
+            (client, jobs) = clients.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                clients[client] = jobs
+            if not clients:
+                del self._queues[priority]
+            return job
+
+    def pending(self):
+        with self._cond:
+            return sum(len(jobs) for clients in self._queues.values() for jobs in clients.values())
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _repr_fields(self):
+        yield ('pending', self.pending())
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+class _Job(object):
+    def __init__(self, op, key, run):
+        self.op = op
+        self.key = key
+        self.run = run
+        # (handler, request id) for every request this job answers
+        self.waiters = []
+
+
+class _JobOutput(object):
+    """Records what an operation prints, for the clients waiting on it, and logs it too."""
+
+    def __init__(self, output):
+        self.output = output
+        self.messages = []
+
+    def _write(self, level, message):
+        self.messages.append((level, str(message)))
+        getattr(self.output, level)(message)
+
+    def info(self, message):
+        self._write('info', message)
+
+    def success(self, message):
+        self._write('success', message)
+
+    def warning(self, message):
+        self._write('warning', message)
+
+    def error(self, message):
+        self._write('error', message)
+
+    def last_error(self):
+        errors = [m for (level, m) in self.messages if level == 'error']
+        return errors[-1] if errors else None
+
+
+class _DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self._write_lock = threading.Lock()
+
+    def handle(self):
+        for line in self.rfile:
+            request_id = None
+            try:
+                req = json.loads(line)
+                request_id = req.pop('id', None)
+                op = req.pop('op', None)
+                if op == 'ping':
+                    self.reply({'id': request_id, 'ok': True, 'messages': []})
+                else:
+                    self.server.daemon.submit(self, request_id, op, req)
+            except Exception as e:
+                self.reply({'id': request_id, 'ok': False, 'error': f"{e.__class__.__name__}: {e}", 'messages': []})
+
+    def reply(self, res):
+        data = json.dumps(res, ensure_ascii=False, default=_json_default).encode('utf-8') + b'\n'
+        with self._write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                pass  # the client went away, its answers are still cached
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """Runs lookups, mylist adds and hashing for many anidbcli processes.
+
+    There's one connector, so one session and one rate limit, however many
+    clients are connected.  Identical requests in flight are run once and
+    answered together.  AniDB requests run one at a time, lookups before
+    mylist adds; lookups the cache can answer run on a thread of their own and
+    hashing on hash_workers threads, all taking turns between the clients.
+    """
+
+    def __init__(self, connector, path, *, output, hash_workers=1):
+        if _socket_in_use(path):
+            raise DaemonError(f"a daemon is already listening on {path}")
+        if os.path.exists(path):
+            os.unlink(path)
+        self.connector = connector
+        self.output = output
+        self._lock = threading.Lock()
+        # dedupe key -> _Job, from submit() until its answers are sent
+        self._inflight = {}
+        # lookups the cache can answer don't wait behind the ones that need AniDB
+        self._queues = {'network': FairQueue(), 'cache': FairQueue(), 'hash': FairQueue()}
+        self._workers = [
+            threading.Thread(target=self._work, args=(self._queues['network'],), name="anidbcli-daemon-network", daemon=True),
+            threading.Thread(target=self._work, args=(self._queues['cache'],), name="anidbcli-daemon-cache", daemon=True),
+        ]
+        for i in range(hash_workers):
+            self._workers.append(threading.Thread(target=self._work, args=(self._queues['hash'],), name=f"anidbcli-daemon-hash-{i}", daemon=True))
+        self.server = _UnixServer(path, _DaemonRequestHandler)
+        self.server.daemon = self
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def _prepare_lookup(self, args):
+        key = _file_key(args)
+        fields = _fields(args.get('fields'))
+        # straight from the cache, the connector would keep the answer for as long as it runs
+        lookup = self.connector.cache.prefetch_file_keys([key], fields).get(key)
+
+        def run(output):
+            file = {'ed2k': key.ed2k, 'size': key.size}
+            ok = operations.GetFileInfoOperation(self.connector, output, fields=fields)(file)
+            return (ok, {'info': file.get('info')})
+        queue_name = 'cache' if lookup is not None and lookup.covers(fields) else 'network'
+        return (queue_name, RequestPriority.INTERACTIVE, (key, tuple(f.name for f in fields)), run)
+
+    def _prepare_mylist_add(self, args):
+        key = _file_key(args)
+        (state, viewed) = (int(args.get('state', 0)), int(bool(args.get('viewed', True))))
+
+        def run(output):
+            file = {'ed2k': key.ed2k, 'size': key.size}
+            operations.MylistAddOperation(self.connector, output, state, not viewed)(file)
+            return (True, {'mylisted': bool(file.get('mylisted'))})
+        return ('network', RequestPriority.MYLIST, (key, state, viewed), run)
+
+    def _prepare_hash(self, args):
+        path = args.get('path')
+        if not isinstance(path, str) or not os.path.isabs(path):
+            raise DaemonError("hash needs an absolute path")
+
+        def run(output):
+            file = {'file_path': path}
+            ok = operations.HashOperation(output, False)(file)
+            return (ok, {'ed2k': file.get('ed2k'), 'size': file.get('size')})
+        return ('hash', RequestPriority.INTERACTIVE, path, run)
+
+    def submit(self, handler, request_id, op, args):
+        prepare = getattr(self, '_prepare_' + str(op), None)
+        if prepare is None:
+            raise DaemonError(f"unknown op {op!r}")
+        (queue_name, priority, key, run) = prepare(args)
+        key = (op, key)
+        with self._lock:
+            job = self._inflight.get(key)
+            if job is None:
+                job = self._inflight[key] = _Job(op, key, run)
+                self._queues[queue_name].put(handler, job, priority)
+            job.waiters.append((handler, request_id))
+
+    def _work(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            output = _JobOutput(self.output)
+            try:
+                (ok, res) = job.run(output)
+                res = {'ok': bool(ok), **res}
+                if not ok:
+                    res['error'] = output.last_error() or f"{job.op} failed"
+            except Exception as e:
+                print(f"{job.op} {job.key!r} failed: {e}", file=sys.stderr)
+                res = {'ok': False, 'error': f"{e.__class__.__name__}: {e}"}
+            res['messages'] = output.messages
+            with self._lock:
+                del self._inflight[job.key]
+                waiters = job.waiters
+            for (handler, request_id) in waiters:
+                handler.reply({'id': request_id, **res})
+
+    def pending(self):
+        return {name: queue.pending() for (name, queue) in self._queues.items()}
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        """Stops accepting requests and waits for the running ones; queued ones are dropped."""
+        self.server.shutdown()
+        self.server.server_close()
+        for queue in self._queues.values():
+            queue.close()
+        for worker in self._workers:
+            worker.join()
+        os.unlink(self.server.server_address)
+
+    def _repr_fields(self):
+        yield ('address', self.address)
+        yield ('pending', self.pending())
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+class DaemonClient(object):
+    """Connection to an 'anidbcli serve' daemon."""
+
+    def __init__(self, path):
+        self.path = path
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._file = self._sock.makefile('rwb')
+        self._next_id = 0
+        # answers read while waiting for another one, by request id
+        self._answers = {}
+
+    @classmethod
+    def connect_if_running(cls, path=None):
+        """A DaemonClient, or None if no daemon is listening on path."""
+        try:
+            return cls(path or get_daemon_socket_path())
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+    def submit(self, op, **args):
+        """Sends a request without waiting for the answer; returns its id for wait()."""
+        with self._write_lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._file.write(json.dumps({'id': request_id, 'op': op, **args}, ensure_ascii=False).encode('utf-8') + b'\n')
+            self._file.flush()
+        return request_id
+
+    def wait(self, request_id=None):
+        """The answer to request_id, or with None the next answer to any request."""
+        with self._read_lock:
+            while True:
+                if request_id is None and self._answers:
+                    return self._answers.pop(next(iter(self._answers)))
+                if request_id in self._answers:
+                    return self._answers.pop(request_id)
+                line = self._file.readline()
+                if not line:
+                    raise DaemonError(f"the daemon at {self.path} closed the connection")
+                res = json.loads(line)
+                self._answers[res.get('id')] = res
+
+    def call(self, op, **args):
+        return self.wait(self.submit(op, **args))
+
+    def close(self):
+        if self._sock is None:
+            return
+        self._file.close()
+        self._sock.close()
+        self._sock = None
+
+    def _repr_fields(self):
+        yield ('path', self.path)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+def _replay(output, res):
+    for (level, message) in res.get('messages', []):
+        getattr(output, level)(message)
+    if not res['ok'] and not res.get('messages'):
+        output.error(res['error'])
+
+
+def _decode_info(info):
+    for (name, value) in info.items():
+        f = file_field_by_name(name)
+        if f is not None and getattr(f, 'pytype', None) is datetime and isinstance(value, str):
+            info[name] = datetime.fromisoformat(value)
+    return info
+
+
+class DaemonHashOperation(operations.Operation):
+    """HashOperation, done by the daemon."""
+
+    def __init__(self, client, output, show_ed2k):
+        self.client = client
+        self.output = output
+        self.show_ed2k = show_ed2k
+
+    def __call__(self, file):
+        res = self.client.call('hash', path=os.path.abspath(file['file_path']))
+        _replay(self.output, res)
+        if not res['ok']:
+            return False
+        file['ed2k'] = res['ed2k']
+        file['size'] = res['size']
+        if self.show_ed2k:
+            self.output.info("{!r} was hashed: {}".format(file['file_path'], file['ed2k']))
+        return True
+
+
+class DaemonGetFileInfoOperation(operations.Operation):
+    """GetFileInfoOperation, done by the daemon."""
+
+    def __init__(self, client, output, fields=None):
+        self.client = client
+        self.output = output
+        self.fields = None if fields is None else [f.name for f in fields]
+
+    def __call__(self, file):
+        res = self.client.call('lookup', ed2k=file['ed2k'], size=file['size'], fields=self.fields)
+        _replay(self.output, res)
+        if not res['ok']:
+            return False
+        file['info'] = _decode_info(res['info'])
+        return True
+
+
+class DaemonMylistAddOperation(operations.Operation):
+    """MylistAddOperation, done by the daemon."""
+
+    def __init__(self, client, output, state, unwatched):
+        self.client = client
+        self.output = output
+        self.state = int(state)
+        self.viewed = 0 if unwatched else 1
+
+    def __call__(self, file):
+        res = self.client.call('mylist_add', ed2k=file['ed2k'], size=file['size'], state=self.state, viewed=self.viewed)
+        _replay(self.output, res)
+        if res.get('mylisted'):
+            file['mylisted'] = True
+        return True
+
+
+class DaemonLookupStream(object):
+    """Sends lookups to the daemon as they come, and hands back each answer once it arrives.
+
+    on_answer(file) is called on a thread of its own, with file['info'] set if
+    the lookup succeeded, in whatever order the daemon answers.
+    """
+
+    def __init__(self, client, output, on_answer, fields=None):
+        self.client = client
+        self.output = output
+        self.on_answer = on_answer
+        self.fields = None if fields is None else [f.name for f in fields]
+        self._cond = threading.Condition()
+        # request id -> file, for lookups not answered yet
+        self._pending = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._collect, name="anidbcli-daemon-answers", daemon=True)
+        self._thread.start()
+
+    def submit(self, file):
+        with self._cond:
+            request_id = self.client.submit('lookup', ed2k=file['ed2k'], size=file['size'], fields=self.fields)
+            self._pending[request_id] = file
+            self._cond.notify()
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            try:
+                res = self.client.wait()
+            except (OSError, ValueError, DaemonError) as e:
+                self.output.error(f"Lost the daemon: {e}")
+                with self._cond:
+                    (lost, self._pending) = (list(self._pending.values()), {})
+                for file in lost:
+                    self.on_answer(file)
+                continue
+            with self._cond:
+                file = self._pending.pop(res.get('id'), None)
+            if file is None:
+                continue
+            _replay(self.output, res)
+            if res['ok']:
+                file['info'] = _decode_info(res['info'])
+            self.on_answer(file)
+
+    def close(self):
+        """Waits for the answers to everything submitted."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -1,5 +1,4 @@
 from abc import ABC, abstractmethod
-from Crypto.Cipher import AES
 
 class TextCrypto:
     @abstractmethod
@@ -21,6 +20,8 @@ unpad = lambda s : s[0:-s[-1]]
 
 class Aes128TextEncryptor(TextCrypto):
     def __init__(self, encryption_key):
+        # pycryptodome is only needed for encrypted sessions
+        from Crypto.Cipher import AES
         self.aes = AES.new(encryption_key, AES.MODE_ECB)
 
     def Encrypt(self, message):
@@ -0,0 +1,245 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import time
+from collections import namedtuple
+
+from anidbcli.anidbconnector import AnidbCacheNoop, CachedFileLookup, ImplicitField, _decode_payload, _iter_payload_entries, _payload_entity_ids, get_persistence_base_path
+from anidbcli.protocol import FileKeyED2K
+
+# Layout, all integers big-endian:
+#   header
+#   file records, sorted by (ed2k, size) so the first 24 bytes compare like the key
+#   entity records (anime/episode/group objects), sorted by (type, id)
+#   payloads: the compact JSON cache payloads the records point at
+INDEX_MAGIC = b'ADBFIDX1'
+HEADER = struct.Struct('>8sQQQQQ')  # magic, files, entities, watermark row id, watermark time, payloads offset
+FILE_RECORD = struct.Struct('>16sQIQI')  # ed2k, size, fid, payload offset, payload length
+FILE_KEY_SIZE = 24
+ENTITY_RECORD = struct.Struct('>BIQI')  # entity type, id, payload offset, payload length
+ENTITY_KEY_SIZE = 5
+ENTITY_TYPES = ('anime', 'episode', 'group')
+
+
+class FidIndexError(Exception):
+    pass
+
+
+class IndexWatermark(namedtuple('_IndexWatermark', ['file_row_id', 'updated'])):
+    """How far into the cache an index goes: anidb_files rows up to file_row_id, and
+    objects updated before updated (a unix timestamp)."""
+    pass
+
+
+def get_index_path():
+    return os.path.join(get_persistence_base_path(), "fid-index.bin")
+
+
+def _file_key(ed2k, size):
+    return bytes.fromhex(ed2k) + size.to_bytes(8, 'big')
+
+
+def _entity_key(entity, entity_id):
+    return ENTITY_TYPES.index(entity).to_bytes(1, 'big') + entity_id.to_bytes(4, 'big')
+
+
+def _bisect(buf, start, count, record_size, key):
+    """Returns the offset of the record starting with key, or None."""
+    (lo, hi) = (0, count)
+    key_size = len(key)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset = start + mid * record_size
+        probe = buf[offset:offset + key_size]
+        if probe < key:
+            lo = mid + 1
+        elif key < probe:
+            hi = mid
+        else:
+            return offset
+    return None
+
+
+class FidIndex(object):
+    """Read-only, memory-mapped ed2k+size -> fid (and cached fields) index.
+
+    Built from the SQLite cache by build_index(); lookups are a binary search over
+    fixed-size records in the mapping, with nothing parsed up front.
+    """
+
+    def __init__(self, path, fh, buf):
+        self.path = path
+        self._fh = fh
+        self._buf = buf
+        (magic, self.file_count, self.entity_count, row_id, updated, self._payloads) = HEADER.unpack_from(buf, 0)
+        if magic != INDEX_MAGIC:
+            raise FidIndexError(f"{path!r} is not an anidbcli fid index")
+        self.watermark = IndexWatermark(row_id, updated)
+        self._files_start = HEADER.size
+        self._entities_start = self._files_start + self.file_count * FILE_RECORD.size
+
+    @classmethod
+    def open(cls, path):
+        fh = open(path, 'rb')
+        try:
+            buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            fh.close()
+            raise FidIndexError(f"{path!r} is empty")
+        return cls(path, fh, buf)
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._fh.close()
+            self._buf = None
+
+    def __len__(self):
+        return self.file_count
+
+    def _payload(self, offset, length):
+        if not length:
+            return None
+        return _decode_payload(self._buf[self._payloads + offset:self._payloads + offset + length])
+
+    def lookup(self, ed2k, size):
+        """Returns (fid, file payload) or None if the file isn't in the index."""
+        offset = _bisect(self._buf, self._files_start, self.file_count, FILE_RECORD.size, _file_key(ed2k, size))
+        if offset is None:
+            return None
+        (_, _, fid, payload_offset, payload_length) = FILE_RECORD.unpack_from(self._buf, offset)
+        return (fid, self._payload(payload_offset, payload_length))
+
+    def entity_payload(self, entity, entity_id):
+        offset = _bisect(self._buf, self._entities_start, self.entity_count, ENTITY_RECORD.size, _entity_key(entity, entity_id))
+        if offset is None:
+            return None
+        (_, _, payload_offset, payload_length) = ENTITY_RECORD.unpack_from(self._buf, offset)
+        return self._payload(payload_offset, payload_length)
+
+    def _iter_raw(self, start, count, record, key_size):
+        """Yields (key, record without payload location, raw payload) in key order."""
+        for i in range(count):
+            offset = start + i * record.size
+            values = record.unpack_from(self._buf, offset)
+            (payload_offset, payload_length) = values[-2:]
+            payload = self._buf[self._payloads + payload_offset:self._payloads + payload_offset + payload_length]
+            yield (self._buf[offset:offset + key_size], values[:-2], payload)
+
+    def iter_files(self):
+        return self._iter_raw(self._files_start, self.file_count, FILE_RECORD, FILE_KEY_SIZE)
+
+    def iter_entities(self):
+        return self._iter_raw(self._entities_start, self.entity_count, ENTITY_RECORD, ENTITY_KEY_SIZE)
+
+    def _repr_fields(self):
+        yield ('path', self.path)
+        yield ('files', self.file_count)
+        yield ('watermark', self.watermark)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+def _merge_sorted(old, new):
+    """Merges two key-sorted record streams; records in new replace those in old."""
+    old = iter(old)
+    new = iter(new)
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a
+            a = next(old, None)
+        else:
+            if a is not None and a[0] == b[0]:
+                a = next(old, None)
+            yield b
+            b = next(new, None)
+
+
+def _write_index(path, files, entities, watermark):
+    """Streams the records to path + '.tmp'; returns (that path, number of files)."""
+    tmp_path = path + '.tmp'
+    counts = [0, 0]
+    with open(tmp_path, 'w+b') as fh, tempfile.TemporaryFile() as payloads:
+        fh.write(HEADER.pack(INDEX_MAGIC, 0, 0, 0, 0, 0))
+        for (i, (records, record)) in enumerate(((files, FILE_RECORD), (entities, ENTITY_RECORD))):
+            for (_, values, payload) in records:
+                fh.write(record.pack(*values, payloads.tell(), len(payload)))
+                payloads.write(payload)
+                counts[i] += 1
+        payloads_offset = fh.tell()
+        payloads.seek(0)
+        shutil.copyfileobj(payloads, fh)
+        fh.seek(0)
+        fh.write(HEADER.pack(INDEX_MAGIC, counts[0], counts[1], watermark.file_row_id, watermark.updated, payloads_offset))
+    return (tmp_path, counts[0])
+
+
+def build_index(cache, path, *, full=False):
+    """Creates the index at path from an AnidbCacheSqlAlchemy, or brings it up to date.
+
+    Only files and objects added or changed since the index's watermark are read
+    from the cache; files dropped from the cache stay in the index until a full
+    rebuild.  Returns (files in the index, files read from the cache).
+    """
+    old = None
+    if not full and os.path.exists(path):
+        old = FidIndex.open(path)
+    since = old.watermark if old is not None else IndexWatermark(0, 0)
+    started = int(time.time())
+    (max_row_id, changed_files, changed_entities) = cache.index_changes(since.file_row_id, since.updated)
+
+    files = sorted(
+        (_file_key(ed2k, size), (bytes.fromhex(ed2k), size, fid), payload.encode('utf-8') if payload else b'')
+        for (ed2k, size, fid, payload) in changed_files)
+    entities = sorted(
+        (_entity_key(entity, entity_id), (ENTITY_TYPES.index(entity), entity_id), payload.encode('utf-8'))
+        for (entity, entity_id, payload) in changed_entities if entity in ENTITY_TYPES)
+    if old is not None:
+        files = _merge_sorted(old.iter_files(), files)
+        entities = _merge_sorted(old.iter_entities(), entities)
+    watermark = IndexWatermark(max(max_row_id, since.file_row_id), started)
+    try:
+        (tmp_path, file_count) = _write_index(path, files, entities, watermark)
+    finally:
+        if old is not None:
+            old.close()
+    os.replace(tmp_path, path)
+    return (file_count, len(changed_files))
+
+
+class AnidbCacheFidIndex(AnidbCacheNoop):
+    """Read-only cache answering lookups from a FidIndex, for offline runs."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def _serve(self, fid, payload, fields):
+        yield ImplicitField('fid'), fid
+        if payload is None:
+            return
+        entity_payloads = {}
+        for (entity, entity_id) in _payload_entity_ids(payload).items():
+            entity_payloads[(entity, entity_id)] = self.index.entity_payload(entity, entity_id) or {}
+        for (f, (raw, _)) in _iter_payload_entries(payload, entity_payloads, fields):
+            yield f, f.filter_value(raw)
+
+    def locally_service_field_values(self, key, fields):
+        if not isinstance(key, FileKeyED2K):
+            return []
+        found = self.index.lookup(key.ed2k, key.size)
+        if found is None:
+            return []
+        return list(self._serve(found[0], found[1], fields))
+
+    def prefetch_file_keys(self, keys, fields):
+        return {k: CachedFileLookup(False, self.locally_service_field_values(k, fields))
+                for k in keys if isinstance(k, FileKeyED2K)}
+
+    def close(self):
+        self.index.close()
@@ -0,0 +1,167 @@
+import sys
+
+from anidbcli.protocol import FileAmaskField, FileRequest, FileKeyFID, MAX_RESPONSE_DATAGRAM_SIZE, FILE_ENTITY_ID_FIELDS, file_field_by_name
+
+# "220 FILE\n" plus the implicit fid column and some slack for multi-byte characters
+# landing on the boundary.
+RESPONSE_HEADER_OVERHEAD = 32
+FIELD_SEPARATOR_SIZE = 1
+SIZE_SAFETY_FACTOR = 1.25
+MAX_FOLLOWUP_REQUESTS = 8
+
+# Starting points for fields we have never seen a response for.
+DEFAULT_FIELD_SIZE = 24
+DEFAULT_FIELD_SIZES = {
+    'aid': 6,
+    'eid': 7,
+    'gid': 6,
+    'lid': 9,
+    'size': 11,
+    'ed2k': 32,
+    'md5': 32,
+    'sha1': 40,
+    'crc32': 8,
+    'filename': 120,
+    'description': 200,
+    'a_romaji': 48,
+    'a_kanji': 48,
+    'a_english': 48,
+    'a_other': 96,
+    'a_short': 32,
+    'a_synonyms': 160,
+    'a_categories': 160,
+    'related_aid_list': 32,
+    'related_aid_type': 16,
+    'ep_english': 48,
+    'ep_romaji': 48,
+    'ep_kanji': 48,
+    'g_name': 32,
+}
+
+
+def _is_shared_field(field):
+    return isinstance(field, FileAmaskField) and field.entity() != 'episode'
+
+
+class FieldSizeStats(object):
+    def __init__(self, samples=0, mean=0.0, max_size=0):
+        self.samples = samples
+        self.mean = mean
+        self.max_size = max_size
+
+    def observe(self, size):
+        self.samples += 1
+        self.mean += (size - self.mean) / self.samples
+        self.max_size = max(self.max_size, size)
+
+    def _repr_fields(self):
+        yield ('samples', self.samples)
+        yield ('mean', self.mean)
+        yield ('max_size', self.max_size)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+class FieldPackingPlanner(object):
+    """Splits a set of FILE fields into requests whose responses fit into one datagram.
+
+    Field sizes are learned from the responses we observe, so the packing gets tighter
+    the longer a cache has been in use.  Fields that come back truncated are requested
+    again in a follow-up request.
+    """
+
+    def __init__(self, stats=None, *, capacity=MAX_RESPONSE_DATAGRAM_SIZE):
+        self._stats = {}
+        self._capacity = capacity - RESPONSE_HEADER_OVERHEAD
+        for (name, (samples, mean, max_size)) in (stats or {}).items():
+            self._stats[name] = FieldSizeStats(samples, mean, max_size)
+
+    def stats(self):
+        return {name: (s.samples, s.mean, s.max_size) for (name, s) in self._stats.items()}
+
+    def estimate(self, field):
+        stats = self._stats.get(field.short_code())
+        if stats is None or not stats.samples:
+            return DEFAULT_FIELD_SIZES.get(field.name, DEFAULT_FIELD_SIZE)
+        # lean towards the worst case we've seen; an extra request is much cheaper
+        # than a truncated response followed by a retry.
+        return max(stats.mean * SIZE_SAFETY_FACTOR, (stats.mean + stats.max_size) / 2)
+
+    def observe(self, req, res):
+        if res.decoded is None or not res.body:
+            return
+        for (f, v) in res.iter_raw_kv(req, suppress_truncation_error=True):
+            self._observe_size(f, len(v.encode('utf-8')))
+        tail = res.truncated_tail(req)
+        if tail is not None:
+            # only a lower bound, but it's what lets an oversized field end up in a
+            # request of its own.
+            (f, partial) = tail
+            self._observe_size(f, len(partial.encode('utf-8')))
+
+    def _observe_size(self, field, size):
+        self._stats.setdefault(field.short_code(), FieldSizeStats()).observe(size)
+
+    def plan(self, fields):
+        """Returns a list of field lists, each expected to fit in a single response."""
+        bins = []
+        # anime and group fields go last: if the fields need several requests, the
+        # follow-ups can often be answered from the cache once aid/gid are known.
+        by_size = sorted(fields, key=lambda f: (_is_shared_field(f), -self.estimate(f)))
+        for f in by_size:
+            cost = self.estimate(f) + FIELD_SEPARATOR_SIZE
+            for b in bins:
+                if b[0] + cost <= self._capacity:
+                    b[0] += cost
+                    b[1].append(f)
+                    break
+            else:
+                bins.append([cost, [f]])
+        # responses come back in mask order, so the request must list them that way too.
+        return [sorted(fs, key=lambda f: f.to_sort_tuple()) for (_, fs) in bins]
+
+    def build_request(self, key, fields):
+        """Returns the first FileRequest for fields, with the rest deferred to follow-ups.
+
+        Looking a file up by ed2k, the first request only asks for fmask fields,
+        among them the aid/eid/gid the amask fields belong to.  The amask fields
+        follow by fid, so the ones of an anime, episode or group already in the
+        cache are filled in from there and only the rest is requested.
+        """
+        if isinstance(key, FileKeyFID):
+            # a follow-up or refresh: what the cache could fill in, it already has
+            (file_fields, entity_fields) = (list(fields), [])
+        else:
+            file_fields = [f for f in fields if not isinstance(f, FileAmaskField)]
+            entity_fields = [f for f in fields if isinstance(f, FileAmaskField)]
+        for entity in sorted({f.entity() for f in entity_fields}):
+            id_field = file_field_by_name(FILE_ENTITY_ID_FIELDS[entity])
+            if id_field not in file_fields:
+                file_fields.append(id_field)
+        packs = self.plan(file_fields)
+        if not packs:
+            return FileRequest(key=key, fields=[], planner=self)
+        deferred = [f for pack in packs[1:] for f in pack] + entity_fields
+        return FileRequest(key=key, fields=packs[0], deferred_fields=deferred, planner=self)
+
+    def next_request(self, req, res):
+        if res.decoded is None:
+            return None
+        missing = [f for f in req.fields if f.name not in res.decoded]
+        if len(req.fields) == 1 and missing:
+            # a lone field that doesn't fit in a datagram will never come back whole.
+            print(f"giving up on truncated field {missing[0].short_code()}", file=sys.stderr)
+            missing = []
+        elif missing:
+            print("re-requesting truncated fields: {}".format(
+                ', '.join(f.short_code() for f in missing)), file=sys.stderr)
+        remaining = missing + list(req.deferred_fields)
+        if not remaining:
+            return None
+        key = req.key
+        fid = res.decoded.get('fid')
+        if fid is not None:
+            key = FileKeyFID(fid)
+        return self.build_request(key, remaining)
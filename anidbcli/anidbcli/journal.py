@@ -0,0 +1,191 @@
+import json
+import os
+import threading
+from collections import namedtuple
+
+from anidbcli.anidbconnector import get_persistence_base_path
+from anidbcli.operations import Operation
+
+# Each line of a journal is {"path": ..., "stages": {stage: {values}}}, the stages a
+# file went through since the last line about it.  Appending a line is all a
+# stage costs; compact() folds the lines of each file into one.
+STAGE_HASHED = 'hashed'
+STAGE_MYLISTED = 'mylisted'
+STAGE_LOOKED_UP = 'looked_up'
+STAGE_RENAMED = 'renamed'
+# stages that needn't be done again once done; a lookup's answer isn't journaled
+# (and served from the cache anyway), so lookups always run
+SKIPPABLE_STAGES = (STAGE_HASHED, STAGE_MYLISTED, STAGE_RENAMED)
+# lines appended between fsyncs; a crash in between loses at most these, whose files are just redone
+JOURNAL_SYNC_EVERY = 64
+# compact once the journal holds this many more lines than files
+JOURNAL_COMPACT_SLACK = 10000
+
+
+def get_journal_path():
+    return os.path.join(get_persistence_base_path(), "run-journal.jsonl")
+
+
+class JournalEntry(namedtuple('_JournalEntry', ['path', 'stages'])):
+    """What was done to the file at path, by stage."""
+
+    def is_current(self):
+        """Whether the file is still the one that was hashed, i.e. still there with the same size and mtime."""
+        hashed = self.stages.get(STAGE_HASHED)
+        if hashed is None:
+            return False
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size == hashed['size'] and st.st_mtime_ns == hashed['mtime']
+
+
+class RunJournal(object):
+    """Append-only record of the stages completed for each file of an api run.
+
+    With resume, the stages recorded by an earlier run are loaded (and the journal
+    compacted); otherwise the journal starts out empty.
+    """
+
+    def __init__(self, path, *, resume=False):
+        self.path = path
+        self.entries = {}
+        # mylist adds record their stage from a thread of their own
+        self._lock = threading.RLock()
+        self._lines = 0
+        self._unsynced = 0
+        if resume and os.path.exists(path):
+            self._load()
+            self.compact()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w'):
+                pass
+        self._fh = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the line being written when the last run died
+                    continue
+                self._merge(record['path'], record['stages'])
+
+    def _merge(self, path, stages):
+        entry = self.entries.get(path)
+        if entry is None or STAGE_HASHED in stages:
+            # hashed again, so whatever was done before was done to an older version of the file
+            entry = self.entries[path] = JournalEntry(path, {})
+        entry.stages.update(stages)
+        if STAGE_RENAMED in stages:
+            target = os.path.abspath(stages[STAGE_RENAMED]['to'])
+            # a renamed file is only found at its new path; links leave the original in place
+            if target != path and not os.path.exists(path):
+                del self.entries[path]
+                self.entries[target] = JournalEntry(target, entry.stages)
+
+    def completed(self, path):
+        """Stages completed for the file at path, empty if it changed since."""
+        with self._lock:
+            entry = self.entries.get(os.path.abspath(path))
+            if entry is None or not entry.is_current():
+                return {}
+            return dict(entry.stages)
+
+    def finished(self, path, stages):
+        """Whether all of stages were completed for the file at path."""
+        completed = self.completed(path)
+        return all(stage in completed for stage in stages)
+
+    def record(self, path, stage, **values):
+        with self._lock:
+            self._merge(path, {stage: values})
+            self._fh.write(json.dumps({'path': path, 'stages': {stage: values}}) + '\n')
+            self._fh.flush()
+            self._lines += 1
+            self._unsynced += 1
+            if JOURNAL_SYNC_EVERY <= self._unsynced:
+                self.sync()
+            if len(self.entries) + JOURNAL_COMPACT_SLACK <= self._lines:
+                self.compact()
+
+    def sync(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+
+    def compact(self):
+        """Rewrites the journal with one line per file, dropping files that are gone or changed."""
+        with self._lock:
+            fh = getattr(self, '_fh', None)
+            if fh is not None:
+                fh.close()
+            self.entries = {p: e for (p, e) in self.entries.items() if e.is_current()}
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as out:
+                for entry in self.entries.values():
+                    out.write(json.dumps({'path': entry.path, 'stages': entry.stages}) + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+            self._lines = len(self.entries)
+            self._unsynced = 0
+            if fh is not None:
+                self._fh = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._fh.close()
+
+    def _repr_fields(self):
+        yield ('path', self.path)
+        yield ('files', len(self.entries))
+        yield ('lines', self._lines)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+class JournaledOperation(Operation):
+    """Records a stage in the journal once the operation did it for a file.
+
+    With skip, a stage the journal has as completed isn't done again: hashing
+    restores ed2k and size from the journal, mylist adds and renames are just
+    skipped.  Lookups always run again, the cache answers them without any
+    request.  Renaming has to be the last stage, as it changes file_path.
+    """
+
+    def __init__(self, operation, journal, stage, *, skip=False):
+        self.operation = operation
+        self.journal = journal
+        self.stage = stage
+        self.skip = skip
+
+    def __call__(self, file):
+        path = os.path.abspath(file["file_path"])
+        done = self.journal.completed(path).get(self.stage) if self.skip and self.stage in SKIPPABLE_STAGES else None
+        if done is not None:
+            if self.stage == STAGE_HASHED:
+                file['ed2k'] = done['ed2k']
+                file['size'] = done['size']
+            return True
+        res = self.operation(file)
+        # mylist adds let the pipeline go on when they fail, file["mylisted"] tells
+        if res and (self.stage != STAGE_MYLISTED or file.get("mylisted")):
+            self.journal.record(path, self.stage, **self._values(path, file))
+        return res
+
+    def _values(self, path, file):
+        if self.stage == STAGE_HASHED:
+            return {'ed2k': file['ed2k'], 'size': file['size'], 'mtime': os.stat(path).st_mtime_ns}
+        if self.stage == STAGE_LOOKED_UP:
+            return {'fid': file.get('info', {}).get('fid')}
+        if self.stage == STAGE_RENAMED:
+            return {'to': file['file_path']}
+        return {}
+
@@ -0,0 +1,369 @@
+import dbm
+import glob
+import os
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from anidbcli.anidbconnector import (
+    AnidbCacheLru, CACHE_FLUSH_EVERY_FILES, CACHE_FLUSH_INTERVAL_SECONDS, FILE_IDENTIFIER_TTL, MYLIST_ENTRY_TTL, NEGATIVE_CACHE_FIRST_RETRY, NEGATIVE_CACHE_MAX_RETRY, NEGATIVE_CACHE_TTL, OBJECT_TYPE_FILE, SWEEP_INTERVAL, CachedFileLookup, ImplicitField,
+    _add_stale_fields, _entity_ids, _iter_payload_entries, _locked, _payload_entity_ids, _split_by_object, _stale_fields_by_fid, get_persistence_base_path)
+from anidbcli.cachepolicy import FieldTtlPolicy
+from anidbcli.protocol import FileAmaskField, FileFmaskField, FileKeyED2K, FileKeyFID, FileRequest, MylistEntry, file_field_by_name
+
+# Keys are a one byte record kind followed by the packed key:
+#   f + file key          -> FILE_RECORD
+#   n + file key          -> NEGATIVE_RECORD
+#   o + type + object id  -> OBJECT_HEADER, then per field FIELD_ENTRY + raw value (utf-8)
+#   m + lid               -> MYLIST_RECORD + file key
+#   M + file key          -> lid (LID)
+#   s + field name        -> FIELD_SIZE_RECORD
+#   S + state name        -> STATE
+# where a file key is the ed2k hash (16 bytes, or the text for anything that isn't
+# a hex digest) and the size (8 bytes); all integers are big-endian.
+FILE_RECORD = struct.Struct('>IQ')  # fid, expiration
+NEGATIVE_RECORD = struct.Struct('>IQQQ')  # failure count, failed on, synthesize failure until, expiration
+OBJECT_HEADER = struct.Struct('>QQ')  # expiration, updated
+FIELD_ENTRY = struct.Struct('>BQI')  # field code, fetched at, value length
+MYLIST_RECORD = struct.Struct('>qIIQ')  # fid (-1 if unknown), state, viewed, updated
+LID = struct.Struct('>I')
+FIELD_SIZE_RECORD = struct.Struct('>IdI')  # samples, mean size, max size
+STATE = struct.Struct('>q')
+
+KV_CACHE_FILE_NAME = "cache.kv"
+
+OBJECT_TYPES = (OBJECT_TYPE_FILE, 'anime', 'episode', 'group')
+# field codes: amask flag, then the byte and bit of the field in its mask
+AMASK_CODE_FLAG = 0x80
+
+
+class KvCacheError(Exception):
+    pass
+
+
+def _lock_exclusively(path):
+    """Opens and locks the file at path for as long as it's open.
+
+    dbm.dumb (what dbm falls back to without gdbm and ndbm) locks nothing and keeps
+    its index in memory until it's synced, so two processes writing to the same
+    store lose each other's writes.
+    """
+    fh = open(path, 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            raise KvCacheError(f"{path} is locked, another anidbcli is using the cache")
+    return fh
+
+
+def _field_code(field):
+    code = field.byte << 3 | field.bit
+    return code | AMASK_CODE_FLAG if isinstance(field, FileAmaskField) else code
+
+
+def _field_by_code(code):
+    cls = FileAmaskField if code & AMASK_CODE_FLAG else FileFmaskField
+    return cls.BIT_POSITION_LOOKUP.get(((code & ~AMASK_CODE_FLAG) >> 3, code & 7))
+
+
+def _file_key(ed2k, size):
+    try:
+        packed = bytes.fromhex(ed2k) if len(ed2k) == 32 else None
+    except ValueError:
+        packed = None
+    if packed is None:
+        packed = ed2k.encode('utf-8')
+    return packed + size.to_bytes(8, 'big')
+
+
+def _object_key(object_type, object_id):
+    return b'o' + bytes([OBJECT_TYPES.index(object_type)]) + object_id.to_bytes(4, 'big')
+
+
+def _pack_object(payload, expiration, updated):
+    parts = [OBJECT_HEADER.pack(expiration, updated)]
+    for (name, (raw, fetched)) in payload.items():
+        value = raw.encode('utf-8')
+        parts.append(FIELD_ENTRY.pack(_field_code(file_field_by_name(name)), fetched, len(value)))
+        parts.append(value)
+    return b''.join(parts)
+
+
+def _unpack_object(data):
+    """Returns ({field name: [raw value, fetched at]}, expiration, updated)."""
+    (expiration, updated) = OBJECT_HEADER.unpack_from(data, 0)
+    payload = {}
+    offset = OBJECT_HEADER.size
+    while offset < len(data):
+        (code, fetched, length) = FIELD_ENTRY.unpack_from(data, offset)
+        offset += FIELD_ENTRY.size
+        field = _field_by_code(code)
+        if field is not None:
+            payload[field.name] = [data[offset:offset + length].decode('utf-8'), fetched]
+        offset += length
+    return (payload, expiration, updated)
+
+
+class AnidbCacheKv(object):
+    """Cache on an embedded key-value store (the best dbm the platform has), without
+    SQLAlchemy.
+
+    Records are binary-packed, and every lookup is a handful of key reads with no
+    query to build.  Serves the same lookups as AnidbCacheSqlAlchemy, but the
+    database tools (query, cache export, build-index and so on) only work on the
+    SQLite cache, and max_size isn't enforced.  Only one process at a time can
+    have it open, and writes are synced to disk every flush_every writes or after
+    flush_interval seconds.
+    """
+
+    def __init__(self, path, *, ttl_policy=None, flush_every=CACHE_FLUSH_EVERY_FILES, flush_interval=CACHE_FLUSH_INTERVAL_SECONDS):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock_file = _lock_exclusively(path + '.lock')
+        try:
+            self._db = dbm.open(path, 'c')
+        except BaseException:
+            self._lock_file.close()
+            raise
+        self._unsynced_writes = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.RLock()
+        self.ttl_policy = ttl_policy or FieldTtlPolicy()
+        self.max_size = None
+        self._stale = {}
+
+    def _after_write(self):
+        self._unsynced_writes += 1
+        if self.flush_every <= self._unsynced_writes or self._last_sync + self.flush_interval <= time.monotonic():
+            self.flush()
+
+    def _get_object(self, object_type, object_id):
+        data = self._db.get(_object_key(object_type, object_id))
+        return _unpack_object(data)[0] if data is not None else None
+
+    def _merge_object(self, object_type, object_id, values, now):
+        key = _object_key(object_type, object_id)
+        data = self._db.get(key)
+        payload = _unpack_object(data)[0] if data is not None else {}
+        payload.update(values)
+        self._db[key] = _pack_object(payload, self.ttl_policy.expiration(payload), int(now.timestamp()))
+
+    def _file_lookup(self, key, fields, now, raw):
+        file_key = _file_key(key.ed2k, key.size)
+        negative = self._db.get(b'n' + file_key)
+        if negative is not None and now <= NEGATIVE_RECORD.unpack(negative)[2]:
+            return CachedFileLookup(True, [])
+        data = self._db.get(b'f' + file_key)
+        if data is None:
+            return CachedFileLookup(False, [])
+        return CachedFileLookup(False, list(self._serve_file(FILE_RECORD.unpack(data)[0], fields, now, raw)))
+
+    def _serve_file(self, fid, fields, now, raw):
+        yield ImplicitField('fid'), fid
+        payload = self._get_object(OBJECT_TYPE_FILE, fid)
+        if payload is None:
+            return
+        entity_payloads = {}
+        if any(isinstance(f, FileAmaskField) for f in fields):
+            for (entity, entity_id) in _payload_entity_ids(payload).items():
+                entity_payloads[(entity, entity_id)] = self._get_object(entity, entity_id) or {}
+        stale = []
+        for (f, (value, fetched)) in _iter_payload_entries(payload, entity_payloads, fields):
+            if self.ttl_policy.is_stale(f, fetched, now):
+                stale.append(f)
+            yield f, (value if raw else f.filter_value(value))
+        if stale:
+            _add_stale_fields(self._stale, fid, stale, _payload_entity_ids(payload))
+
+    @_locked
+    def check_negative_cache(self, req):
+        key = None
+        if isinstance(req, FileRequest) and isinstance(req.key, FileKeyED2K):
+            key = req.key
+        elif isinstance(req, dict) and req.get('ed2k') is not None and req.get('size') is not None:
+            key = FileKeyED2K(req['ed2k'], req['size'])
+        if key is None:
+            return False
+        data = self._db.get(b'n' + _file_key(key.ed2k, key.size))
+        return data is not None and datetime.now().timestamp() <= NEGATIVE_RECORD.unpack(data)[2]
+
+    @_locked
+    def _inject_negative_cache_record(self, req):
+        if not (hasattr(req, 'key') and isinstance(req.key, FileKeyED2K)):
+            print(f"want to insert negative cache record for {req!r}, but type is not understood", file=sys.stderr)
+            return
+        now = int(datetime.now().timestamp())
+        key = b'n' + _file_key(req.key.ed2k, req.key.size)
+        data = self._db.get(key)
+        (failure_count, failed_on, until) = (1, now, now + int(NEGATIVE_CACHE_FIRST_RETRY.total_seconds()))
+        if data is not None:
+            (failure_count, failed_on) = NEGATIVE_RECORD.unpack(data)[:2]
+            until = now + int(min(NEGATIVE_CACHE_MAX_RETRY, NEGATIVE_CACHE_FIRST_RETRY * (failure_count + 1)).total_seconds())
+            failure_count += 1
+        self._db[key] = NEGATIVE_RECORD.pack(failure_count, failed_on, until, now + int(NEGATIVE_CACHE_TTL.total_seconds()))
+        self._after_write()
+
+    @_locked
+    def inject_cache(self, req, res):
+        if isinstance(req, FileRequest):
+            values = dict(res.iter_raw_kv(req, suppress_truncation_error=True))
+            self.inject_file_values(req.key, res.decoded['fid'], values)
+
+    @_locked
+    def inject_file_values(self, key, fid, values):
+        """Stores {field: raw value} of a file as received from AniDB, keyed by ed2k or fid."""
+        now = datetime.now()
+        if isinstance(key, FileKeyED2K):
+            self._db[b'f' + _file_key(key.ed2k, key.size)] = FILE_RECORD.pack(fid, int((now + FILE_IDENTIFIER_TTL).timestamp()))
+        fetched = int(now.timestamp())
+        entity_ids = _entity_ids({f.name: v for (f, v) in values.items()})
+        for (object_type, updates) in _split_by_object(fid, {f: [v, fetched] for (f, v) in values.items()}, entity_ids).items():
+            for (object_id, object_values) in updates.items():
+                self._merge_object(object_type, object_id, object_values, now)
+        self._after_write()
+
+    @_locked
+    def locally_service_field_values(self, key, fields, *, raw=False):
+        now = int(datetime.now().timestamp())
+        if isinstance(key, FileKeyED2K):
+            lookup = self._file_lookup(key, fields, now, raw)
+            return [] if lookup.negative else lookup.values
+        if isinstance(key, FileKeyFID):
+            return list(self._serve_file(key.fid, fields, now, raw))
+        return []
+
+    @_locked
+    def prefetch_file_keys(self, keys, fields, *, raw=False):
+        now = int(datetime.now().timestamp())
+        return {k: self._file_lookup(k, fields, now, raw) for k in keys if isinstance(k, FileKeyED2K)}
+
+    @_locked
+    def take_stale_fields(self):
+        (stale, self._stale) = (self._stale, {})
+        return _stale_fields_by_fid(stale)
+
+    @_locked
+    def load_field_size_stats(self):
+        out = {}
+        for key in self._db.keys():
+            if key.startswith(b's'):
+                out[key[1:].decode('utf-8')] = FIELD_SIZE_RECORD.unpack(self._db[key])
+        return out
+
+    @_locked
+    def store_field_size_stats(self, stats):
+        for (field, (samples, mean_size, max_size)) in stats.items():
+            self._db[b's' + field.encode('utf-8')] = FIELD_SIZE_RECORD.pack(samples, mean_size, max_size)
+        self._after_write()
+
+    @_locked
+    def lookup_mylist_entry(self, key):
+        if not isinstance(key, FileKeyED2K):
+            return None
+        lid = self._db.get(b'M' + _file_key(key.ed2k, key.size))
+        data = self._db.get(b'm' + lid) if lid is not None else None
+        if data is None:
+            return None
+        (fid, state, viewed, updated) = MYLIST_RECORD.unpack_from(data, 0)
+        if updated < (datetime.now() - MYLIST_ENTRY_TTL).timestamp():
+            return None
+        return MylistEntry(LID.unpack(lid)[0], fid if fid >= 0 else None, state, viewed, datetime.fromtimestamp(updated))
+
+    @_locked
+    def record_mylist_entry(self, key, *, lid, state, viewed, fid=None):
+        file_key = _file_key(key.ed2k, key.size)
+        old_lid = self._db.get(b'M' + file_key)
+        if fid is None and old_lid == LID.pack(lid):
+            fid = MYLIST_RECORD.unpack_from(self._db[b'm' + old_lid], 0)[0]
+        # like the SQLite cache, a file re-added under a new lid drops the old entry
+        if old_lid is not None and old_lid != LID.pack(lid):
+            self._db.pop(b'm' + old_lid, None)
+        previous = self._db.get(b'm' + LID.pack(lid))
+        if previous is not None and previous[MYLIST_RECORD.size:] != file_key:
+            self._db.pop(b'M' + previous[MYLIST_RECORD.size:], None)
+        self._db[b'm' + LID.pack(lid)] = MYLIST_RECORD.pack(
+            -1 if fid is None or fid < 0 else fid, state, viewed, int(datetime.now().timestamp())) + file_key
+        self._db[b'M' + file_key] = LID.pack(lid)
+        self._after_write()
+
+    @_locked
+    def forget_mylist_entry(self, key):
+        lid = self._db.pop(b'M' + _file_key(key.ed2k, key.size), None)
+        if lid is not None:
+            self._db.pop(b'm' + lid, None)
+        self._after_write()
+
+    @_locked
+    def get_state(self, key, default=None):
+        data = self._db.get(b'S' + key.encode('utf-8'))
+        return default if data is None else STATE.unpack(data)[0]
+
+    @_locked
+    def set_state(self, key, value):
+        self._db[b'S' + key.encode('utf-8')] = STATE.pack(value)
+
+    @_locked
+    def sweep(self):
+        """Drops expired records; returns how many."""
+        now = int(datetime.now().timestamp())
+        expired = []
+        for key in self._db.keys():
+            kind = key[:1]
+            if kind == b'f':
+                expiration = FILE_RECORD.unpack(self._db[key])[1]
+            elif kind == b'n':
+                expiration = NEGATIVE_RECORD.unpack(self._db[key])[3]
+            elif kind == b'o':
+                expiration = OBJECT_HEADER.unpack_from(self._db[key], 0)[0]
+            else:
+                continue
+            if expiration <= now:
+                expired.append(key)
+        for key in expired:
+            del self._db[key]
+        self.set_state('last_sweep', now)
+        return len(expired)
+
+    def used_size(self):
+        return sum(os.path.getsize(p) for p in glob.glob(glob.escape(self.path) + '*'))
+
+    @_locked
+    def flush(self):
+        if hasattr(self._db, 'sync'):
+            self._db.sync()
+        self._unsynced_writes = 0
+        self._last_sync = time.monotonic()
+
+    @_locked
+    def close(self):
+        if self._db is None:
+            return
+        last_sweep = self.get_state('last_sweep')
+        if last_sweep is None or last_sweep + SWEEP_INTERVAL.total_seconds() <= datetime.now().timestamp():
+            self.sweep()
+        self._db.close()
+        self._db = None
+        self._lock_file.close()
+
+    def _repr_fields(self):
+        yield ('path', self.path)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+def open_default_kv_cache():
+    """An AnidbCacheKv in the settings folder, behind an AnidbCacheLru."""
+    os.makedirs(get_persistence_base_path(), exist_ok=True)
+    return AnidbCacheLru(AnidbCacheKv(os.path.join(get_persistence_base_path(), KV_CACHE_FILE_NAME)))
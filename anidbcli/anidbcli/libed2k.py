@@ -1,7 +1,6 @@
 import hashlib
 import functools
 import os
-import multiprocessing
 import binascii
 import ctypes
 import time
@@ -36,7 +35,7 @@ def hash_file(file_path, parallel=None):
         f.seek(0, os.SEEK_END)
         size = f.tell()
         f.seek(0, os.SEEK_SET)
-        cpu_count = multiprocessing.cpu_count()
+        cpu_count = os.cpu_count()
         cpu_count = 1
         if cpu_count == 1 or size < (4 * CHUNK_SIZE):  # a guess, threads have spin-up cost.
             hashes = [md4_hash(i) for i in generator(f)]
@@ -117,7 +116,7 @@ class ED2KPool(object):
         _libed2k = None
 
     def __init__(self, threads=None):
-        self._threadpool = self._libed2k.ed2k_pool_init(multiprocessing.cpu_count())
+        self._threadpool = self._libed2k.ed2k_pool_init(os.cpu_count())
     
     def _check_threadpool(self):
         if self._threadpool is None:
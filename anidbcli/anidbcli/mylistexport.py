@@ -0,0 +1,167 @@
+import csv
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+from anidbcli.template import field_for_tag
+
+# Column names used by the various export templates, mapped to our field names.
+COLUMN_ALIASES = {
+    'fileid': 'fid',
+    'file_id': 'fid',
+    'ed2k_hash': 'ed2k',
+    'ed2khash': 'ed2k',
+    'filesize': 'size',
+    'file_size': 'size',
+    'animeid': 'aid',
+    'anime_id': 'aid',
+    'epid': 'eid',
+    'ep_id': 'eid',
+    'episodeid': 'eid',
+    'episode_id': 'eid',
+    'groupid': 'gid',
+    'group_id': 'gid',
+    'mylistid': 'lid',
+    'mylist_id': 'lid',
+    'mystate': 'mylist_state',
+    'watched': 'viewed',
+    'view_date': 'viewdate',
+    'romaji_name': 'a_romaji',
+    'anime_name_romaji': 'a_romaji',
+    'kanji_name': 'a_kanji',
+    'anime_name_kanji': 'a_kanji',
+    'english_name': 'a_english',
+    'anime_name_english': 'a_english',
+    'synonym_list': 'a_synonyms',
+    'anime_total_episodes': 'ep_total',
+    'highest_episode_number': 'ep_last',
+    'epno': 'ep_no',
+    'episode_number': 'ep_no',
+    'ep_name': 'ep_english',
+    'episode_name': 'ep_english',
+    'ep_romaji_name': 'ep_romaji',
+    'ep_kanji_name': 'ep_kanji',
+    'group_name': 'g_name',
+    'group_short_name': 'g_sname',
+    'video_resolution': 'resolution',
+    'anidb_file_name': 'filename',
+}
+
+EXPORT_DELIMITERS = ',\t|;'
+EXPORT_SUFFIXES = ('.csv', '.tsv', '.txt')
+
+
+class MylistExportError(ValueError):
+    pass
+
+
+class ExportRecord(object):
+    """One file of a mylist export: its identifiers, mylist state and raw field values.
+
+    exported is the unix time the export was made, None if it isn't known.
+    """
+
+    def __init__(self, fid, ed2k, size, fields, lid=None, state=None, viewed=None, exported=None):
+        self.fid = fid
+        self.ed2k = ed2k
+        self.size = size
+        self.fields = fields
+        self.lid = lid
+        self.state = state
+        self.viewed = viewed
+        self.exported = exported
+
+    def _repr_fields(self):
+        yield ('fid', self.fid)
+        yield ('ed2k', self.ed2k)
+        yield ('size', self.size)
+        if self.lid is not None:
+            yield ('lid', self.lid)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
+
+
+def _canonical_column(name):
+    name = name.strip().lower().replace(' ', '_')
+    return COLUMN_ALIASES.get(name, name)
+
+
+def _to_int(value):
+    if value is None or value.strip() in ('', 'none'):
+        return None
+    return int(value)
+
+
+def _iter_text_members(path):
+    """Yields (name, text stream, unix time it was exported) for every export table found at path.
+
+    The time is that of the archive member, which AniDB writes when it makes the
+    export; a bare table only has the time it was saved, so it gets None.
+    """
+    if tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.lower().endswith(EXPORT_SUFFIXES):
+                    yield member.name, io.TextIOWrapper(tar.extractfile(member), encoding='utf-8', newline=''), member.mtime or None
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.filename.lower().endswith(EXPORT_SUFFIXES):
+                    with zf.open(info) as fh:
+                        yield info.filename, io.TextIOWrapper(fh, encoding='utf-8', newline=''), time.mktime(info.date_time + (0, 0, -1))
+    else:
+        with open(path, 'r', encoding='utf-8', newline='') as fh:
+            yield os.path.basename(path), fh, None
+
+
+def _parse_table(name, fh, exported):
+    header = fh.readline()
+    if not header.strip():
+        return
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=EXPORT_DELIMITERS)
+    except csv.Error:
+        raise MylistExportError(f"{name}: cannot determine the column delimiter")
+    columns = [_canonical_column(c) for c in next(csv.reader([header], dialect))]
+    if not {'fid', 'ed2k', 'size'}.issubset(columns):
+        # not a file table (e.g. the anime or group listing of an export)
+        return
+    fields = [(idx, field_for_tag(c)) for (idx, c) in enumerate(columns)]
+    fields = [(idx, f) for (idx, f) in fields if f is not None]
+    reader = csv.reader(fh, dialect)
+    for row in reader:
+        if not row:
+            continue
+        doc = dict(zip(columns, row))
+        try:
+            viewed = _to_int(doc.get('viewed'))
+            if viewed is None and doc.get('viewdate') is not None:
+                viewed = int(_to_int(doc['viewdate']) not in (None, 0))
+            record = ExportRecord(
+                fid=int(doc['fid']),
+                ed2k=doc['ed2k'].lower(),
+                size=int(doc['size']),
+                fields={f: row[idx] for (idx, f) in fields if idx < len(row)},
+                lid=_to_int(doc.get('lid')),
+                state=_to_int(doc.get('mylist_state', doc.get('state'))),
+                viewed=viewed,
+                exported=exported)
+        except (KeyError, ValueError) as e:
+            # line_num leaves out the header, read before the reader was made
+            raise MylistExportError(f"{name}, line {reader.line_num + 1}: {e}")
+        yield record
+
+
+def iter_export_records(path):
+    """Parses a mylist export (a .tgz/.zip archive or a single table) at path.
+
+    Delimited text templates with a header row are understood; columns are matched
+    to FILE field names (or their old names, see COLUMN_ALIASES) and tables without
+    fid, ed2k and size columns are skipped.
+    """
+    for (name, fh, exported) in _iter_text_members(path):
+        yield from _parse_table(name, fh, exported)
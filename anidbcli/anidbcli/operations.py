@@ -8,10 +8,15 @@ import glob
 import errno
 import time
 import shutil
+import threading
 import traceback
+import queue
+from collections import OrderedDict
 
 import anidbcli.libed2k as libed2k 
-from anidbcli.protocol import parse_data, FileAmaskField, FileFmaskField, FileRequest, AnidbResponse
+from anidbcli.fieldplanner import FieldPackingPlanner, MAX_FOLLOWUP_REQUESTS
+from anidbcli.protocol import parse_data, FileAmaskField, FileFmaskField, FileKeyED2K, AnidbResponse, MylistEntry, FILE_ENTITY_ID_FIELDS, file_field_by_name
+from anidbcli.template import RenameTemplate, TemplateEmptyTagError
 
 API_ENDPOINT_MYLYST_ADD = "MYLISTADD size=%d&ed2k=%s&viewed=%d&state=%s"
 API_ENDPOINT_MYLYST_EDIT = "MYLISTADD size=%d&ed2k=%s&edit=1&viewed=%d&state=%s"
@@ -19,6 +24,11 @@ API_ENDPOINT_MYLYST_EDIT = "MYLISTADD size=%d&ed2k=%s&edit=1&viewed=%d&state=%s"
 RESULT_MYLIST_ENTRY_ADDED = 210
 RESULT_MYLIST_ENTRY_EDITED = 311
 RESULT_ALREADY_IN_MYLIST = 310
+RESULT_NO_SUCH_MYLIST_ENTRY = 411
+
+# files whose info GetFileInfoOperation keeps for other paths of the same file;
+# copies and hardlinks are usually walked close together
+ANSWERED_MAX_ENTRIES = 256
 
 
 def IsNullOrWhitespace(s):
@@ -32,34 +42,134 @@ class Operation:
 
 
 class MylistAddOperation(Operation):
+    """Adds a file to mylist, or updates its state and viewed flag there.
+
+    Returns True either way, so the rest of the pipeline goes on; file["mylisted"]
+    is set only once the entry is in mylist as asked.
+    """
+
     def __init__(self, connector, output, state, unwatched):
         self.connector = connector
         self.output = output
         self.state = state 
+        # local mirror of our mylist, lets re-runs skip entries that are already up to date
+        self.mylist = getattr(connector, 'cache', None)
         if unwatched:
             self.viewed = 0
         else:
             self.viewed = 1
 
     def __call__(self, file):
+        key = FileKeyED2K(file["ed2k"], file["size"])
         try:
-            res = self.connector.send_request(API_ENDPOINT_MYLYST_ADD % (file["size"], file["ed2k"], self.viewed, int(self.state)))
-            if res.code == RESULT_MYLIST_ENTRY_ADDED:
-                self.output.success("Mylist entry added.")
-            elif res.code == RESULT_ALREADY_IN_MYLIST:
-                self.output.warning("Already in mylist.")
-                res = self.connector.send_request(API_ENDPOINT_MYLYST_EDIT % (file["size"], file["ed2k"], self.viewed, int(self.state)))
-                if res.code == RESULT_MYLIST_ENTRY_EDITED:
-                    self.output.success("Mylist entry state updated.")
+            entry = None
+            if self.mylist is not None:
+                entry = self.mylist.lookup_mylist_entry(key)
+            if entry is not None and entry.state == int(self.state) and entry.viewed == self.viewed:
+                self.output.success("Mylist entry already up to date (cached).")
+                file["mylisted"] = True
+                return True
+            if entry is None:
+                res = self.connector.send_request(API_ENDPOINT_MYLYST_ADD % (file["size"], file["ed2k"], self.viewed, int(self.state)))
+                if res.code == RESULT_MYLIST_ENTRY_ADDED:
+                    self.output.success("Mylist entry added.")
+                    lid = _parse_lid(res.body)
+                    if lid is not None:
+                        self._record(key, lid=lid, fid=None)
+                    file["mylisted"] = True
+                    return True
+                elif res.code == RESULT_ALREADY_IN_MYLIST:
+                    self.output.warning("Already in mylist.")
+                    entry = self._record_existing(key, res.body)
+                    if entry is not None and entry.state == int(self.state) and entry.viewed == self.viewed:
+                        self.output.success("Mylist entry already up to date.")
+                        file["mylisted"] = True
+                        return True
                 else:
-                    self.output.warning("Could not mark as watched.")
+                    self.output.error("Couldn't add to mylist: %s" % res["data"])
+                    return True
+            res = self.connector.send_request(API_ENDPOINT_MYLYST_EDIT % (file["size"], file["ed2k"], self.viewed, int(self.state)))
+            if res.code == RESULT_MYLIST_ENTRY_EDITED:
+                self.output.success("Mylist entry state updated.")
+                if entry is not None:
+                    self._record(key, lid=entry.lid, fid=entry.fid)
+                file["mylisted"] = True
             else:
-                self.output.error("Couldn't add to mylist: %s" % res["data"])
+                if res.code == RESULT_NO_SUCH_MYLIST_ENTRY and self.mylist is not None:
+                    self.mylist.forget_mylist_entry(key)
+                self.output.warning("Could not mark as watched.")
         except Exception as e:
             self.output.error("Failed to add file to mylist: " + str(e))
 
         return True
 
+    def _record(self, key, *, lid, fid):
+        if self.mylist is not None:
+            self.mylist.record_mylist_entry(key, lid=lid, fid=fid, state=int(self.state), viewed=self.viewed)
+
+    def _record_existing(self, key, body):
+        """Records the entry described by a 310 FILE ALREADY IN MYLIST response."""
+        try:
+            (lid, fid, _eid, _aid, _gid, _date, state, viewdate, *_rest) = body.split("|")
+            entry = MylistEntry(int(lid), int(fid), int(state), int(int(viewdate) != 0), None)
+        except (AttributeError, ValueError):
+            return None
+        if self.mylist is not None:
+            self.mylist.record_mylist_entry(key, lid=entry.lid, fid=entry.fid, state=entry.state, viewed=entry.viewed)
+        return entry
+
+
+def _parse_lid(body):
+    """The lid of a 210 MYLIST ENTRY ADDED response, None if it came without one."""
+    try:
+        return int(body.split("|", 1)[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+class DeferredOperation(Operation):
+    """Runs an operation on a thread of its own, so the pipeline doesn't wait for it.
+
+    Meant for work nothing later in the pipeline depends on, like mylist adds:
+    their requests have a lower priority than lookups, so they get the slots
+    of the rate limit the pipeline leaves idle, e.g. while it hashes the next
+    file.  Files are handled in the order they come in; close() waits for all
+    of them.  on_done(file, result) is called on that thread after each file the
+    operation didn't raise on, e.g. to do what has to wait for its outcome.
+    """
+
+    def __init__(self, operation, on_done=None):
+        self.operation = operation
+        self.on_done = on_done
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def __call__(self, file):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="anidbcli-deferred", daemon=True)
+            self._thread.start()
+        self._queue.put(dict(file))
+        return True
+
+    def _run(self):
+        while True:
+            file = self._queue.get()
+            if file is None:
+                return
+            try:
+                res = self.operation(file)
+            except Exception as e:
+                print(f"deferred {self.operation!r} failed on {file!r}: {e}", file=sys.stderr)
+                continue
+            if self.on_done is not None:
+                self.on_done(file, res)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
 
 def hash_operation_factory(output, show_ed2k):
     def hash_operation(file):
@@ -86,60 +196,81 @@ class HashOperation(Operation):
         return self._callable(file)
 
 
+DEFAULT_FILE_INFO_FIELDS = [
+    FileFmaskField.f.aid,
+    FileFmaskField.f.eid,
+    FileFmaskField.f.gid,
+    FileFmaskField.f.lid,
+    # FileFmaskField.f.file_state,
+    FileFmaskField.f.size,
+    FileFmaskField.f.ed2k,
+    FileFmaskField.f.md5,
+    FileFmaskField.f.sha1,
+    FileFmaskField.f.crc32,
+    FileFmaskField.f.color_depth,
+    FileFmaskField.f.quality,
+    FileFmaskField.f.source,
+    FileFmaskField.f.audio_codec,
+    FileFmaskField.f.audio_bitrate,
+    FileFmaskField.f.video_codec,
+    FileFmaskField.f.video_bitrate,
+    FileFmaskField.f.resolution,
+    FileFmaskField.f.filetype,
+    FileFmaskField.f.dub_language,
+    FileFmaskField.f.sub_language,
+    FileFmaskField.f.length,
+    FileFmaskField.f.aired,
+    FileFmaskField.f.filename,
+    FileAmaskField.f.ep_total,
+    FileAmaskField.f.ep_last,
+    FileAmaskField.f.year,
+    FileAmaskField.f.a_type,
+    FileAmaskField.f.a_romaji,
+    FileAmaskField.f.a_kanji,
+    FileAmaskField.f.a_english,
+    FileAmaskField.f.a_other,
+    FileAmaskField.f.a_short,
+    FileAmaskField.f.a_synonyms,
+    FileAmaskField.f.ep_no,
+    FileAmaskField.f.ep_english,
+    FileAmaskField.f.ep_romaji,
+    FileAmaskField.f.ep_kanji,
+    FileAmaskField.f.g_name,
+    FileAmaskField.f.g_sname,
+]
+
+
 class GetFileInfoOperation(Operation):
-    def __init__(self, connector, output):
+    def __init__(self, connector, output, fields=None, *, remember_results=True, max_remembered=ANSWERED_MAX_ENTRIES):
         self.connector = connector
         self.output = output
+        # file info by FileKeyED2K, least recently used first, so another path of a
+        # file already looked up in this run (a copy or hardlink) doesn't cost
+        # another request
+        self.answered = OrderedDict() if remember_results else None
+        self.max_remembered = max_remembered
+        self.fields = list(fields) if fields is not None else list(DEFAULT_FILE_INFO_FIELDS)
+        # always ask for aid/eid/gid, so the cache can share anime/episode/group data across files
+        for name in FILE_ENTITY_ID_FIELDS.values():
+            field = file_field_by_name(name)
+            if field not in self.fields:
+                self.fields.append(field)
+        self.planner = getattr(connector, 'field_planner', None) or FieldPackingPlanner()
 
     def __call__(self, file):
         ed2k = file['ed2k']
         size = file['size']
-        
-        request = FileRequest(size=size, ed2k=ed2k, fields=[
-            FileFmaskField.f.aid,
-            FileFmaskField.f.eid,
-            FileFmaskField.f.gid,
-            FileFmaskField.f.lid,
-            # FileFmaskField.f.file_state,
-            FileFmaskField.f.size,
-            FileFmaskField.f.ed2k,
-            FileFmaskField.f.md5,
-            FileFmaskField.f.sha1,
-            FileFmaskField.f.crc32,
-            FileFmaskField.f.color_depth,
-            FileFmaskField.f.quality,
-            FileFmaskField.f.source,
-            FileFmaskField.f.audio_codec,
-            FileFmaskField.f.audio_bitrate,
-            FileFmaskField.f.video_codec,
-            FileFmaskField.f.video_bitrate,
-            FileFmaskField.f.resolution,
-            FileFmaskField.f.filetype,
-            FileFmaskField.f.dub_language,
-            FileFmaskField.f.sub_language,
-            FileFmaskField.f.length,
-            FileFmaskField.f.aired,
-            FileFmaskField.f.filename,
-            FileAmaskField.f.ep_total,
-            FileAmaskField.f.ep_last,
-            FileAmaskField.f.year,
-            FileAmaskField.f.a_type,
-            FileAmaskField.f.a_romaji,
-            FileAmaskField.f.a_kanji,
-            FileAmaskField.f.a_english,
-            FileAmaskField.f.a_other,
-            FileAmaskField.f.a_short,
-            FileAmaskField.f.a_synonyms,
-            FileAmaskField.f.ep_no,
-            FileAmaskField.f.ep_english,
-            FileAmaskField.f.ep_romaji,
-            FileAmaskField.f.ep_kanji,
-            FileAmaskField.f.g_name,
-            FileAmaskField.f.g_sname,
-        ])
+        key = FileKeyED2K(ed2k, size)
+        if self.answered is not None and key in self.answered:
+            self.answered.move_to_end(key)
+            file["info"] = dict(self.answered[key])
+            self.output.success("Reused the file info of an identical file.")
+            return True
+
+        request = self.planner.build_request(key, self.fields)
 
         fileinfo = {}
-        request_split_max = 2
+        request_split_max = 1 + MAX_FOLLOWUP_REQUESTS
         while 0 < request_split_max and request:
             request_split_max -= 1
             if not request:
@@ -169,12 +300,16 @@ class GetFileInfoOperation(Operation):
         # if status & 64: fileinfo["censored"] = "uncensored"
         # if status & 128: fileinfo["censored"] = "censored"
 
-        if IsNullOrWhitespace(fileinfo["ep_english"]):
+        if IsNullOrWhitespace(fileinfo.get("ep_english")) and "ep_romaji" in fileinfo:
             fileinfo["ep_english"] = fileinfo["ep_romaji"]
-        if IsNullOrWhitespace(fileinfo["a_english"]):
+        if IsNullOrWhitespace(fileinfo.get("a_english")) and "a_romaji" in fileinfo:
             fileinfo["a_english"] = fileinfo["a_romaji"]
 
         file["info"] = construct_helper_tags(fileinfo)
+        if self.answered is not None:
+            self.answered[key] = dict(file["info"])
+            while self.max_remembered < len(self.answered):
+                self.answered.popitem(last=False)
         self.output.success("Successfully grabbed file info.")
         return True
 
@@ -182,30 +317,36 @@ class GetFileInfoOperation(Operation):
 class RenameOperation(Operation):
     def __init__(self, output, target_path, date_format, delete_empty, keep_structure, soft_link, hard_link, abort):
         self.output = output
-        self.target_path = target_path
+        if not isinstance(target_path, RenameTemplate):
+            target_path = RenameTemplate.compile(target_path)
+        self.template = target_path
         self.date_format = date_format
         self.delete_empty = delete_empty
         self.keep_structure = keep_structure
         self.soft_link = soft_link
         self.hard_link = hard_link
         self.abort = abort
-    def __call__(self, file):
+        self.sanitizers = {"aired": self._sanitize_aired}
+
+    def _sanitize_aired(self, aired):
         try:
-            file["info"]["aired"] = file["info"]["aired"].strftime(self.date_format)
+            return filename_friendly(aired.strftime(self.date_format))
         except:
             self.output.warning("Invalid date format, using default one instead.")
             try:
-                file["info"]["aired"] = file["info"]["aired"].strftime("%Y-%m-%d")
+                return filename_friendly(aired.strftime("%Y-%m-%d"))
             except:
-                pass  # Invalid input format, leave as is
-        target = self.target_path
-        for tag in file["info"]:
-            if (self.abort and ("%"+tag+"%" in target) and IsNullOrWhitespace(file["info"][tag])):
-                self.output.error(f"Rename aborted, {tag!r} is empty.")
-                return
-            target = target.replace("%"+tag+"%", filename_friendly(file["info"][tag])) # Remove path invalid characters
+                return filename_friendly(aired)  # Invalid input format, leave as is
+
+    def __call__(self, file):
+        try:
+            target = self.template.render(file["info"], sanitizer=filename_friendly, sanitizers=self.sanitizers, abort_on_empty=self.abort)
+        except TemplateEmptyTagError as e:
+            self.output.error(f"Rename aborted, {e.tag!r} is empty.")
+            return False
         target = ' '.join(target.split())  # Replace multiple whitespaces with one
         filename, base_ext = os.path.splitext(file["file_path"])
+        failed = False
         for f in glob.glob(glob.escape(filename) + "*"): # Find subtitle files
             try:
                 tmp_tgt = target
@@ -240,9 +381,13 @@ class RenameOperation(Operation):
             except (OSError, RuntimeError) as e:
                 # {tmp_tgt + file_extension!r}:
                 self.output.error(f"Failed to rename/link to: {e}")
+                failed = True
         if self.delete_empty and len(os.listdir(os.path.dirname(file["file_path"]))) == 0:
             os.removedirs(os.path.dirname(file["file_path"]))
+        if self.keep_structure:  # Where the file itself went, for the journal and catalog
+            target = os.path.join(os.path.dirname(file["file_path"]), target)
         file["file_path"] = target + base_ext
+        return not failed
 
 
 def filename_friendly(input):
@@ -257,16 +402,18 @@ def filename_friendly(input):
 
 
 def construct_helper_tags(fileinfo):
-    year_list = re.findall(r'(\d{4})', fileinfo["year"])
-    if (len(year_list) > 0):
-        fileinfo["year_start"] = year_list[0]
-        fileinfo["year_end"] = year_list[-1]
-    else:
-        fileinfo["year_start"] = fileinfo["year_end"] = fileinfo["year"]
-
-    res_match = re.findall('x(360|480|720|1080|2160)', fileinfo["resolution"])
-    if (len(res_match) > 0):
-        fileinfo["resolution_abbr"] = res_match[0] + 'p'
-    else:
-        fileinfo["resolution_abbr"] = fileinfo["resolution"]
+    if "year" in fileinfo:
+        year_list = re.findall(r'(\d{4})', fileinfo["year"])
+        if (len(year_list) > 0):
+            fileinfo["year_start"] = year_list[0]
+            fileinfo["year_end"] = year_list[-1]
+        else:
+            fileinfo["year_start"] = fileinfo["year_end"] = fileinfo["year"]
+
+    if "resolution" in fileinfo:
+        res_match = re.findall('x(360|480|720|1080|2160)', fileinfo["resolution"])
+        if (len(res_match) > 0):
+            fileinfo["resolution_abbr"] = res_match[0] + 'p'
+        else:
+            fileinfo["resolution_abbr"] = fileinfo["resolution"]
     return fileinfo
@@ -5,6 +5,9 @@ from datetime import datetime
 
 QUIRK_ANIMEDESC_LEAVE_SLASH = object()
 
+# AniDB truncates UDP responses to this many bytes.
+MAX_RESPONSE_DATAGRAM_SIZE = 1400
+
 def _get_query_quirks(query):
     if isinstance(query, AnimeDescRequest):
         return [QUIRK_ANIMEDESC_LEAVE_SLASH]
@@ -106,18 +109,23 @@ class AnidbResponse(object):
     CODE_RESULT_ANIME_DESCRIPTION = 233
     CODE_RESULT_NO_SUCH_FILE = 320
 
-    def __init__(self, code, data, *, extended=None, body=None, decoded=None):
+    def __init__(self, code, data, *, extended=None, body=None, decoded=None, wire_size=None):
         self.code = code
         self.data = data
         self.extended = extended
         self.body = body
         self.decoded = decoded
+        self.wire_size = wire_size
 
     @classmethod
-    def parse(cls, binary):
+    def parse(cls, binary, *, wire_size=None):
+        """wire_size is the size of the datagram as received, before decryption;
+        without it, the size of the text is used."""
         (code_text, rest) = binary.split(' ', 1)
         code = int(code_text)
-        inst = cls(code, rest)
+        if wire_size is None:
+            wire_size = len(binary.encode('utf-8'))
+        inst = cls(code, rest, wire_size=wire_size)
         parts = rest.split("\n", 1)
         if len(parts) == 2:
             inst.extended = parts[0]
@@ -140,6 +148,23 @@ class AnidbResponse(object):
         keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
         return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
 
+    def may_be_truncated(self, query):
+        expected = len(query.IMPLICIT_FIELDS) + len(query.fields)
+        if len(self.body.split("|")) < expected:
+            return True
+        # a response that filled the whole datagram may have lost the tail of its last field.
+        return self.wire_size is not None and MAX_RESPONSE_DATAGRAM_SIZE <= self.wire_size
+
+    def truncated_tail(self, query):
+        """Returns (field, partial_raw_value) for the field cut off by truncation, if any."""
+        if not self.may_be_truncated(query):
+            return None
+        parsed = parse_data(self.body, quirks=_get_query_quirks(query))
+        idx = len(parsed) - 1 - len(query.IMPLICIT_FIELDS)
+        if idx < 0 or len(query.fields) <= idx:
+            return None
+        return query.fields[idx], parsed[-1]
+
     def iter_raw_kv(self, query, *, suppress_truncation_error=False):
         if hasattr(query, 'validate_response_has_valid_code'):
             query.validate_response_has_valid_code(self)
@@ -150,11 +175,14 @@ class AnidbResponse(object):
         if not suppress_truncation_error:
             if len(parsed) != len(query.IMPLICIT_FIELDS) + len(query.fields):
                 raise RuntimeError(f'Truncated: {len(parsed)} != {len(query.IMPLICIT_FIELDS) + len(query.fields)}')
-        else:
-            truncation_workaround = slice(None, len(parsed) - 1)
+        elif self.may_be_truncated(query):
+            truncation_workaround = slice(None, len(parsed) - 1 - len(query.IMPLICIT_FIELDS))
         for (f, v) in zip(query.fields, parsed[len(query.IMPLICIT_FIELDS):][truncation_workaround]):
             yield f, v
 
+    def undecoded_copy(self):
+        return AnidbResponse(self.code, self.data, extended=self.extended, body=self.body, wire_size=self.wire_size)
+
     def decode_with_query(self, query, *, suppress_truncation_error=False):
         if self.decoded is not None:
             return
@@ -215,6 +243,12 @@ class FileKeyED2K(object):
         yield ('ed2k', self.ed2k)
         yield ('size', self.size)
 
+    def __eq__(self, other):
+        return isinstance(other, FileKeyED2K) and (self.ed2k, self.size) == (other.ed2k, other.size)
+
+    def __hash__(self):
+        return hash((FileKeyED2K, self.ed2k, self.size))
+
     def _repr_fields(self):
         yield ('ed2k', self.ed2k)
         yield ('size', self.size)
@@ -234,6 +268,12 @@ class FileKeyFID(object):
     def anidb_props(self):
         yield ('fid', self.fid)
 
+    def __eq__(self, other):
+        return isinstance(other, FileKeyFID) and self.fid == other.fid
+
+    def __hash__(self):
+        return hash((FileKeyFID, self.fid))
+
     def _repr_fields(self):
         yield ('fid', self.fid)
 
@@ -242,10 +282,17 @@ class FileKeyFID(object):
         return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
 
 
+class MylistEntry(namedtuple('_MylistEntry', ['lid', 'fid', 'state', 'viewed', 'updated'])):
+    pass
+
+
 class FileRequest(AnidbApiCall):
     IMPLICIT_FIELDS = [('fid', int)]
-    def __init__(self, *, fields, key=None, size=None, ed2k=None, fid=None):
+    def __init__(self, *, fields, key=None, size=None, ed2k=None, fid=None, deferred_fields=None, planner=None):
         self.fields = fields
+        # fields planned for a follow-up request, see anidbcli.fieldplanner
+        self.deferred_fields = list(deferred_fields or [])
+        self.planner = planner
         if key:
             assert (isinstance(key, FileKeyED2K) or isinstance(key, FileKeyFID))
             self.key = key
@@ -283,11 +330,15 @@ class FileRequest(AnidbApiCall):
         _assert_code(response, AnidbResponse.CODE_RESULT_FILE, "FILE")
 
     def next_request(self, response):
-        return None
+        if self.planner is None:
+            return None
+        return self.planner.next_request(self, response)
 
     def _repr_fields(self):
         yield ('key', self.key)
         yield ('fields', self.fields)
+        if self.deferred_fields:
+            yield ('deferred_fields', self.deferred_fields)
 
     def __repr__(self):
         keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
@@ -486,6 +537,14 @@ class FileAmaskField(MaskField, namedtuple('_FileAmaskField', ['byte', 'bit', 'n
     def short_code(self):
         return f"file_amask_{self.name}"
 
+    def entity(self):
+        """The object this field describes: 'anime', 'episode' or 'group'."""
+        if self.byte == 3:
+            return 'episode'
+        if self.byte == 4 and self.name in ('g_name', 'g_sname'):
+            return 'group'
+        return 'anime'
+
 
 FileAmaskField.register_all([
     FileAmaskField(1, 7, 'ep_total', None),  # was: anime_total_episodes
@@ -515,6 +574,23 @@ FileAmaskField.register_all([
     FileAmaskField(4, 0, 'date_aid_record_updated', None),
 ])
 
+# The FILE fields identifying the object each FileAmaskField.entity() refers to.
+FILE_ENTITY_ID_FIELDS = {
+    'anime': 'aid',
+    'episode': 'eid',
+    'group': 'gid',
+}
+
+
+def file_field_by_name(name):
+    """Returns the FileFmaskField or FileAmaskField called name, or None."""
+    for cls in (FileFmaskField, FileAmaskField):
+        field = vars(cls.f).get(name)
+        if isinstance(field, cls):
+            return field
+    return None
+
+
 AnimeAmaskField.register_all([
     AnimeAmaskField(1, 7, 'aid'),
     AnimeAmaskField(1, 6, 'dateflags'),
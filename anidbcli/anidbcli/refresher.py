@@ -0,0 +1,83 @@
+import queue
+import sys
+import threading
+
+from anidbcli.fieldplanner import MAX_FOLLOWUP_REQUESTS
+from anidbcli.protocol import AnidbResponse, FileKeyFID
+
+
+class BackgroundRefresher(object):
+    """Re-fetches stale cached FILE fields on a background thread.
+
+    Refreshes go through the connector like any other request, so they share its
+    session and rate limit; stale values keep being served until they're replaced.
+    Refreshes still queued on close() are dropped, the fields just stay stale.
+    """
+
+    def __init__(self, connector):
+        self._connector = connector
+        self._queue = queue.Queue()
+        # fid -> set of fields, for fids queued but not picked up yet
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def queue(self, fid, fields):
+        with self._lock:
+            if self._closed:
+                return
+            if fid in self._pending:
+                self._pending[fid].update(fields)
+                return
+            self._pending[fid] = set(fields)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="anidbcli-refresher", daemon=True)
+                self._thread.start()
+        self._queue.put(fid)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            fid = self._queue.get()
+            if fid is None:
+                return
+            with self._lock:
+                fields = self._pending.pop(fid, None)
+            if not fields:
+                continue
+            try:
+                self._refresh(fid, fields)
+            except Exception as e:
+                print(f"background refresh of fid {fid} failed: {e}", file=sys.stderr)
+
+    def _refresh(self, fid, fields):
+        print("refreshing stale fields of fid {}: {}".format(
+            fid, ', '.join(f.short_code() for f in fields)), file=sys.stderr)
+        req = self._connector.field_planner.build_request(FileKeyFID(fid), fields)
+        for _ in range(1 + MAX_FOLLOWUP_REQUESTS):
+            if req is None or self._closed:
+                break
+            res = self._connector.send_request(req, refresh=True)
+            if res.code != AnidbResponse.CODE_RESULT_FILE:
+                break
+            req = req.next_request(res)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _repr_fields(self):
+        yield ('pending', self.pending())
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
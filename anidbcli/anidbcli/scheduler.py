@@ -0,0 +1,88 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from enum import IntEnum
+
+
+class RequestPriority(IntEnum):
+    """Which request gets the next slot of the rate limit, lowest value first."""
+    # someone is waiting for the answer right now (api --api-2x, the daemon's clients)
+    INTERACTIVE = 0
+    # FILE lookups of a batch run, which renames wait for
+    PIPELINE = 1
+    # MYLISTADD, nothing waits for it
+    MYLIST = 2
+    # re-fetching stale cached values
+    BACKGROUND = 3
+
+
+class PriorityScheduler(object):
+    """Hands out the connection to AniDB one request at a time.
+
+    Whenever it's free and the rate limit allows another request, the waiting
+    request with the highest priority goes; with shortest_job_first, the
+    cheapest one of those, otherwise the one waiting longest.  Nothing is let
+    through ahead of its slot, so low-priority work only ever takes slots no
+    higher-priority request was waiting for.
+
+    ready_at() returns the time.monotonic() from which the next request may be sent.
+    """
+
+    def __init__(self, ready_at, *, shortest_job_first=False):
+        self.ready_at = ready_at
+        self.shortest_job_first = shortest_job_first
+        self._cond = threading.Condition()
+        # heap of (priority, cost, arrival) tickets
+        self._waiting = []
+        self._arrivals = itertools.count()
+        self._busy = False
+        self._owner = None
+        # requests let through, by RequestPriority
+        self.granted = Counter()
+
+    @contextmanager
+    def slot(self, priority, cost=0):
+        """Waits for this request's turn; the connection is this thread's until the block exits."""
+        if self._owner == threading.get_ident():
+            # already sending, e.g. logging in again from within a request
+            yield
+            return
+        ticket = (int(priority), cost if self.shortest_job_first else 0, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._busy or self._waiting[0] != ticket:
+                    self._cond.wait()
+                    continue
+                delay = self.ready_at() - time.monotonic()
+                if delay <= 0:
+                    break
+                # a more important request may show up meanwhile
+                self._cond.wait(delay)
+            heapq.heappop(self._waiting)
+            self._busy = True
+            self._owner = threading.get_ident()
+            self.granted[RequestPriority(priority)] += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._busy = False
+                self._owner = None
+                self._cond.notify_all()
+
+    def waiting(self):
+        with self._cond:
+            return Counter(RequestPriority(priority) for (priority, _, _) in self._waiting)
+
+    def _repr_fields(self):
+        yield ('shortest_job_first', self.shortest_job_first)
+        yield ('waiting', dict(self.waiting()))
+        yield ('granted', dict(self.granted))
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
@@ -0,0 +1,169 @@
+import time
+from collections import namedtuple
+
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, Text, Index, bindparam, delete, func, insert, select, text
+
+from anidbcli.anidbconnector import OBJECT_TYPE_FILE, PREFETCH_CHUNK_SIZE, _chunks, _decode_payload, _payload_entity_ids
+from anidbcli.sqlcache import anidb_files, anidb_objects
+from anidbcli.protocol import FILE_ENTITY_ID_FIELDS
+
+# The search tables are derived from anidb_objects and brought up to date before
+# every query, so the lookup and write paths never pay for them.
+search_metadata = MetaData()
+anidb_search_facets = Table(
+    "anidb_search_facets",
+    search_metadata,
+    Column("fid", Integer, primary_key=True),
+    Column("aid", Integer, nullable=True),
+    Column("eid", Integer, nullable=True),
+    Column("gid", Integer, nullable=True),
+    Column("resolution", Text, nullable=True),
+    Column("video_codec", Text, nullable=True),
+    Column("title", Text, nullable=True),
+    Column("ep_no", Text, nullable=True),
+    Column("group_name", Text, nullable=True),
+)
+Index("anidb_search_facets_aid", anidb_search_facets.c.aid)
+Index("anidb_search_facets_eid", anidb_search_facets.c.eid)
+Index("anidb_search_facets_gid", anidb_search_facets.c.gid)
+
+# full text index over the same files, rowid = fid
+CREATE_SEARCH_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS anidb_search USING fts5("
+    "titles, groups, episodes, filename, tokenize='unicode61 remove_diacritics 2')")
+anidb_search = sqlalchemy.table("anidb_search", sqlalchemy.column("rowid"))
+
+SEARCH_COLUMN_FIELDS = {
+    'titles': ('a_romaji', 'a_kanji', 'a_english', 'a_synonyms', 'a_other', 'a_short'),
+    'groups': ('g_name', 'g_sname'),
+    'episodes': ('ep_english', 'ep_romaji', 'ep_kanji'),
+    'filename': ('filename',),
+}
+DEFAULT_QUERY_LIMIT = 50
+
+
+class SearchResult(namedtuple('_SearchResult', ['fid', 'ed2k', 'size', 'aid', 'eid', 'gid', 'title', 'ep_no', 'group_name', 'resolution', 'video_codec'])):
+    pass
+
+
+def _file_values(payload, entity_payloads):
+    """Raw values by field name for a file, with its anime/episode/group fields filled in."""
+    values = {name: v[0] for (name, v) in payload.items()}
+    for (entity, entity_id) in _payload_entity_ids(payload).items():
+        for (name, v) in entity_payloads.get((entity, entity_id), {}).items():
+            values.setdefault(name, v[0])
+    return values
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _load_payloads(conn, object_type, object_ids):
+    rows = conn.execute(
+        select(anidb_objects.c.object_id, anidb_objects.c.payload).where(
+            (anidb_objects.c.object_type == object_type) & anidb_objects.c.object_id.in_(object_ids)))
+    return {object_id: _decode_payload(payload) for (object_id, payload) in rows}
+
+
+def _changed_fids(conn, since):
+    fids = set(conn.execute(select(anidb_objects.c.object_id).where(
+        (anidb_objects.c.object_type == OBJECT_TYPE_FILE) & (since <= anidb_objects.c.updated))).scalars())
+    for (entity, id_field) in FILE_ENTITY_ID_FIELDS.items():
+        changed = select(anidb_objects.c.object_id).where(
+            (anidb_objects.c.object_type == entity) & (since <= anidb_objects.c.updated))
+        fids.update(conn.execute(select(anidb_search_facets.c.fid).where(
+            anidb_search_facets.c[id_field].in_(changed))).scalars())
+    return fids
+
+
+def _index_files(conn, fids):
+    payloads = _load_payloads(conn, OBJECT_TYPE_FILE, fids)
+    wanted = {}
+    for payload in payloads.values():
+        for (entity, entity_id) in _payload_entity_ids(payload).items():
+            wanted.setdefault(entity, set()).add(entity_id)
+    entity_payloads = {}
+    for (entity, entity_ids) in wanted.items():
+        for (entity_id, payload) in _load_payloads(conn, entity, sorted(entity_ids)).items():
+            entity_payloads[(entity, entity_id)] = payload
+
+    conn.execute(delete(anidb_search_facets).where(anidb_search_facets.c.fid.in_(fids)))
+    conn.execute(text("DELETE FROM anidb_search WHERE rowid IN :fids").bindparams(bindparam('fids', expanding=True)), {'fids': fids})
+    facets = []
+    documents = []
+    for (fid, payload) in payloads.items():
+        values = _file_values(payload, entity_payloads)
+        facets.append({
+            'fid': fid,
+            'aid': _to_int(values.get('aid')),
+            'eid': _to_int(values.get('eid')),
+            'gid': _to_int(values.get('gid')),
+            'resolution': values.get('resolution'),
+            'video_codec': values.get('video_codec'),
+            'title': values.get('a_romaji') or values.get('a_english'),
+            'ep_no': values.get('ep_no'),
+            'group_name': values.get('g_name'),
+        })
+        document = {'fid': fid}
+        for (column, names) in SEARCH_COLUMN_FIELDS.items():
+            document[column] = ' '.join(values[n] for n in names if values.get(n))
+        documents.append(document)
+    if facets:
+        conn.execute(insert(anidb_search_facets), facets)
+        conn.execute(text(
+            "INSERT INTO anidb_search (rowid, titles, groups, episodes, filename) "
+            "VALUES (:fid, :titles, :groups, :episodes, :filename)"), documents)
+
+
+def refresh_search_index(cache):
+    """Brings the search tables up to date with the cache; returns the number of files indexed."""
+    with cache.connection() as conn:
+        search_metadata.create_all(conn)
+        conn.exec_driver_sql(CREATE_SEARCH_TABLE)
+        since = cache.get_state('search_indexed', 0)
+        started = int(time.time())
+        fids = sorted(_changed_fids(conn, since))
+        for chunk in _chunks(fids, PREFETCH_CHUNK_SIZE):
+            _index_files(conn, chunk)
+        if since <= cache.get_state('last_sweep', 0):
+            # files swept or evicted since the last refresh
+            cached = select(anidb_objects.c.object_id).where(anidb_objects.c.object_type == OBJECT_TYPE_FILE)
+            conn.execute(delete(anidb_search_facets).where(anidb_search_facets.c.fid.not_in(cached)))
+            conn.exec_driver_sql(
+                "DELETE FROM anidb_search WHERE rowid NOT IN "
+                f"(SELECT object_id FROM anidb_objects WHERE object_type = '{OBJECT_TYPE_FILE}')")
+        cache.set_state('search_indexed', started)
+    return len(fids)
+
+
+def match_expression(query_text):
+    """Turns free text into an FTS5 query matching all words as prefixes."""
+    return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in query_text.split())
+
+
+def search(cache, query_text=None, *, aid=None, eid=None, gid=None, resolution=None, codec=None, limit=DEFAULT_QUERY_LIMIT):
+    """Finds cached files by title/group/episode text and structured filters; returns SearchResults."""
+    refresh_search_index(cache)
+    facets = anidb_search_facets
+    stmt = select(
+        facets.c.fid, anidb_files.c.ed2k, anidb_files.c.size, facets.c.aid, facets.c.eid, facets.c.gid,
+        facets.c.title, facets.c.ep_no, facets.c.group_name, facets.c.resolution, facets.c.video_codec,
+    ).select_from(facets.join(anidb_files, anidb_files.c.fid == facets.c.fid))
+    params = {}
+    if query_text and query_text.strip():
+        matching = select(anidb_search.c.rowid).where(text("anidb_search MATCH :match"))
+        stmt = stmt.where(facets.c.fid.in_(matching))
+        params['match'] = match_expression(query_text)
+    for (column, value) in (('aid', aid), ('eid', eid), ('gid', gid), ('resolution', resolution)):
+        if value is not None:
+            stmt = stmt.where(facets.c[column] == value)
+    if codec is not None:
+        stmt = stmt.where(func.lower(facets.c.video_codec) == codec.lower())
+    stmt = stmt.order_by(facets.c.title, facets.c.ep_no, facets.c.fid).limit(limit)
+    with cache.connection() as conn:
+        return [SearchResult(*r) for r in conn.execute(stmt, params)]
@@ -0,0 +1,251 @@
+import gzip
+import json
+import os
+import time
+import zlib
+from collections import namedtuple
+
+from sqlalchemy import and_, delete, exists, or_, select
+from sqlalchemy.dialects.sqlite import insert
+
+from anidbcli.anidbconnector import FILE_IDENTIFIER_TTL, NEGATIVE_CACHE_TTL, PREFETCH_CHUNK_SIZE, _decode_payload, _encode_payload, _payload_masks
+from anidbcli.sqlcache import anidb_file_negative_cache2, anidb_files, anidb_mylist, anidb_objects
+
+# A snapshot is gzipped JSON lines: a header object, then one array per cached row,
+# tagged with its kind:
+#   ["f", ed2k, size, fid, expiration]
+#   ["o", object type, object id, payload, expiration, updated]
+#   ["n", ed2k, size, failure count, failed on, synthesize failure until, expiration]
+#   ["m", lid, fid, ed2k, size, state, viewed, updated]
+SNAPSHOT_FORMAT = "anidbcli-cache-snapshot"
+SNAPSHOT_VERSION = 1
+RECORD_KINDS = {
+    'f': 'files',
+    'o': 'objects',
+    'n': 'negative',
+    'm': 'mylist',
+}
+# the number of values after the kind
+RECORD_LENGTHS = {
+    'f': 4,
+    'o': 5,
+    'n': 6,
+    'm': 7,
+}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotHeader(namedtuple('_SnapshotHeader', ['version', 'since', 'watermark'])):
+    """since and watermark are unix timestamps: the snapshot holds the rows written in
+    between, so the next delta can be exported with since=watermark."""
+    pass
+
+
+class SnapshotCounts(namedtuple('_SnapshotCounts', list(RECORD_KINDS.values()))):
+    pass
+
+
+def _iter_records(conn, since):
+    # anidb_files and the negative cache have no write time, but their expiration is
+    # always set to the write time plus a fixed TTL.
+    files = select(anidb_files.c.ed2k, anidb_files.c.size, anidb_files.c.fid, anidb_files.c.expiration).where(
+        since + int(FILE_IDENTIFIER_TTL.total_seconds()) <= anidb_files.c.expiration)
+    for r in conn.execute(files):
+        yield ['f', *r]
+    objects = select(
+        anidb_objects.c.object_type, anidb_objects.c.object_id, anidb_objects.c.payload,
+        anidb_objects.c.expiration, anidb_objects.c.updated,
+    ).where(since <= anidb_objects.c.updated)
+    for (object_type, object_id, payload, expiration, updated) in conn.execute(objects):
+        yield ['o', object_type, object_id, _decode_payload(payload), expiration, updated]
+    neg = anidb_file_negative_cache2
+    negative = select(
+        neg.c.ed2k, neg.c.size, neg.c.failure_count, neg.c.failed_on, neg.c.synthesize_failure_until, neg.c.expiration,
+    ).where(since + int(NEGATIVE_CACHE_TTL.total_seconds()) <= neg.c.expiration)
+    for r in conn.execute(negative):
+        yield ['n', *r]
+    mylist = select(
+        anidb_mylist.c.lid, anidb_mylist.c.fid, anidb_mylist.c.ed2k, anidb_mylist.c.size,
+        anidb_mylist.c.state, anidb_mylist.c.viewed, anidb_mylist.c.updated,
+    ).where(since <= anidb_mylist.c.updated)
+    for r in conn.execute(mylist):
+        yield ['m', *r]
+
+
+def export_snapshot(cache, path, *, since=0):
+    """Writes the files, objects, negative cache and mylist rows of an
+    AnidbCacheSqlAlchemy written since the given unix timestamp to path.
+
+    Returns (SnapshotHeader, SnapshotCounts).
+    """
+    header = SnapshotHeader(SNAPSHOT_VERSION, since, int(time.time()))
+    counts = dict.fromkeys(RECORD_KINDS, 0)
+    tmp_path = path + '.tmp'
+    try:
+        with cache.connection() as conn, gzip.open(tmp_path, 'wt', encoding='utf-8') as fh:
+            fh.write(json.dumps({'format': SNAPSHOT_FORMAT, **header._asdict()}) + '\n')
+            for record in _iter_records(conn, since):
+                fh.write(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n')
+                counts[record[0]] += 1
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return (header, SnapshotCounts(*counts.values()))
+
+
+def _read_header(fh, path):
+    try:
+        header = json.loads(fh.readline())
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        raise SnapshotError(f"{path!r} is not a cache snapshot: {e}")
+    if not isinstance(header, dict) or header.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"{path!r} is not a cache snapshot")
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError(f"{path!r} is a version {header.get('version')} snapshot, only version {SNAPSHOT_VERSION} is supported")
+    return SnapshotHeader(header['version'], header['since'], header['watermark'])
+
+
+def read_snapshot_header(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as fh:
+        return _read_header(fh, path)
+
+
+def _merge_files(conn, records):
+    upsert = insert(anidb_files)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=['ed2k', 'size'],
+        set_={'fid': upsert.excluded.fid, 'expiration': upsert.excluded.expiration},
+        where=anidb_files.c.expiration < upsert.excluded.expiration)
+    return conn.execute(upsert, [
+        {'ed2k': ed2k, 'size': size, 'fid': fid, 'expiration': expiration}
+        for (ed2k, size, fid, expiration) in records]).rowcount
+
+
+def _merge_negative(conn, records):
+    neg = anidb_file_negative_cache2
+    upsert = insert(neg)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=['ed2k', 'size'],
+        set_={c: upsert.excluded[c] for c in ('failure_count', 'failed_on', 'synthesize_failure_until', 'expiration')},
+        where=neg.c.expiration < upsert.excluded.expiration)
+    return conn.execute(upsert, [
+        {'ed2k': ed2k, 'size': size, 'failure_count': failure_count, 'failed_on': failed_on,
+         'synthesize_failure_until': until, 'expiration': expiration}
+        for (ed2k, size, failure_count, failed_on, until, expiration) in records]).rowcount
+
+
+def _merge_objects(conn, records):
+    """Merges payloads field by field, keeping whichever value was fetched last."""
+    now = int(time.time())
+    by_type = {}
+    for (object_type, object_id, payload, expiration, updated) in records:
+        by_type.setdefault(object_type, {})[object_id] = (payload, expiration)
+    upsert = insert(anidb_objects)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=['object_type', 'object_id'],
+        set_={c: upsert.excluded[c] for c in ('fmask', 'amask', 'payload', 'expiration', 'updated')})
+    rows = []
+    for (object_type, incoming) in by_type.items():
+        existing = {
+            object_id: (_decode_payload(payload), expiration)
+            for (object_id, payload, expiration) in conn.execute(
+                select(anidb_objects.c.object_id, anidb_objects.c.payload, anidb_objects.c.expiration).where(
+                    (anidb_objects.c.object_type == object_type) & anidb_objects.c.object_id.in_(list(incoming))))}
+        for (object_id, (payload, expiration)) in incoming.items():
+            (merged, old_expiration) = existing.get(object_id, ({}, 0))
+            changed = object_id not in existing
+            for (name, value) in payload.items():
+                if name not in merged or merged[name][1] < value[1]:
+                    merged[name] = value
+                    changed = True
+            if not changed:
+                continue
+            (fmask, amask) = _payload_masks(merged)
+            rows.append({
+                'object_type': object_type,
+                'object_id': object_id,
+                'fmask': fmask,
+                'amask': amask,
+                'payload': _encode_payload(merged),
+                'expiration': max(expiration, old_expiration),
+                # rewritten rows count as written now, so they're part of this cache's next delta
+                'updated': now,
+                'last_access': now,
+            })
+    if rows:
+        conn.execute(upsert, rows)
+    return len(rows)
+
+
+def _merge_mylist(conn, records):
+    """Replaces mylist entries (by lid, or by file) with incoming ones updated later."""
+    lids = [r[0] for r in records]
+    ed2ks = [r[2] for r in records if r[2] is not None]
+    newest = {}
+    for r in conn.execute(select(anidb_mylist).where(or_(anidb_mylist.c.lid.in_(lids), anidb_mylist.c.ed2k.in_(ed2ks)))):
+        for k in (('lid', r.lid), ('file', r.ed2k, r.size)):
+            newest[k] = max(newest.get(k, 0), r.updated)
+    rows = []
+    for (lid, fid, ed2k, size, state, viewed, updated) in records:
+        if updated <= max(newest.get(('lid', lid), 0), newest.get(('file', ed2k, size), 0)):
+            continue
+        rows.append({'lid': lid, 'fid': fid, 'ed2k': ed2k, 'size': size, 'state': state, 'viewed': viewed, 'updated': updated})
+    if rows:
+        # OR REPLACE also drops the row of a file that was re-added under a new lid
+        conn.execute(insert(anidb_mylist).prefix_with("OR REPLACE"), rows)
+    return len(rows)
+
+
+MERGERS = {
+    'f': _merge_files,
+    'o': _merge_objects,
+    'n': _merge_negative,
+    'm': _merge_mylist,
+}
+
+
+def import_snapshot(cache, path):
+    """Merges a snapshot into an AnidbCacheSqlAlchemy.
+
+    Each row is kept from whichever side expires later (files, negative cache),
+    was fetched later (each field of an object) or was updated later (mylist).
+    Returns (SnapshotHeader, SnapshotCounts of the rows that changed anything).
+    """
+    merged = dict.fromkeys(RECORD_KINDS, 0)
+    batches = {kind: [] for kind in RECORD_KINDS}
+
+    def flush_batch(conn, kind):
+        if batches[kind]:
+            merged[kind] += MERGERS[kind](conn, batches[kind])
+            batches[kind] = []
+
+    with gzip.open(path, 'rt', encoding='utf-8') as fh:
+        header = _read_header(fh, path)
+        with cache.connection() as conn:
+            try:
+                for (line_no, line) in enumerate(fh, 2):
+                    record = json.loads(line)
+                    if not isinstance(record, list) or not record or record[0] not in MERGERS:
+                        raise SnapshotError(f"{path!r}, line {line_no}: unknown record {line[:40]!r}")
+                    if len(record) != 1 + RECORD_LENGTHS[record[0]]:
+                        raise SnapshotError(f"{path!r}, line {line_no}: expected {RECORD_LENGTHS[record[0]]} values "
+                                            f"in a {record[0]!r} record, got {len(record) - 1}")
+                    batches[record[0]].append(record[1:])
+                    if PREFETCH_CHUNK_SIZE <= len(batches[record[0]]):
+                        flush_batch(conn, record[0])
+                for kind in RECORD_KINDS:
+                    flush_batch(conn, kind)
+            except (OSError, EOFError, zlib.error, ValueError, TypeError, AttributeError) as e:
+                raise SnapshotError(f"{path!r} is damaged: {e}")
+            # a file identified on either side isn't unknown
+            neg = anidb_file_negative_cache2
+            conn.execute(delete(neg).where(exists().where(
+                and_(anidb_files.c.ed2k == neg.c.ed2k, anidb_files.c.size == neg.c.size))))
+    return (header, SnapshotCounts(*merged.values()))
@@ -0,0 +1,806 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import sqlalchemy
+import sqlalchemy.engine
+from sqlalchemy import create_engine, event, bindparam, case, MetaData, Table, Column, Integer, Float, Text, select, Index, UniqueConstraint, delete, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.sql.expression import func
+from sqlalchemy.sql.functions import count
+
+from anidbcli.anidbconnector import (
+    CACHE_FLUSH_EVERY_FILES, CACHE_FLUSH_INTERVAL_SECONDS, EVICTION_TARGET_RATIO, FILE_IDENTIFIER_TTL, METADATA_TTL, MYLIST_ENTRY_TTL,
+    NEGATIVE_CACHE_FIRST_RETRY, NEGATIVE_CACHE_MAX_RETRY, NEGATIVE_CACHE_TTL, OBJECT_TYPE_FILE, PREFETCH_CHUNK_SIZE, SWEEP_EVERY_WRITES, SWEEP_INTERVAL, CachedFileLookup,
+    ImplicitField, _add_stale_fields, _chunks, _convert_return_iter_to_list, _decode_payload, _encode_payload, _entity_ids, _field_masks, _iter_payload_entries, _locked,
+    _payload_entity_ids, _payload_masks, _split_by_object, _stale_fields_by_fid, get_cache_path, get_persistence_base_path)
+from anidbcli.cachepolicy import FieldTtlPolicy
+from anidbcli.protocol import FILE_ENTITY_ID_FIELDS, FileKeyED2K, FileKeyFID, FileRequest, MylistEntry, file_field_by_name
+
+metadata_obj = MetaData()
+# legacy, superseded by anidb_file_negative_cache2 and no longer written to.
+anidb_file_negative_cache = Table(
+    "anidb_file_negative_cache",
+    metadata_obj,
+    Column("id", Integer, primary_key=True),
+    Column("ed2k", Text, nullable=False),
+    Column("size", Integer, nullable=False),
+    Column("expiration", Integer, nullable=False),
+    UniqueConstraint("ed2k", "size", name="anidb_key"),
+)
+Index("anidb_file_negative_cache_expiration", anidb_file_negative_cache.c.expiration)
+
+anidb_file_negative_cache2 = Table(
+    "anidb_file_negative_cache2",
+    metadata_obj,
+    Column("id", Integer, primary_key=True),
+    Column("ed2k", Text, nullable=False),
+    Column("size", Integer, nullable=False),
+    Column("failure_count", Integer, nullable=False),
+    Column("failed_on", Integer, nullable=False),
+    Column("synthesize_failure_until", Integer, nullable=False),
+    Column("expiration", Integer, nullable=False),
+    UniqueConstraint("ed2k", "size", name="anidb_key"),
+)
+Index("anidb_file_negative_cache2_expiration", anidb_file_negative_cache.c.expiration)
+
+anidb_files = Table(
+    "anidb_files",
+    metadata_obj,
+    Column("id", Integer, primary_key=True),
+    Column("fid", Integer, nullable=False),
+    Column("ed2k", Text, nullable=False),
+    Column("size", Integer, nullable=False),
+    Column("expiration", Integer, nullable=False),
+    UniqueConstraint("ed2k", "size", name="anidb_key"),
+)
+Index("anidb_files_fid", anidb_files.c.expiration)
+Index("anidb_files_expiration", anidb_files.c.expiration)
+
+# One row per cached object (a file, or the anime, episode or group files refer to
+# through aid/eid/gid) with the raw values of all its cached fields and when they
+# were fetched in payload (see _encode_payload).  fmask/amask have the bits of the
+# cached fields set, like the masks of a FILE request, so lookups can tell whether
+# an object has any of the fields they want without decoding its payload.
+anidb_objects = Table(
+    "anidb_objects",
+    metadata_obj,
+    Column("object_type", Text, primary_key=True),
+    Column("object_id", Integer, primary_key=True),
+    Column("fmask", Integer, nullable=False),
+    Column("amask", Integer, nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("expiration", Integer, nullable=False),
+    Column("updated", Integer, nullable=False),
+    Column("last_access", Integer, nullable=False, server_default="0"),
+)
+Index("anidb_objects_expiration", anidb_objects.c.expiration)
+anidb_objects_last_access = Index("anidb_objects_last_access", anidb_objects.c.last_access)
+
+# the one-row-per-field table used before anidb_objects, only read when migrating.
+legacy_anidb_metadata = Table(
+    "metadata",
+    MetaData(),
+    Column("object_prop_key", Text, primary_key=True),
+    Column("prop_value", Text, nullable=False),
+    Column("expiration", Integer, nullable=False),
+)
+
+anidb_mylist = Table(
+    "anidb_mylist",
+    metadata_obj,
+    Column("lid", Integer, primary_key=True),
+    Column("fid", Integer, nullable=True),
+    Column("ed2k", Text, nullable=True),
+    Column("size", Integer, nullable=True),
+    Column("state", Integer, nullable=False),
+    Column("viewed", Integer, nullable=False),
+    Column("updated", Integer, nullable=False),
+    UniqueConstraint("ed2k", "size", name="anidb_key"),
+)
+Index("anidb_mylist_fid", anidb_mylist.c.fid)
+
+# bookkeeping of the cache itself, like when it was last swept.
+anidb_cache_state = Table(
+    "anidb_cache_state",
+    metadata_obj,
+    Column("key", Text, primary_key=True),
+    Column("value", Integer, nullable=False),
+)
+
+anidb_field_sizes = Table(
+    "anidb_field_sizes",
+    metadata_obj,
+    Column("field", Text, primary_key=True),
+    Column("samples", Integer, nullable=False),
+    Column("mean_size", Float, nullable=False),
+    Column("max_size", Integer, nullable=False),
+)
+
+# the aid/eid/gid bits: a file with those may lead to anime, episode or group objects with amask fields
+ENTITY_ID_FMASK = _field_masks(file_field_by_name(name) for name in FILE_ENTITY_ID_FIELDS.values())[0]
+
+
+def _has_wanted_fields(objects):
+    """Whether a row of anidb_objects has any of the fields in the fmask/amask parameters, by its masks."""
+    return ((objects.c.fmask.op('&')(bindparam('fmask')) != 0)
+            | (objects.c.amask.op('&')(bindparam('amask')) != 0)
+            | ((bindparam('amask') != 0) & (objects.c.fmask.op('&')(ENTITY_ID_FMASK) != 0)))
+
+
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # durable enough for a cache, and no fsync per commit in WAL mode
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+]
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _writes(func):
+    """Like _locked, for methods writing to the cache.  If one fails halfway, the
+    uncommitted writes are rolled back, so the next flush can't commit half of it."""
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            try:
+                return func(self, *args, **kwargs)
+            except BaseException:
+                self.rollback()
+                raise
+    return wrapper
+
+
+class AnidbCacheSqlAlchemy:
+    """Cache on top of a single long-lived connection.
+
+    Writes are grouped into transactions which are committed every flush_every files
+    or flush_interval seconds, whichever comes first, and on flush()/close().  A
+    timer commits the last writes before an idle spell, and a write that fails
+    rolls back the uncommitted ones.  The connection is shared with the background
+    refresher, so all access is serialized.
+    """
+
+    def __init__(self, engine_url, *, flush_every=CACHE_FLUSH_EVERY_FILES, flush_interval=CACHE_FLUSH_INTERVAL_SECONDS, ttl_policy=None, max_size=None):
+        connect_args = {}
+        if sqlalchemy.engine.make_url(engine_url).get_backend_name() == 'sqlite':
+            connect_args['check_same_thread'] = False
+        self._sqlite_engine = create_engine(engine_url, echo=False, connect_args=connect_args)
+        self._lock = threading.RLock()
+        self.ttl_policy = ttl_policy or FieldTtlPolicy()
+        # fid -> fields served from the cache although their TTL ran out
+        self._stale = {}
+        # bytes; least recently used objects are evicted by sweep() beyond that
+        self.max_size = max_size
+        # (object_type, object_id) served since the last flush, for last_access
+        self._accessed = set()
+        self._writes_since_sweep = 0
+        if self._sqlite_engine.dialect.name == 'sqlite':
+            event.listen(self._sqlite_engine, "connect", _set_sqlite_pragmas)
+        self._conn = self._sqlite_engine.connect()
+        metadata_obj.create_all(self._conn)
+        self._migrate_last_access()
+        self._conn.commit()
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._pending_files = 0
+        # whether there are writes to commit, and the timer that commits them when idle
+        self._dirty = False
+        self._flush_timer = None
+        self._last_flush = time.monotonic()
+        self._prepare_statements()
+        self._migrate_legacy_metadata()
+
+    def _prepare_statements(self):
+        # Built once with bound parameters so SQLAlchemy's compiled cache and the
+        # driver's statement cache get hit on every call.
+        neg = anidb_file_negative_cache2
+        self._select_negative = select(neg.c.synthesize_failure_until).where(
+            (neg.c.ed2k == bindparam('ed2k'))
+            & (neg.c.size == bindparam('size'))
+            & (bindparam('now') <= neg.c.synthesize_failure_until))
+        self._delete_expired_negative = delete(neg).where(neg.c.expiration <= bindparam('now'))
+        upsert_negative = insert(neg).values(
+            ed2k=bindparam('ed2k'),
+            size=bindparam('size'),
+            failure_count=1,
+            failed_on=bindparam('now'),
+            synthesize_failure_until=bindparam('first_until'),
+            expiration=bindparam('expiration'))
+        self._upsert_negative = upsert_negative.on_conflict_do_update(
+            index_elements=['ed2k', 'size'],
+            set_={
+                'failure_count': neg.c.failure_count + 1,
+                'synthesize_failure_until': func.min(
+                    bindparam('max_until'),
+                    bindparam('first_until') + 3600 * neg.c.failure_count),
+                'expiration': bindparam('expiration'),
+            })
+        upsert_file = insert(anidb_files)
+        self._upsert_file = upsert_file.on_conflict_do_update(
+            index_elements=['ed2k', 'size'],
+            set_={'fid': upsert_file.excluded.fid, 'expiration': upsert_file.excluded.expiration})
+        self._select_objects = select(anidb_objects.c.object_id, anidb_objects.c.payload).where(
+            (anidb_objects.c.object_type == bindparam('object_type'))
+            & anidb_objects.c.object_id.in_(bindparam('object_ids', expanding=True)))
+        self._select_objects_with_fields = self._select_objects.where(_has_wanted_fields(anidb_objects))
+        upsert_object = insert(anidb_objects)
+        self._upsert_object = upsert_object.on_conflict_do_update(
+            index_elements=['object_type', 'object_id'],
+            set_={c: upsert_object.excluded[c] for c in ('fmask', 'amask', 'payload', 'expiration', 'updated', 'last_access')})
+        file_objects = anidb_objects.alias('file_objects')
+        files_join = anidb_files.outerjoin(file_objects, (file_objects.c.object_type == OBJECT_TYPE_FILE)
+                                           & (file_objects.c.object_id == anidb_files.c.fid))
+        # the payload only comes along (and gets decoded) if the masks say it has some of the fields asked for
+        wanted_payload = case((_has_wanted_fields(file_objects), file_objects.c.payload), else_=None)
+        self._select_file_object = select(anidb_files.c.fid, wanted_payload).select_from(files_join).where(
+            (anidb_files.c.ed2k == bindparam('ed2k'))
+            & (anidb_files.c.size == bindparam('size')))
+        self._select_file_objects_many = select(
+            anidb_files.c.ed2k, anidb_files.c.size, anidb_files.c.fid, wanted_payload,
+        ).select_from(files_join).where(anidb_files.c.ed2k.in_(bindparam('ed2ks', expanding=True)))
+        self._delete_expired_files = delete(anidb_files).where(anidb_files.c.expiration <= bindparam('now'))
+        self._delete_expired_objects = delete(anidb_objects).where(anidb_objects.c.expiration <= bindparam('now'))
+        self._touch_object = update(anidb_objects).where(
+            (anidb_objects.c.object_type == bindparam('b_object_type'))
+            & (anidb_objects.c.object_id == bindparam('b_object_id'))
+        ).values(last_access=bindparam('b_now'))
+        self._select_least_recently_used = select(anidb_objects.c.object_type, anidb_objects.c.object_id).order_by(
+            anidb_objects.c.last_access).limit(bindparam('limit'))
+        self._delete_objects = delete(anidb_objects).where(
+            (anidb_objects.c.object_type == bindparam('object_type'))
+            & anidb_objects.c.object_id.in_(bindparam('object_ids', expanding=True)))
+        self._delete_files_by_fid = delete(anidb_files).where(anidb_files.c.fid.in_(bindparam('fids', expanding=True)))
+        upsert_state = insert(anidb_cache_state)
+        self._upsert_state = upsert_state.on_conflict_do_update(
+            index_elements=['key'], set_={'value': upsert_state.excluded.value})
+        self._select_negative_many = select(neg.c.ed2k, neg.c.size).where(
+            neg.c.ed2k.in_(bindparam('ed2ks', expanding=True))
+            & (bindparam('now') <= neg.c.synthesize_failure_until))
+        self._select_mylist = select(anidb_mylist).where(
+            (anidb_mylist.c.ed2k == bindparam('ed2k'))
+            & (anidb_mylist.c.size == bindparam('size'))
+            & (bindparam('since') <= anidb_mylist.c.updated))
+        self._replace_mylist = insert(anidb_mylist).prefix_with("OR REPLACE")
+
+    def _migrate_last_access(self):
+        columns = {c['name'] for c in sqlalchemy.inspect(self._conn).get_columns(anidb_objects.name)}
+        if 'last_access' not in columns:
+            self._conn.exec_driver_sql("ALTER TABLE anidb_objects ADD COLUMN last_access INTEGER NOT NULL DEFAULT 0")
+        anidb_objects_last_access.create(self._conn, checkfirst=True)
+
+    def _migrate_legacy_metadata(self):
+        """Folds the one-row-per-field metadata table of older caches into anidb_objects.
+
+        Reads the table a page of rows at a time, in primary key order, so a large
+        one isn't loaded whole; fields of a file split across pages are merged.
+        """
+        if not sqlalchemy.inspect(self._conn).has_table(legacy_anidb_metadata.name):
+            return
+        rows = self._conn.execute(select(count()).select_from(legacy_anidb_metadata)).scalar()
+        if rows:
+            print(f"migrating {rows} cached fields to the anidb_objects table", file=sys.stderr)
+        key = legacy_anidb_metadata.c.object_prop_key
+        page = select(legacy_anidb_metadata).where(bindparam('after') < key).order_by(key).limit(PREFETCH_CHUNK_SIZE)
+        batch = self._conn.execute(page, {'after': ''}).all()
+        while batch:
+            updates = {}
+            for r in batch:
+                (object_key, _, name) = r.object_prop_key.partition(':')
+                if not object_key.startswith('f') or not object_key[1:].isdigit():
+                    continue
+                fetched = int(r.expiration - METADATA_TTL.total_seconds())
+                updates.setdefault(int(object_key[1:]), {})[name] = [r.prop_value, fetched]
+            self._merge_objects(OBJECT_TYPE_FILE, updates)
+            batch = self._conn.execute(page, {'after': batch[-1].object_prop_key}).all()
+        legacy_anidb_metadata.drop(self._conn)
+        self._conn.commit()
+        self._conn.exec_driver_sql("VACUUM")
+
+    def _load_payloads(self, object_type, object_ids, masks=None):
+        """Loads objects by id; with masks, (fmask, amask), only the ones having some of those fields."""
+        (stmt, params) = (self._select_objects, {'object_type': object_type})
+        if masks is not None:
+            (stmt, params['fmask'], params['amask']) = (self._select_objects_with_fields, *masks)
+        out = {}
+        for chunk in _chunks(list(object_ids), PREFETCH_CHUNK_SIZE):
+            with self._conn.execute(stmt, dict(params, object_ids=chunk)) as iterator:
+                for (object_id, payload) in iterator:
+                    out[object_id] = _decode_payload(payload)
+        return out
+
+    def _load_entity_payloads(self, file_payloads, fields):
+        """Loads the anime/episode/group objects referred to by file payloads, by (type, id)."""
+        (_, amask) = _field_masks(fields)
+        if not amask:
+            return {}
+        wanted = {}
+        for payload in file_payloads:
+            for (entity, entity_id) in _payload_entity_ids(payload).items():
+                wanted.setdefault(entity, set()).add(entity_id)
+        out = {}
+        for (entity, entity_ids) in wanted.items():
+            for (entity_id, payload) in self._load_payloads(entity, sorted(entity_ids), (0, amask)).items():
+                out[(entity, entity_id)] = payload
+                self._accessed.add((entity, entity_id))
+        return out
+
+    def _merge_objects(self, object_type, updates):
+        """Merges {object_id: {field name: [raw value, fetched at]}} into the stored objects."""
+        if not updates:
+            return
+        now = datetime.now()
+        existing = self._load_payloads(object_type, updates.keys())
+        rows = []
+        for (object_id, values) in updates.items():
+            payload = existing.get(object_id, {})
+            payload.update(values)
+            (fmask, amask) = _payload_masks(payload)
+            rows.append({
+                'object_type': object_type,
+                'object_id': object_id,
+                'fmask': fmask,
+                'amask': amask,
+                'payload': _encode_payload(payload),
+                'expiration': self.ttl_policy.expiration(payload),
+                'updated': int(now.timestamp()),
+                'last_access': int(now.timestamp()),
+            })
+        self._conn.execute(self._upsert_object, rows)
+
+    def _after_write(self, files=0):
+        self._pending_files += files
+        self._writes_since_sweep += 1
+        self._dirty = True
+        if SWEEP_EVERY_WRITES <= self._writes_since_sweep:
+            self.sweep()
+        elif (self._flush_every <= self._pending_files
+                or self._flush_interval <= time.monotonic() - self._last_flush):
+            self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self._flush_interval, self._flush_when_idle)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_when_idle(self):
+        with self._lock:
+            self._flush_timer = None
+            if self._conn is not None and self._dirty:
+                self.flush()
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    @_locked
+    def flush(self):
+        if self._accessed:
+            now = int(datetime.now().timestamp())
+            self._conn.execute(self._touch_object, [
+                {'b_object_type': object_type, 'b_object_id': object_id, 'b_now': now}
+                for (object_type, object_id) in self._accessed])
+            self._accessed.clear()
+        self._conn.commit()
+        self._pending_files = 0
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    @_locked
+    def rollback(self):
+        """Drops the writes not committed yet."""
+        self._conn.rollback()
+        self._pending_files = 0
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    @_locked
+    def close(self):
+        if self._conn is None:
+            return
+        last_sweep = self.get_state('last_sweep')
+        if last_sweep is None or last_sweep + SWEEP_INTERVAL.total_seconds() <= datetime.now().timestamp():
+            self.sweep()
+        self.flush()
+        self._cancel_flush_timer()
+        self._conn.close()
+        self._conn = None
+        self._sqlite_engine.dispose()
+
+    @_locked
+    def get_state(self, key, default=None):
+        value = self._conn.execute(
+            select(anidb_cache_state.c.value).where(anidb_cache_state.c.key == key)).scalar()
+        return default if value is None else value
+
+    @_writes
+    def set_state(self, key, value):
+        self._conn.execute(self._upsert_state, {'key': key, 'value': value})
+        self._schedule_flush()
+
+    @contextmanager
+    def connection(self):
+        """The underlying connection, for tools working on the database directly.
+
+        Pending writes are flushed first, the cache is locked meanwhile and whatever
+        was done is committed afterwards, or rolled back if that failed.
+        """
+        with self._lock:
+            self.flush()
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    def used_size(self):
+        """Bytes used by the database, not counting free pages."""
+        page_size = self._conn.exec_driver_sql("PRAGMA page_size").scalar()
+        page_count = self._conn.exec_driver_sql("PRAGMA page_count").scalar()
+        freelist_count = self._conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        return (page_count - freelist_count) * page_size
+
+    @_locked
+    def sweep(self):
+        """Drops expired rows and, if over max_size, the least recently used objects.
+
+        Returns the number of rows removed.  Runs every SWEEP_EVERY_WRITES writes and
+        on close once a day, so lookups themselves never write.
+        """
+        now = int(datetime.now().timestamp())
+        self.flush()
+        removed = 0
+        for stmt in (self._delete_expired_negative, self._delete_expired_files, self._delete_expired_objects):
+            removed += self._conn.execute(stmt, {'now': now}).rowcount
+        if self.max_size is not None:
+            removed += self._evict(int(self.max_size * EVICTION_TARGET_RATIO))
+        self.set_state('last_sweep', now)
+        self._writes_since_sweep = 0
+        self.flush()
+        return removed
+
+    def _evict(self, target_size):
+        used = self.used_size()
+        if used <= self.max_size:
+            return 0
+        objects = self._conn.execute(select(count()).select_from(anidb_objects)).scalar()
+        if not objects:
+            return 0
+        # deleted rows only free whole pages, so estimate how many objects to drop from
+        # the average instead of deleting until the page count goes down.
+        excess = (used - target_size) * objects // used + 1
+        victims = self._conn.execute(self._select_least_recently_used, {'limit': excess}).all()
+        by_type = {}
+        for (object_type, object_id) in victims:
+            by_type.setdefault(object_type, []).append(object_id)
+        for (object_type, object_ids) in by_type.items():
+            for chunk in _chunks(object_ids, PREFETCH_CHUNK_SIZE):
+                self._conn.execute(self._delete_objects, {'object_type': object_type, 'object_ids': chunk})
+                if object_type == OBJECT_TYPE_FILE:
+                    self._conn.execute(self._delete_files_by_fid, {'fids': chunk})
+        print(f"evicted {len(victims)} least recently used cache entries", file=sys.stderr)
+        return len(victims)
+
+    @_locked
+    def index_changes(self, since_row_id, since_updated):
+        """Files and anime/episode/group objects added or changed since a watermark.
+
+        Returns (highest anidb_files id, [(ed2k, size, fid, payload)], [(type, id,
+        payload)]), payloads being the stored JSON text; used by fidindex.build_index.
+        """
+        self.flush()
+        file_objects = anidb_objects.alias('file_objects')
+        files_join = anidb_files.outerjoin(file_objects, (file_objects.c.object_type == OBJECT_TYPE_FILE)
+                                           & (file_objects.c.object_id == anidb_files.c.fid))
+        max_row_id = self._conn.execute(select(func.max(anidb_files.c.id))).scalar() or 0
+        files = self._conn.execute(
+            select(anidb_files.c.ed2k, anidb_files.c.size, anidb_files.c.fid, file_objects.c.payload)
+            .select_from(files_join)
+            .where((since_row_id < anidb_files.c.id) | (since_updated <= file_objects.c.updated))).all()
+        entities = self._conn.execute(
+            select(anidb_objects.c.object_type, anidb_objects.c.object_id, anidb_objects.c.payload)
+            .where((anidb_objects.c.object_type != OBJECT_TYPE_FILE) & (since_updated <= anidb_objects.c.updated))).all()
+        return (max_row_id, files, entities)
+
+    @_locked
+    def maintain(self):
+        """sweep(), then VACUUM and ANALYZE.  Returns (size before, size after) in bytes."""
+        before = self.used_size()
+        self.sweep()
+        self._conn.exec_driver_sql("VACUUM")
+        self._conn.exec_driver_sql("ANALYZE")
+        self._conn.commit()
+        return (before, self.used_size())
+
+    def _inject_negative_cache_record(self, req):
+        if hasattr(req, 'key') and isinstance(req.key, FileKeyED2K):
+            return self._inject_negative_cache_record_file_key_ed2k(req.key.ed2k, req.key.size)
+        print("want to insert negative cache record for {!r}, but type is not understood", file=sys.stderr)
+
+    @_writes
+    def _inject_negative_cache_record_file_key_ed2k(self, ed2k, size):
+        now = datetime.now()
+        self._conn.execute(self._upsert_negative, {
+            'ed2k': ed2k,
+            'size': size,
+            'now': int(now.timestamp()),
+            'first_until': int((now + NEGATIVE_CACHE_FIRST_RETRY).timestamp()),
+            'max_until': int((now + NEGATIVE_CACHE_MAX_RETRY).timestamp()),
+            'expiration': int((now + NEGATIVE_CACHE_TTL).timestamp()),
+        })
+        self._after_write(files=1)
+
+
+    @_locked
+    def check_negative_cache(self, req):
+        """
+        returns true if we think this record does not exist,
+        returns false if the record may exist
+        """
+        hash_key = None
+        if isinstance(req, FileRequest):
+            if isinstance(req.key, FileKeyFID):
+                # If we have a File ID, then this file cannot be unknown.
+                return False
+            assert isinstance(req.key, FileKeyED2K)
+            hash_key = req.key
+        elif isinstance(req, dict):
+            ed2k = req.get('ed2k', None)
+            size = req.get('size', None)
+            if ed2k is not None and size is not None:
+                hash_key = FileKeyED2K(ed2k, size)
+        elif hash_key is None:
+            return False
+        now = int(datetime.now().timestamp())
+        if isinstance(hash_key, FileKeyED2K):
+            params = {'ed2k': hash_key.ed2k, 'size': hash_key.size, 'now': now}
+            with self._conn.execute(self._select_negative, params) as cursor:
+                for _ in cursor:
+                    return True
+        elif isinstance(hash_key, FileKeyFID):
+            # If we have a File ID, then this file cannot be unknown.
+            return False
+        else:
+            cls_name = "{0.__class__.__module__}.{0.__class__.__name__}".format(hash_key)
+            allowed = {FileKeyED2K, FileKeyFID}
+            raise TypeError("expected hash key (in {0!r}), got {1}: {2}".format(allowed, cls_name, hash_key))
+        return False
+
+    @_writes
+    def inject_cache(self, req, res):
+        if isinstance(req, FileRequest):
+            values = dict(res.iter_raw_kv(req, suppress_truncation_error=True))
+            self.inject_file_values(req.key, res.decoded['fid'], values)
+
+    @_writes
+    def inject_file_values(self, key, fid, values):
+        """Stores {field: raw value} of a file as received from AniDB, keyed by ed2k or fid."""
+        now = datetime.now()
+        if isinstance(key, FileKeyED2K):
+            self._conn.execute(self._upsert_file, {
+                'fid': fid,
+                'ed2k': key.ed2k,
+                'size': key.size,
+                'expiration': int((now + FILE_IDENTIFIER_TTL).timestamp()),
+            })
+        fetched = int(now.timestamp())
+        entity_ids = _entity_ids({f.name: v for (f, v) in values.items()})
+        for (object_type, updates) in _split_by_object(fid, {f: [v, fetched] for (f, v) in values.items()}, entity_ids).items():
+            self._merge_objects(object_type, updates)
+        self._after_write(files=1)
+
+    @_locked
+    def load_field_size_stats(self):
+        with self._conn.execute(select(anidb_field_sizes)) as iterator:
+            return {r.field: (r.samples, r.mean_size, r.max_size) for r in iterator}
+
+    @_writes
+    def store_field_size_stats(self, stats):
+        if not stats:
+            return
+        upsert = insert(anidb_field_sizes)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['field'],
+            set_={c: upsert.excluded[c] for c in ('samples', 'mean_size', 'max_size')})
+        self._conn.execute(upsert, [
+            {'field': field, 'samples': samples, 'mean_size': mean_size, 'max_size': max_size}
+            for (field, (samples, mean_size, max_size)) in stats.items()])
+        self._after_write()
+
+    @_locked
+    def lookup_mylist_entry(self, key):
+        if not isinstance(key, FileKeyED2K):
+            return None
+        since = int((datetime.now() - MYLIST_ENTRY_TTL).timestamp())
+        with self._conn.execute(self._select_mylist, {'ed2k': key.ed2k, 'size': key.size, 'since': since}) as iterator:
+            for r in iterator:
+                return MylistEntry(r.lid, r.fid, r.state, r.viewed, datetime.fromtimestamp(r.updated))
+        return None
+
+    @_writes
+    def record_mylist_entry(self, key, *, lid, state, viewed, fid=None):
+        if fid is None:
+            entry = self.lookup_mylist_entry(key)
+            if entry is not None and entry.lid == lid:
+                fid = entry.fid
+        # OR REPLACE also drops the row of a file that was re-added under a new lid
+        self._conn.execute(self._replace_mylist, {
+            'lid': lid,
+            'fid': fid,
+            'ed2k': key.ed2k,
+            'size': key.size,
+            'state': state,
+            'viewed': viewed,
+            'updated': int(datetime.now().timestamp()),
+        })
+        self._after_write()
+
+    @_writes
+    def forget_mylist_entry(self, key):
+        self._conn.execute(delete(anidb_mylist).where(
+            (anidb_mylist.c.ed2k == key.ed2k)
+            & (anidb_mylist.c.size == key.size)))
+        self._after_write()
+
+    @_writes
+    def bulk_import_export_records(self, records, *, batch_size=1000):
+        """Loads mylist export records into the file, metadata and mylist tables.
+
+        Everything is written in a single transaction, which is rolled back if the
+        import fails.  Records with a value that doesn't parse as its field's type
+        are skipped.  Values count as fetched when the export was made; if that
+        isn't known, they're stale right away, so they're served but refreshed.
+        Returns (number of records imported, number skipped).
+        """
+        now = datetime.now()
+        file_expiration = int((now + FILE_IDENTIFIER_TTL).timestamp())
+        self.flush()
+
+        def fetched_at(r, field):
+            if r.exported is not None:
+                return int(min(r.exported, now.timestamp()))
+            ttl = self.ttl_policy.ttl(field)
+            return int(now.timestamp() - (0 if ttl is None else ttl.total_seconds()))
+
+        count = 0
+        batch = []
+        def flush_batch():
+            self._conn.execute(self._upsert_file, [
+                {'fid': r.fid, 'ed2k': r.ed2k, 'size': r.size, 'expiration': file_expiration}
+                for r in batch])
+            updates = {}
+            for r in batch:
+                values = {f: [v, fetched_at(r, f)] for (f, v) in r.fields.items()}
+                entity_ids = _entity_ids({f.name: v for (f, v) in r.fields.items()})
+                for (object_type, objects) in _split_by_object(r.fid, values, entity_ids).items():
+                    for (object_id, payload) in objects.items():
+                        updates.setdefault(object_type, {}).setdefault(object_id, {}).update(payload)
+            for (object_type, objects) in updates.items():
+                self._merge_objects(object_type, objects)
+            mylist_rows = [
+                {'lid': r.lid, 'fid': r.fid, 'ed2k': r.ed2k, 'size': r.size, 'state': r.state or 0,
+                 'viewed': r.viewed or 0, 'updated': int(min(r.exported or now.timestamp(), now.timestamp()))}
+                for r in batch if r.lid is not None]
+            if mylist_rows:
+                self._conn.execute(self._replace_mylist, mylist_rows)
+            batch.clear()
+
+        skipped = 0
+        for r in records:
+            if not _valid_export_record(r):
+                skipped += 1
+                continue
+            batch.append(r)
+            count += 1
+            if batch_size <= len(batch):
+                flush_batch()
+        if batch:
+            flush_batch()
+        self.flush()
+        return (count, skipped)
+
+    @_locked
+    def prefetch_file_keys(self, keys, fields, *, raw=False):
+        """Batch version of check_negative_cache and locally_service_field_values.
+
+        Resolves many FileKeyED2K at once with a handful of set-based queries and
+        returns {key: CachedFileLookup}.  Keys the cache knows nothing about map to
+        CachedFileLookup(False, []).  With raw, values are left as received from
+        AniDB instead of being decoded.
+        """
+        out = {k: CachedFileLookup(False, []) for k in keys if isinstance(k, FileKeyED2K)}
+        now = int(datetime.now().timestamp())
+        (fmask, amask) = _field_masks(fields)
+        files = {}
+        for chunk in _chunks(sorted({k.ed2k for k in out}), PREFETCH_CHUNK_SIZE):
+            with self._conn.execute(self._select_negative_many, {'ed2ks': chunk, 'now': now}) as iterator:
+                for (ed2k, size) in iterator:
+                    key = FileKeyED2K(ed2k, size)
+                    if key in out:
+                        out[key] = CachedFileLookup(True, [])
+            params = {'ed2ks': chunk, 'fmask': fmask, 'amask': amask}
+            with self._conn.execute(self._select_file_objects_many, params) as iterator:
+                for (ed2k, size, fid, payload) in iterator:
+                    key = FileKeyED2K(ed2k, size)
+                    if key in out and not out[key].negative:
+                        files[key] = (fid, _decode_payload(payload) if payload is not None else None)
+        entity_payloads = self._load_entity_payloads([p for (_, p) in files.values() if p is not None], fields)
+        for (key, (fid, payload)) in files.items():
+            out[key].values.extend(self._serve_file(fid, payload, entity_payloads, fields, now, raw))
+        return out
+
+    @_locked
+    @_convert_return_iter_to_list
+    def locally_service_field_values(self, key, fields, *, raw=False):
+        masks = _field_masks(fields)
+        if isinstance(key, FileKeyED2K):
+            params = {'ed2k': key.ed2k, 'size': key.size, 'fmask': masks[0], 'amask': masks[1]}
+            with self._conn.execute(self._select_file_object, params) as iterator:
+                rows = [(fid, _decode_payload(payload) if payload is not None else None) for (fid, payload) in iterator]
+        elif isinstance(key, FileKeyFID):
+            rows = [(key.fid, self._load_payloads(OBJECT_TYPE_FILE, [key.fid], masks).get(key.fid))]
+        else:
+            return
+        entity_payloads = self._load_entity_payloads([p for (_, p) in rows if p is not None], fields)
+        now = int(datetime.now().timestamp())
+        for (fid, payload) in rows:
+            yield from self._serve_file(fid, payload, entity_payloads, fields, now, raw)
+
+    def _serve_file(self, fid, payload, entity_payloads, fields, now, raw=False):
+        yield ImplicitField('fid'), fid
+        if payload is None:
+            return
+        self._accessed.add((OBJECT_TYPE_FILE, fid))
+        stale = []
+        for (f, (value, fetched)) in _iter_payload_entries(payload, entity_payloads, fields):
+            if self.ttl_policy.is_stale(f, fetched, now):
+                stale.append(f)
+            yield f, (value if raw else f.filter_value(value))
+        if stale:
+            _add_stale_fields(self._stale, fid, stale, _payload_entity_ids(payload))
+
+    @_locked
+    def take_stale_fields(self):
+        """Returns {fid: fields} served since the last call although they're stale."""
+        (stale, self._stale) = (self._stale, {})
+        return _stale_fields_by_fid(stale)
+
+
+def _valid_export_record(record):
+    """Whether all field values of an export record parse as their field's type."""
+    for (f, v) in record.fields.items():
+        try:
+            f.filter_value(v)
+        except (TypeError, ValueError):
+            return False
+    return True
+
+
+def open_default_cache():
+    try:
+        os.mkdir(get_persistence_base_path())
+    except FileExistsError:
+        pass
+    return AnidbCacheSqlAlchemy(engine_url = sqlalchemy.engine.URL(
+        drivername='sqlite+pysqlite',
+        username=None,
+        password=None,
+        host=None,
+        port=None,
+        database=get_cache_path(),
+        query={},
+    ))
@@ -0,0 +1,147 @@
+import re
+from collections import namedtuple
+
+from anidbcli.protocol import file_field_by_name
+
+# Tags computed by GetFileInfoOperation, mapped to the fields they are computed from.
+DERIVED_TAG_SOURCES = {
+    'resolution_abbr': ('resolution',),
+    'year_start': ('year',),
+    'year_end': ('year',),
+    'a_english': ('a_english', 'a_romaji'),  # falls back to romaji when empty
+    'ep_english': ('ep_english', 'ep_romaji'),  # falls back to romaji when empty
+    'version': (),
+    'censored': (),
+}
+
+# %tag%, %tag|fallback|...%, and %?tag% ... %/tag% for sections only rendered when
+# the tag is non-empty.
+TAG_PATTERN = re.compile(r'%([?/]?)(\w+(?:\|\w+)*)%')
+
+
+class TemplateSyntaxError(ValueError):
+    pass
+
+
+class TemplateEmptyTagError(Exception):
+    def __init__(self, tag):
+        self.tag = tag
+        super().__init__(f"{tag!r} is empty")
+
+
+class Literal(namedtuple('_Literal', ['text'])):
+    pass
+
+
+class Field(namedtuple('_Field', ['name', 'fallbacks'], defaults=((),))):
+    def names(self):
+        return (self.name,) + tuple(self.fallbacks)
+
+
+class Conditional(namedtuple('_Conditional', ['name', 'segments'])):
+    pass
+
+
+def field_for_tag(name):
+    """Returns the FILE mask field for a tag name, or None for unknown tags."""
+    return file_field_by_name(name)
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and (value == "" or value.isspace()))
+
+
+def _iter_tags(segments):
+    for s in segments:
+        if isinstance(s, Field):
+            yield from s.names()
+        elif isinstance(s, Conditional):
+            yield s.name
+            yield from _iter_tags(s.segments)
+
+
+class RenameTemplate(object):
+    """A --rename format string, parsed once into literal and field segments."""
+
+    def __init__(self, format_string, segments):
+        self.format_string = format_string
+        self.segments = segments
+
+    @classmethod
+    def compile(cls, format_string):
+        # stack of (open conditional name or None, segments being collected)
+        stack = [(None, [])]
+        pos = 0
+        for m in TAG_PATTERN.finditer(format_string):
+            segments = stack[-1][1]
+            if pos < m.start():
+                segments.append(Literal(format_string[pos:m.start()]))
+            pos = m.end()
+            (sigil, names) = (m.group(1), m.group(2).split('|'))
+            if sigil == '?':
+                if len(names) != 1:
+                    raise TemplateSyntaxError(f"conditional {m.group(0)!r} takes a single tag")
+                stack.append((names[0], []))
+            elif sigil == '/':
+                if stack[-1][0] != m.group(2):
+                    raise TemplateSyntaxError(f"unexpected {m.group(0)!r} at offset {m.start()}")
+                (name, inner) = stack.pop()
+                stack[-1][1].append(Conditional(name, inner))
+            else:
+                segments.append(Field(names[0], tuple(names[1:])))
+        if pos < len(format_string):
+            stack[-1][1].append(Literal(format_string[pos:]))
+        if len(stack) != 1:
+            raise TemplateSyntaxError(f"unterminated conditional %?{stack[-1][0]}%")
+        return cls(format_string, stack[0][1])
+
+    def tags(self):
+        return set(_iter_tags(self.segments))
+
+    def required_fields(self):
+        """Returns the FILE fields needed to render this template, in mask order."""
+        fields = set()
+        for tag in self.tags():
+            for source in DERIVED_TAG_SOURCES.get(tag, (tag,)):
+                field = field_for_tag(source)
+                if field is not None:
+                    fields.add(field)
+        return sorted(fields, key=lambda f: f.to_sort_tuple())
+
+    def render(self, info, *, sanitizer=str, sanitizers=None, abort_on_empty=False):
+        """Renders the template for one file's info in a single pass.
+
+        Values go through sanitizers[tag] if present and sanitizer otherwise.  Tags
+        missing from info entirely are left in place, as they always have been.
+        Raises TemplateEmptyTagError for empty tags if abort_on_empty is set.
+        """
+        out = []
+        self._render_into(out, self.segments, info, sanitizer, sanitizers or {}, abort_on_empty)
+        return ''.join(out)
+
+    def _render_into(self, out, segments, info, sanitizer, sanitizers, abort_on_empty):
+        for s in segments:
+            if isinstance(s, Literal):
+                out.append(s.text)
+            elif isinstance(s, Conditional):
+                if not _is_empty(info.get(s.name)):
+                    self._render_into(out, s.segments, info, sanitizer, sanitizers, abort_on_empty)
+            else:
+                known = [n for n in s.names() if n in info]
+                if not known:
+                    out.append('%' + '|'.join(s.names()) + '%')
+                    continue
+                for n in known:
+                    if not _is_empty(info[n]):
+                        out.append(sanitizers.get(n, sanitizer)(info[n]))
+                        break
+                else:
+                    if abort_on_empty:
+                        raise TemplateEmptyTagError(known[0])
+
+    def _repr_fields(self):
+        yield ('format_string', self.format_string)
+
+    def __repr__(self):
+        keys = ', '.join("{}={!r}".format(n, v) for (n, v) in self._repr_fields())
+        return "{0.__class__.__module__}.{0.__class__.__name__}({1})".format(self, keys)
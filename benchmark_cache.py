@@ -0,0 +1,102 @@
+"""Compares the SQLite and key-value cache backends.
+
+Measures bulk insert speed, lookup latency (single lookups by ed2k, and batches of
+them through prefetch_file_keys) and the size of the database on disk:
+
+    python benchmark_cache.py --files 20000
+"""
+import argparse
+import glob
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "anidbcli"))
+
+from anidbcli.kvcache import AnidbCacheKv
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileRequest
+from anidbcli.sqlcache import AnidbCacheSqlAlchemy
+
+FIELDS = [
+    FileFmaskField.f.aid,
+    FileFmaskField.f.eid,
+    FileFmaskField.f.gid,
+    FileFmaskField.f.crc32,
+    FileFmaskField.f.resolution,
+    FileFmaskField.f.video_codec,
+    FileFmaskField.f.filename,
+    FileAmaskField.f.a_romaji,
+    FileAmaskField.f.a_english,
+    FileAmaskField.f.ep_no,
+    FileAmaskField.f.ep_english,
+    FileAmaskField.f.g_name,
+]
+
+
+def make_file(i):
+    key = FileKeyED2K(f"{i:032x}", 100000000 + i)
+    (aid, eid, gid) = (i // 12 + 1, i + 1, i % 40 + 1)
+    body = "|".join(map(str, [
+        i + 1, aid, eid, gid, f"{i:08x}", "1920x1080", "H264/AVC",
+        f"[Group{gid}] Anime {aid} - {i % 12 + 1:02d} [1080p].mkv",
+        f"Anime {aid}", f"Anime {aid} English", f"{i % 12 + 1:02d}", f"Episode {i % 12 + 1}", f"Group {gid}",
+    ]))
+    req = FileRequest(key=key, fields=list(FIELDS))
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    return (req, res)
+
+
+def disk_size(path):
+    return sum(os.path.getsize(p) for p in glob.glob(glob.escape(path) + "*"))
+
+
+def bench(name, cache, path, files, lookups, batch_size):
+    started = time.perf_counter()
+    for (req, res) in files:
+        cache.inject_cache(req, res)
+    cache.flush()
+    insert_seconds = time.perf_counter() - started
+
+    keys = [req.key for (req, _) in random.sample(files, min(lookups, len(files)))]
+    latencies = []
+    for key in keys:
+        started = time.perf_counter()
+        cache.locally_service_field_values(key, FIELDS)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+
+    started = time.perf_counter()
+    for i in range(0, len(keys), batch_size):
+        cache.prefetch_file_keys(keys[i:i + batch_size], FIELDS)
+    batch_seconds = time.perf_counter() - started
+    cache.close()
+
+    print(f"{name}:")
+    print(f"  insert    {len(files) / insert_seconds:10.0f} files/s")
+    print(f"  lookup    {statistics.median(latencies) * 1e6:10.1f} us median, {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us p99")
+    print(f"  prefetch  {batch_seconds / len(keys) * 1e6:10.1f} us per file, batches of {batch_size}")
+    print(f"  on disk   {disk_size(path) / 2**20:10.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10000, help="files to insert")
+    parser.add_argument("--lookups", type=int, default=5000, help="files to look up")
+    parser.add_argument("--batch-size", type=int, default=100, help="keys per prefetch_file_keys call")
+    args = parser.parse_args()
+
+    random.seed(0)
+    files = [make_file(i) for i in range(args.files)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.sqlite3")
+        bench("sqlite", AnidbCacheSqlAlchemy(f"sqlite:///{path}"), path, files, args.lookups, args.batch_size)
+        path = os.path.join(tmp, "cache.kv")
+        bench("kv", AnidbCacheKv(path), path, files, args.lookups, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
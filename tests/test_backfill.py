@@ -0,0 +1,91 @@
+from collections import Counter
+
+import flexmock
+
+import anidbcli.backfill as backfill
+import anidbcli.libed2k as libed2k
+from anidbcli.backfill import BackfillBudget, BackfillQueue, run_backfill
+from anidbcli.protocol import AnidbResponse
+from anidbcli.sqlcache import AnidbCacheSqlAlchemy
+
+
+class FakeConnector:
+    """Answers FILE requests with made up values, failing for the files in failing."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.field_planner = None
+        self.scheduler = flexmock.flexmock(granted=Counter())
+        self.failing = set()
+
+    def send_request(self, req):
+        self.scheduler.granted['PIPELINE'] += 1
+        if req.key.size in self.failing:
+            return AnidbResponse.parse("320 NO SUCH FILE")
+        return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, '', decoded={f.name: f"{f.name}-value" for f in req.fields})
+
+
+def quiet_output():
+    return flexmock.flexmock(info=lambda x: None, success=lambda x: None, warning=lambda x: None, error=lambda x: None)
+
+
+def make_files(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"{i}.mkv"
+        path.write_bytes(b"x" * (i + 1))
+        paths.append(str(path))
+    return paths
+
+
+def test_budget_spreads_requests_and_caps_windows():
+    budget = BackfillBudget(per_hour=4, per_day=None)
+    assert budget.interval() == 900
+    assert budget.next_allowed([], 1000) == 1000
+    assert budget.next_allowed([1000], 1000) == 1900
+    # four sent within the hour, the oldest one has to drop out of the window first
+    assert BackfillBudget(per_hour=4, per_day=100).next_allowed([0, 100, 200, 300], 400) == 3600
+    assert BackfillBudget(None, None).next_allowed([1, 2, 3], 4) == 4
+
+
+def test_queue_survives_reopening(tmp_path):
+    url = f"sqlite:///{tmp_path / 'cache.db'}"
+    paths = make_files(tmp_path, 3)
+    cache = AnidbCacheSqlAlchemy(url)
+    queue = BackfillQueue(cache)
+    assert queue.add(paths) == 3
+    assert queue.add(paths[:1]) == 0
+    queue.hashed(queue.next_entry(0), "ab" * 16, 1)
+    cache.close()
+
+    queue = BackfillQueue(AnidbCacheSqlAlchemy(url))
+    assert queue.pending() == 3
+    assert queue.next_entry(0).ed2k == "ab" * 16
+    queue.cache.close()
+
+
+def test_run_looks_up_queued_files_and_retries_failures(tmp_path):
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    conn = FakeConnector(cache)
+    conn.failing.add(2)
+    flexmock.flexmock(libed2k).should_receive('hash_file').replace_with(lambda path: "%032x" % len(path))
+    queue = BackfillQueue(cache)
+    queue.add(make_files(tmp_path, 3))
+    assert run_backfill(queue, conn, quiet_output(), BackfillBudget(None, None), fields=[]) == 3
+    assert queue.pending() == 1
+    assert queue.next_entry(0) is None
+    assert queue.requests_per_file() == 1.0
+    assert len(queue.recent_sent(backfill.time.time())) == 3
+    cache.close()
+
+
+def test_run_stops_when_the_budget_is_used_up(tmp_path):
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    conn = FakeConnector(cache)
+    flexmock.flexmock(libed2k).should_receive('hash_file').replace_with(lambda path: "%032x" % len(path))
+    queue = BackfillQueue(cache)
+    queue.add(make_files(tmp_path, 3))
+    assert run_backfill(queue, conn, quiet_output(), BackfillBudget(per_hour=2, per_day=None), fields=[], no_wait=True) == 1
+    assert queue.pending() == 2
+    assert queue.eta(BackfillBudget(per_hour=2, per_day=None)) == 2 * 1800
+    cache.close()
@@ -0,0 +1,258 @@
+import time
+
+import flexmock
+import pytest
+
+import anidbcli.operations as operations
+import anidbcli.sqlcache as sqlcache
+from anidbcli.anidbconnector import NEGATIVE_CACHE_FIRST_RETRY, AnidbCacheLru, AnidbCacheSqlAlchemy, AnidbConnector, _decode_payload, _encode_payload
+from anidbcli.cachepolicy import FieldTtlPolicy
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileRequest
+
+FIELDS = [FileFmaskField.f.aid, FileFmaskField.f.crc32, FileAmaskField.f.a_romaji]
+
+
+def file_response(req, body):
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    return res
+
+
+def served(cache, key, fields=FIELDS):
+    return {f.name: v for (f, v) in cache.locally_service_field_values(key, fields)}
+
+
+def test_inject_then_serve(tmp_path):
+    cache = AnidbCacheSqlAlchemy(f"sqlite:///{tmp_path}/cache.sqlite3", flush_every=100, flush_interval=3600)
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=list(FIELDS))
+    cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    # visible on the same connection before the batch is committed
+    assert served(cache, FileKeyED2K("abc", 42)) == {"fid": 1001, "aid": 5, "crc32": "23d62d71", "a_romaji": "Gintama"}
+    # injecting the same file again must not trip over existing rows
+    cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    cache.close()
+
+    reopened = AnidbCacheSqlAlchemy(f"sqlite:///{tmp_path}/cache.sqlite3")
+    assert served(reopened, FileKeyED2K("abc", 42))["a_romaji"] == "Gintama"
+    assert reopened._conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+    reopened.close()
+
+
+def test_negative_cache():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=list(FIELDS))
+    assert not cache.check_negative_cache(req)
+    cache._inject_negative_cache_record(req)
+    cache._inject_negative_cache_record(req)
+    assert cache.check_negative_cache(req)
+    assert cache.check_negative_cache({"ed2k": "abc", "size": 42})
+    assert not cache.check_negative_cache({"ed2k": "abc", "size": 43})
+
+
+def test_prefetch_file_keys():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    for (ed2k, fid) in (("abc", 1001), ("abd", 1002)):
+        req = FileRequest(key=FileKeyED2K(ed2k, 42), fields=list(FIELDS))
+        cache.inject_cache(req, file_response(req, f"{fid}|5|23d62d71|Gintama"))
+    cache._inject_negative_cache_record(FileRequest(key=FileKeyED2K("bad", 42), fields=[]))
+
+    keys = [FileKeyED2K("abc", 42), FileKeyED2K("abd", 42), FileKeyED2K("abd", 43), FileKeyED2K("bad", 42)]
+    found = cache.prefetch_file_keys(keys, FIELDS)
+    assert found[FileKeyED2K("abc", 42)].field_names() == {"fid", "aid", "crc32", "a_romaji"}
+    assert dict((f.name, v) for (f, v) in found[FileKeyED2K("abd", 42)].values)["fid"] == 1002
+    assert found[FileKeyED2K("abd", 43)] == (False, [])
+    assert found[FileKeyED2K("bad", 42)].negative
+    for key in keys:
+        assert sorted(found[key].values, key=repr) == sorted(cache.locally_service_field_values(key, FIELDS), key=repr)
+
+
+@pytest.mark.parametrize("page_size", [sqlcache.PREFETCH_CHUNK_SIZE, 1])
+def test_migrates_legacy_metadata(tmp_path, monkeypatch, page_size):
+    import sqlite3
+    # with pages of one row, the fields of a file are read in separate pages
+    monkeypatch.setattr(sqlcache, "PREFETCH_CHUNK_SIZE", page_size)
+    path = tmp_path / "cache.sqlite3"
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE metadata (object_prop_key TEXT PRIMARY KEY, prop_value TEXT NOT NULL, expiration INTEGER NOT NULL)")
+    db.executemany("INSERT INTO metadata VALUES (?, ?, ?)", [
+        ("f1001:aid", "5", 2000000000),
+        ("f1001:a_romaji", "Gintama", 2000000000),
+    ])
+    db.execute("CREATE TABLE anidb_files (id INTEGER PRIMARY KEY, fid INTEGER NOT NULL, ed2k TEXT NOT NULL, size INTEGER NOT NULL, expiration INTEGER NOT NULL, CONSTRAINT anidb_key UNIQUE (ed2k, size))")
+    db.execute("INSERT INTO anidb_files (fid, ed2k, size, expiration) VALUES (1001, 'abc', 42, 2000000000)")
+    db.commit()
+    db.close()
+
+    cache = AnidbCacheSqlAlchemy(f"sqlite:///{path}")
+    assert served(cache, FileKeyED2K("abc", 42)) == {"fid": 1001, "aid": 5, "a_romaji": "Gintama"}
+    (fmask, amask) = cache._conn.exec_driver_sql("SELECT fmask, amask FROM anidb_objects WHERE object_id = 1001").one()
+    assert fmask == FileFmaskField.f.aid.to_bitfield()
+    assert amask == FileAmaskField.f.a_romaji.to_bitfield()
+    assert cache._conn.exec_driver_sql("SELECT count(*) FROM sqlite_master WHERE name = 'metadata'").scalar() == 0
+    cache.close()
+
+
+def test_anime_fields_are_shared_between_files():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    fields = [FileFmaskField.f.aid, FileFmaskField.f.eid, FileAmaskField.f.a_romaji, FileAmaskField.f.ep_no]
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=list(fields))
+    cache.inject_cache(req, file_response(req, "1001|5|70|Gintama|01"))
+    # another episode of the same anime, only its file-level fields fetched so far
+    req = FileRequest(key=FileKeyED2K("abd", 42), fields=[FileFmaskField.f.aid, FileFmaskField.f.eid])
+    cache.inject_cache(req, file_response(req, "1002|5|71"))
+
+    assert served(cache, FileKeyED2K("abd", 42), fields) == {"fid": 1002, "aid": 5, "eid": 71, "a_romaji": "Gintama"}
+    found = cache.prefetch_file_keys([FileKeyED2K("abd", 42)], fields)
+    assert found[FileKeyED2K("abd", 42)].field_names() == {"fid", "aid", "eid", "a_romaji"}
+    object_types = cache._conn.exec_driver_sql("SELECT object_type, count(*) FROM anidb_objects GROUP BY object_type").all()
+    assert dict(object_types) == {"anime": 1, "episode": 1, "file": 2}
+
+
+def test_stale_values_are_served_and_reported():
+    cache = AnidbCacheSqlAlchemy("sqlite://", ttl_policy=FieldTtlPolicy.parse(["a_romaji=0s"]))
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=list(FIELDS))
+    cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    assert served(cache, FileKeyED2K("abc", 42))["a_romaji"] == "Gintama"
+    assert cache.take_stale_fields() == {1001: {FileAmaskField.f.a_romaji}}
+    assert cache.take_stale_fields() == {}
+
+
+def test_stale_anime_fields_are_reported_once_per_anime():
+    cache = AnidbCacheSqlAlchemy("sqlite://", ttl_policy=FieldTtlPolicy.parse(["a_romaji=0s", "crc32=0s"]))
+    for (ed2k, fid) in (("abc", 1001), ("abd", 1002)):
+        req = FileRequest(key=FileKeyED2K(ed2k, 42), fields=list(FIELDS))
+        cache.inject_cache(req, file_response(req, f"{fid}|5|23d62d71|Gintama"))
+    served(cache, FileKeyED2K("abc", 42))
+    served(cache, FileKeyED2K("abd", 42))
+    assert cache.take_stale_fields() == {
+        1001: {FileFmaskField.f.crc32, FileAmaskField.f.a_romaji},
+        1002: {FileFmaskField.f.crc32},
+    }
+
+
+def test_sweep_drops_expired_and_least_recently_used():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    cache._inject_negative_cache_record(FileRequest(key=FileKeyED2K("bad", 42), fields=[]))
+    fields = [FileFmaskField.f.aid, FileFmaskField.f.filename]
+    for i in range(400):
+        req = FileRequest(key=FileKeyED2K(f"{i:032x}", 42), fields=list(fields))
+        cache.inject_cache(req, file_response(req, f"{i + 1}|5|{'x' * 200}"))
+    cache.flush()
+    cache._conn.exec_driver_sql("UPDATE anidb_file_negative_cache2 SET expiration = 0")
+    cache._conn.exec_driver_sql("UPDATE anidb_objects SET last_access = 1 WHERE object_id != 1")
+
+    cache.max_size = cache.used_size() // 2
+    assert cache.sweep() > 1
+    assert not cache.check_negative_cache({"ed2k": "bad", "size": 42})
+    assert cache._conn.exec_driver_sql("SELECT count(*) FROM anidb_file_negative_cache2").scalar() == 0
+    remaining = cache._conn.exec_driver_sql("SELECT count(*) FROM anidb_objects").scalar()
+    assert 0 < remaining < 400
+    assert served(cache, FileKeyED2K(f"{0:032x}", 42), fields)["aid"] == 5
+    assert cache._conn.exec_driver_sql("SELECT count(*) FROM anidb_files").scalar() == remaining
+
+
+def test_lru_is_write_through():
+    cache = AnidbCacheLru(AnidbCacheSqlAlchemy("sqlite://"), max_entries=3)
+    key = FileKeyED2K("abc", 42)
+    req = FileRequest(key=key, fields=list(FIELDS))
+    assert not cache.check_negative_cache(req)
+    cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    expected = {"fid": 1001, "aid": 5, "crc32": "23d62d71", "a_romaji": "Gintama"}
+    assert served(cache, key) == expected
+    assert served(cache, key) == expected
+    assert served(cache.inner, key) == expected
+    assert cache.stats()["hits"] == 2  # the fid, twice
+    assert not cache.check_negative_cache(req)
+
+    other = FileRequest(key=FileKeyED2K("bad", 42), fields=[])
+    cache._inject_negative_cache_record(other)
+    assert cache.check_negative_cache(other)
+    assert cache.inner.check_negative_cache(other)
+    cache._inject_negative_cache_record(FileRequest(key=FileKeyED2K("bae", 42), fields=[]))
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_rechecks_negative_entries(monkeypatch):
+    cache = AnidbCacheLru(AnidbCacheSqlAlchemy("sqlite://"))
+    req = FileRequest(key=FileKeyED2K("bad", 42), fields=[])
+    cache._inject_negative_cache_record(req)
+    # the file may be asked about again, which only the database knows
+    cache.inner._conn.exec_driver_sql("UPDATE anidb_file_negative_cache2 SET synthesize_failure_until = 0")
+    assert cache.check_negative_cache(req)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + NEGATIVE_CACHE_FIRST_RETRY.total_seconds())
+    assert not cache.check_negative_cache(req)
+
+
+def test_lru_hits_report_stale_fields():
+    cache = AnidbCacheLru(AnidbCacheSqlAlchemy("sqlite://", ttl_policy=FieldTtlPolicy.parse(["a_romaji=0s"])))
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=list(FIELDS))
+    cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    served(cache, FileKeyED2K("abc", 42))
+    assert cache.stats()["hits"] == 1
+    assert cache.take_stale_fields() == {1001: {FileAmaskField.f.a_romaji}}
+
+
+def test_idle_writes_are_committed_by_the_timer(tmp_path):
+    url = f"sqlite:///{tmp_path}/cache.sqlite3"
+    cache = AnidbCacheSqlAlchemy(url, flush_every=100, flush_interval=0.1)
+    reader = AnidbCacheSqlAlchemy(url)
+    cache.record_mylist_entry(FileKeyED2K("abc", 42), lid=7, state=1, viewed=1)
+    deadline = time.monotonic() + 5
+    while reader.lookup_mylist_entry(FileKeyED2K("abc", 42)) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert reader.lookup_mylist_entry(FileKeyED2K("abc", 42)).lid == 7
+    reader.close()
+    cache.close()
+
+
+def test_failed_write_is_rolled_back():
+    cache = AnidbCacheSqlAlchemy("sqlite://", flush_every=100, flush_interval=3600)
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=list(FIELDS))
+    flexmock.flexmock(cache).should_receive('_merge_objects').and_raise(RuntimeError)
+    with pytest.raises(RuntimeError):
+        cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    cache.flush()
+    # the file row written before the failure is gone with it
+    assert served(cache, FileKeyED2K("abc", 42)) == {}
+
+
+def test_payload_keeps_a_shared_fetch_time_once():
+    payload = {"aid": ["5", 100], "crc32": ["23d62d71", 100], "a_romaji": ["Gintama", 90]}
+    assert _encode_payload(payload) == '{"":100,"aid":"5","crc32":"23d62d71","a_romaji":["Gintama",90]}'
+    assert _decode_payload(_encode_payload(payload)) == payload
+    # payloads written before pair every value with its fetch time
+    assert _decode_payload('{"aid":["5",100]}') == {"aid": ["5", 100]}
+
+
+def test_payload_is_only_decoded_if_the_masks_match():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=[FileFmaskField.f.crc32])
+    cache.inject_cache(req, file_response(req, "1001|23d62d71"))
+    flexmock.flexmock(sqlcache).should_receive('_decode_payload').never()
+    assert served(cache, FileKeyED2K("abc", 42), [FileFmaskField.f.md5, FileAmaskField.f.a_romaji]) == {"fid": 1001}
+
+
+def test_lookup_fills_in_cached_anime_fields_before_requesting_the_rest():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    req = FileRequest(key=FileKeyED2K("abc", 42), fields=[FileFmaskField.f.aid, FileAmaskField.f.a_romaji])
+    cache.inject_cache(req, file_response(req, "1001|5|Gintama"))
+    flexmock.flexmock(AnidbConnector).should_receive('_initialize_socket')
+    conn = AnidbConnector(("username", "password"), cache_impl=cache)
+    responses = ["1002|5|71|3", "1002|02"]
+    sent = []
+
+    def send(content, priority, cost):
+        sent.append(content)
+        body = responses.pop(0)
+        return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    conn.send_request_helper_legacy = send
+
+    output = flexmock.flexmock(success=lambda x: None, error=lambda x: None)
+    lookup = operations.GetFileInfoOperation(conn, output, [FileAmaskField.f.a_romaji, FileAmaskField.f.ep_no])
+    f = {"ed2k": "abd", "size": 42}
+    assert lookup(f)
+    assert f["info"]["a_romaji"] == "Gintama"
+    assert f["info"]["ep_no"] == "02"
+    (ep_no_mask, ids_mask) = (FileAmaskField.f.ep_no.to_bitfield(), FileFmaskField.f.aid.to_bitfield() | FileFmaskField.f.eid.to_bitfield() | FileFmaskField.f.gid.to_bitfield())
+    assert sent == [f"FILE ed2k=abd&size=42&fmask={ids_mask:010X}&amask=00000000", f"FILE fid=1002&fmask=0000000000&amask={ep_no_mask:08X}"]
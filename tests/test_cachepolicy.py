@@ -0,0 +1,76 @@
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy
+from anidbcli.cachepolicy import FieldTtlPolicy, TtlPolicyError, parse_duration
+from anidbcli.fieldplanner import FieldPackingPlanner
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K
+from anidbcli.refresher import BackgroundRefresher
+
+
+def test_parse_duration():
+    assert parse_duration("1w2d") == timedelta(days=9)
+    assert parse_duration("12h") == timedelta(hours=12)
+    assert parse_duration("never") is None
+    with pytest.raises(TtlPolicyError):
+        parse_duration("12 parsecs")
+
+
+def test_policy_classes_and_overrides():
+    policy = FieldTtlPolicy.parse(["volatile=1d", "a_romaji=never"])
+    assert policy.ttl(FileFmaskField.f.md5) is None
+    assert policy.ttl(FileAmaskField.f.ep_last) == timedelta(days=1)
+    assert policy.ttl(FileAmaskField.f.a_romaji) is None
+    assert policy.ttl(FileFmaskField.f.resolution) == timedelta(days=300)
+    assert policy.is_stale(FileAmaskField.f.ep_last, 1000, 1000 + 86400)
+    assert not policy.is_stale(FileFmaskField.f.md5, 0, 10 ** 10)
+    with pytest.raises(TtlPolicyError):
+        FieldTtlPolicy.parse(["a_romanji=1d"])
+
+
+def test_objects_outlive_their_stale_values():
+    policy = FieldTtlPolicy()
+    day = 86400
+    # stale stable values stay around to be served and refreshed
+    assert policy.expiration({"a_romaji": ["Gintama", 0]}) == (300 + 300) * day
+    assert policy.expiration({"a_romaji": ["Gintama", 0], "ep_last": ["12", 500 * day]}) == (500 + 7 + 300) * day
+    assert policy.expiration({"aid": ["5", 0], "a_romaji": ["Gintama", 0]}) == 1200 * day
+
+
+def test_sweep_keeps_stale_and_immutable_values():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    long_ago = int(time.time()) - 400 * 86400
+    cache.inject_file_values(FileKeyED2K("abc", 42), 1001, {FileFmaskField.f.crc32: "23d62d71", FileFmaskField.f.resolution: "1920x1080"})
+    cache._conn.exec_driver_sql("DELETE FROM anidb_objects")
+    cache._merge_objects("file", {1001: {"crc32": ["23d62d71", long_ago], "resolution": ["1920x1080", long_ago]}})
+    cache.sweep()
+    assert {f.name: v for (f, v) in cache.locally_service_field_values(
+        FileKeyED2K("abc", 42), [FileFmaskField.f.crc32, FileFmaskField.f.resolution])} == {
+            "fid": 1001, "crc32": "23d62d71", "resolution": "1920x1080"}
+    assert cache.take_stale_fields() == {1001: {FileFmaskField.f.resolution}}
+
+
+class RecordingConnector:
+    def __init__(self):
+        self.field_planner = FieldPackingPlanner()
+        self.requests = []
+        self.done = threading.Event()
+
+    def send_request(self, req, *, refresh=False):
+        assert refresh
+        self.requests.append(req)
+        self.done.set()
+        return AnidbResponse(AnidbResponse.CODE_RESULT_NO_SUCH_FILE, 'NO SUCH FILE')
+
+
+def test_refresher_requests_by_fid():
+    connector = RecordingConnector()
+    refresher = BackgroundRefresher(connector)
+    refresher.queue(1001, {FileAmaskField.f.ep_last})
+    assert connector.done.wait(5)
+    refresher.close()
+    assert [r.key.fid for r in connector.requests] == [1001]
+    assert connector.requests[0].fields == [FileAmaskField.f.ep_last]
@@ -0,0 +1,115 @@
+import socket
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+from anidbcli.anidbconnector import AnidbCacheNoop, AnidbCacheSqlAlchemy
+from anidbcli.cacheservice import AnidbCacheRemote, CacheServer, CacheServiceError
+from anidbcli.cli import cli, open_cache
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileKeyFID, FileRequest
+
+FIELDS = [FileFmaskField.f.aid, FileFmaskField.f.crc32, FileAmaskField.f.a_romaji]
+
+
+def file_response(req, body):
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    return res
+
+
+def served(cache, key):
+    return {f.name: v for (f, v) in cache.locally_service_field_values(key, FIELDS)}
+
+
+@pytest.fixture(params=["tcp", "unix"])
+def server(request, tmp_path):
+    address = "127.0.0.1:0" if request.param == "tcp" else str(tmp_path / "cache.sock")
+    server = CacheServer(AnidbCacheSqlAlchemy("sqlite://"), address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+def test_clients_share_the_served_cache(server):
+    writer = AnidbCacheRemote.connect(server.address)
+    reader = AnidbCacheRemote(server.address)
+    key = FileKeyED2K("a" * 32, 42)
+    req = FileRequest(key=key, fields=list(FIELDS))
+    writer.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    writer._inject_negative_cache_record(FileRequest(key=FileKeyED2K("b" * 32, 42), fields=[]))
+    # writes are batched until flushed
+    assert served(reader, key) == {}
+    writer.flush()
+
+    expected = {"fid": 1001, "aid": 5, "crc32": "23d62d71", "a_romaji": "Gintama"}
+    assert served(reader, key) == expected
+    assert served(reader, FileKeyFID(1001)) == expected
+    assert served(server.cache, key) == expected
+    assert reader.check_negative_cache({"ed2k": "b" * 32, "size": 42})
+    found = reader.prefetch_file_keys([key, FileKeyED2K("b" * 32, 42), FileKeyED2K("c" * 32, 42)], FIELDS)
+    assert {f.name: v for (f, v) in found[key].values} == expected
+    assert found[FileKeyED2K("b" * 32, 42)].negative
+    assert found[FileKeyED2K("c" * 32, 42)].values == []
+
+    reader.record_mylist_entry(key, lid=7, state=1, viewed=0, fid=1001)
+    assert writer.lookup_mylist_entry(key).lid == 7
+    writer.close()
+    reader.close()
+
+
+def test_pending_writes_are_sent_before_reading_them(server):
+    client = AnidbCacheRemote(server.address)
+    key = FileKeyED2K("a" * 32, 42)
+    req = FileRequest(key=key, fields=list(FIELDS))
+    client.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    assert served(client, key)["fid"] == 1001
+    with pytest.raises(CacheServiceError):
+        client._call("bogus")
+    client.close()
+
+
+def test_pending_writes_survive_a_failed_put(server, monkeypatch):
+    client = AnidbCacheRemote(server.address)
+    key = FileKeyED2K("a" * 32, 42)
+    req = FileRequest(key=key, fields=list(FIELDS))
+    client.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    call = client._call
+    def failing_put(op, **args):
+        if op == 'put':
+            raise CacheServiceError("cache server went away")
+        return call(op, **args)
+    monkeypatch.setattr(client, "_call", failing_put)
+    with pytest.raises(CacheServiceError):
+        client.flush()
+    monkeypatch.setattr(client, "_call", call)
+    client.flush()
+    assert served(server.cache, key)["a_romaji"] == "Gintama"
+    client.close()
+
+
+def test_unanswered_calls_time_out(tmp_path):
+    path = str(tmp_path / "silent.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    client = AnidbCacheRemote(path, call_timeout=0.1)
+    with pytest.raises(CacheServiceError):
+        client.flush()
+    # the late answer can't be mistaken for that of another call
+    with pytest.raises(CacheServiceError):
+        client.lookup_mylist_entry(FileKeyFID(1001))
+    client.close()
+    listener.close()
+
+
+def test_api_falls_back_to_no_cache_without_the_server(tmp_path):
+    assert isinstance(open_cache(False, str(tmp_path / "nobody.sock")), AnidbCacheNoop)
+
+
+def test_api_rejects_cache_settings_for_a_cache_server():
+    res = CliRunner().invoke(cli, ["api", "--no-daemon", "--cache-server", "127.0.0.1:9740", "--cache-ttl", "volatile=1d", "-a"], obj={})
+    assert res.exit_code == 2
+    assert "cache-serve" in res.output
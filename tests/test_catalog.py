@@ -0,0 +1,86 @@
+import os
+
+import flexmock
+import pytest
+from click.testing import CliRunner
+
+import anidbcli.cli as cli_module
+import anidbcli.operations as operations
+from anidbcli.catalog import KnownHashOperation, LibraryCatalog
+from anidbcli.cli import cli
+from anidbcli.protocol import AnidbResponse
+from anidbcli.sqlcache import AnidbCacheSqlAlchemy
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def hashing(file):
+    file["ed2k"] = "ab" * 16
+    file["size"] = 5
+    return True
+
+
+def test_plan_finds_new_changed_moved_and_deleted_files(tmp_path):
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    catalog = LibraryCatalog(cache)
+    (same, changed, moving, deleted, linked) = (write(tmp_path / n, n.encode()) for n in ("same", "changed", "moving", "deleted", "linked"))
+    link_target = str(tmp_path / "Show - 01.mkv")
+    os.link(linked, link_target)
+    for path in (same, changed, moving, deleted):
+        catalog.record(path, {"ed2k": "ab" * 16, "info": {"fid": 1}}, "mylisted")
+    catalog.record(linked, {"ed2k": "cd" * 16}, "linked", link_target)
+
+    write(tmp_path / "changed", b"changed, longer")
+    os.rename(moving, tmp_path / "moved")
+    os.unlink(deleted)
+    added = write(tmp_path / "added", b"added")
+    plan = catalog.plan([same, str(tmp_path / "changed"), str(tmp_path / "moved"), added, linked, link_target])
+    assert plan.added == [added]
+    assert plan.changed == [changed]
+    assert {p: e.path for (p, e) in plan.moved.items()} == {str(tmp_path / "moved"): moving}
+    assert [e.path for e in plan.deleted] == [deleted]
+    assert plan.unchanged == 3
+    assert plan.to_process() == sorted([added, changed, str(tmp_path / "moved")])
+
+    file = {"file_path": str(tmp_path / "moved")}
+    assert KnownHashOperation(None, plan.moved)(file)
+    assert (file["ed2k"], file["size"]) == ("ab" * 16, len(b"moving"))
+    catalog.record(str(tmp_path / "moved"), file, "mylisted", replaces=moving)
+    assert moving not in catalog.entries()
+    cache.close()
+
+
+def test_files_outside_the_walk_are_not_deleted(tmp_path):
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    catalog = LibraryCatalog(cache)
+    elsewhere = write(tmp_path / "elsewhere", b"x")
+    catalog.record(elsewhere, {"ed2k": "ab" * 16}, "hashed")
+    plan = catalog.plan([])
+    assert plan.deleted == [] and plan.unchanged == 0
+    cache.close()
+
+
+@pytest.mark.parametrize("implementation", ["--api2", "--api-2x"])
+def test_sync_needs_the_default_implementation(implementation):
+    res = CliRunner().invoke(cli, ["api", "--no-daemon", "--sync", implementation], obj={})
+    assert res.exit_code == 2
+    assert "--sync" in res.output
+
+
+@pytest.mark.parametrize(("answer", "cataloged"), [
+    ("505 ILLEGAL INPUT OR ACCESS DENIED", False),
+    ("210 MYLIST ENTRY ADDED\n1234", True),
+])
+def test_sync_catalogs_files_once_their_mylist_add_succeeded(tmp_path, answer, cataloged):
+    media = write(tmp_path / "a.mkv", b"12345")
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    conn = flexmock.flexmock(cache=cache, send_request=lambda req: AnidbResponse.parse(answer), close=lambda: None)
+    flexmock.flexmock(cli_module).should_receive("get_connector").and_return(conn)
+    flexmock.flexmock(operations).should_receive("HashOperation").and_return(hashing)
+    res = CliRunner().invoke(cli, ["api", "--no-daemon", "--sync", "-a", "--journal", str(tmp_path / "journal.jsonl"), media], obj={})
+    assert res.exit_code == 0, res.output
+    assert (os.path.abspath(media) in LibraryCatalog(cache).entries()) == cataloged
+    cache.close()
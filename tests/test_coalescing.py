@@ -0,0 +1,84 @@
+import threading
+import time
+
+import flexmock
+
+import anidbcli.operations as operations
+from anidbcli.anidbconnector import AnidbCacheNoop, AnidbConnector
+from anidbcli.protocol import AnidbResponse, FileFmaskField, FileKeyED2K, FileRequest
+
+FIELDS = [FileFmaskField.f.aid, FileFmaskField.f.crc32]
+
+
+def quiet_output():
+    return flexmock.flexmock(info=lambda x: None, success=lambda x: None, warning=lambda x: None, error=lambda x: None)
+
+
+def make_connector():
+    flexmock.flexmock(AnidbConnector).should_receive('_initialize_socket')
+    return AnidbConnector(("username", "password"), cache_impl=AnidbCacheNoop())
+
+
+def test_identical_requests_in_flight_share_one_answer():
+    conn = make_connector()
+    sent = []
+    (entered, gate) = (threading.Event(), threading.Event())
+
+    def send(content, priority, cost):
+        sent.append(content)
+        entered.set()
+        gate.wait()
+        body = "9|12|abcd1234"
+        return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    conn.send_request_helper_legacy = send
+
+    results = []
+
+    def lookup():
+        results.append(conn.send_request(FileRequest(key=FileKeyED2K("abc", 42), fields=list(FIELDS))))
+    threads = [threading.Thread(target=lookup) for _ in range(2)]
+    threads[0].start()
+    assert entered.wait(5)
+    threads[1].start()
+    time.sleep(0.3)
+    gate.set()
+    for t in threads:
+        t.join()
+    assert len(sent) == 1
+    assert [r.decoded for r in results] == [{'fid': 9, 'aid': 12, 'crc32': 'abcd1234'}] * 2
+    assert results[0] is not results[1]
+    conn.close()
+
+
+def test_file_info_is_reused_for_another_path_of_the_same_file():
+    conn = flexmock.flexmock(send_request=lambda req: AnidbResponse(
+        AnidbResponse.CODE_RESULT_FILE, '', decoded={'fid': 9, **{f.name: "x" for f in req.fields}}))
+    conn.should_call("send_request").once()
+    oper = operations.GetFileInfoOperation(conn, quiet_output(), fields=[FileFmaskField.f.crc32])
+    (first, second) = ({"ed2k": "abc", "size": 42}, {"ed2k": "abc", "size": 42})
+    assert oper(first) and oper(second)
+    assert first["info"] == second["info"] and first["info"] is not second["info"]
+
+
+def test_empty_field_list_still_looks_up_the_fid():
+    conn = make_connector()
+    sent = []
+
+    def send(content, priority, cost):
+        sent.append(content)
+        return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n9", extended="FILE", body="9", wire_size=6)
+    conn.send_request_helper_legacy = send
+
+    res = conn.send_request(FileRequest(key=FileKeyED2K("abc", 42), fields=[]))
+    assert sent == ["FILE ed2k=abc&size=42&fmask=0000000000&amask=00000000"]
+    assert res.decoded == {'fid': 9}
+
+
+def test_reused_file_info_is_bounded():
+    conn = flexmock.flexmock(send_request=lambda req: AnidbResponse(
+        AnidbResponse.CODE_RESULT_FILE, '', decoded={'fid': 9, **{f.name: "x" for f in req.fields}}))
+    oper = operations.GetFileInfoOperation(conn, quiet_output(), fields=[FileFmaskField.f.crc32], max_remembered=2)
+    for ed2k in ("abc", "def", "abc", "ghi"):
+        assert oper({"ed2k": ed2k, "size": 42})
+    assert list(oper.answered) == [FileKeyED2K("abc", 42), FileKeyED2K("ghi", 42)]
+    assert operations.GetFileInfoOperation(conn, quiet_output(), remember_results=False).answered is None
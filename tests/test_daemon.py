@@ -0,0 +1,150 @@
+import threading
+import time
+from datetime import datetime
+
+import flexmock
+import pytest
+from click.testing import CliRunner
+
+from anidbcli.anidbconnector import CachedFileLookup
+from anidbcli.cli import cli
+from anidbcli.daemon import Daemon, DaemonClient, DaemonGetFileInfoOperation, DaemonMylistAddOperation, FairQueue
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileKeyFID
+from anidbcli.sqlcache import AnidbCacheSqlAlchemy
+
+AIRED = datetime(2018, 9, 1)
+
+
+class FakeConnector:
+    """Answers FILE requests with made up values and mylist adds with 210.
+
+    A file's fid is its size.  Requests for files not in cached wait for gate to be set.
+    """
+
+    def __init__(self):
+        self.cache = AnidbCacheSqlAlchemy("sqlite://")
+        flexmock.flexmock(self.cache).should_receive('prefetch_file_keys').replace_with(self._prefetch_file_keys)
+        self.field_planner = None
+        self.gate = threading.Event()
+        self.gate.set()
+        self.cached = set()
+        self.sent = []
+
+    def _prefetch_file_keys(self, keys, fields):
+        return {k: CachedFileLookup(True, []) for k in keys if k in self.cached}
+
+    def send_request(self, req):
+        if isinstance(req, str):
+            fid = None
+        elif isinstance(req.key, FileKeyFID):
+            fid = req.key.fid
+        else:
+            fid = req.key.size
+        if fid not in {k.size for k in self.cached}:
+            self.gate.wait()
+        self.sent.append(req)
+        if isinstance(req, str):
+            return AnidbResponse.parse("210 MYLIST ENTRY ADDED\n1234")
+        decoded = {f.name: AIRED if f.name == 'aired' else f"{f.name}-value" for f in req.fields}
+        decoded['fid'] = fid
+        return AnidbResponse(AnidbResponse.CODE_RESULT_FILE, '', decoded=decoded)
+
+
+def quiet_output():
+    return flexmock.flexmock(info=lambda x: None, success=lambda x: None, warning=lambda x: None, error=lambda x: None)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    conn = FakeConnector()
+    d = Daemon(conn, str(tmp_path / "daemon.sock"), output=quiet_output())
+    thread = threading.Thread(target=d.serve_forever, daemon=True)
+    thread.start()
+    yield d
+    conn.gate.set()
+    d.shutdown()
+    thread.join()
+
+
+def test_fair_queue_takes_turns_between_clients():
+    queue = FairQueue()
+    for job in ["a1", "a2", "a3"]:
+        queue.put("a", job)
+    queue.put("b", "b1")
+    assert [queue.get() for _ in range(4)] == ["a1", "b1", "a2", "a3"]
+    queue.close()
+    assert queue.get() is None
+
+
+def test_lookup_through_daemon(daemon):
+    client = DaemonClient.connect_if_running(daemon.address)
+    oper = DaemonGetFileInfoOperation(client, quiet_output(), fields=[FileAmaskField.f.a_romaji, FileFmaskField.f.aired])
+    f = {"ed2k": "abc", "size": 42}
+    assert oper(f)
+    assert f["info"]["a_romaji"] == "a_romaji-value"
+    assert f["info"]["aired"] == AIRED
+    client.close()
+
+
+def test_identical_requests_are_sent_once(daemon):
+    daemon.connector.gate.clear()
+    clients = [DaemonClient(daemon.address) for _ in range(2)]
+    ids = [c.submit("mylist_add", ed2k="abc", size=42, state=0, viewed=1) for c in clients]
+    deadline = time.monotonic() + 5
+    while sum(len(job.waiters) for job in list(daemon._inflight.values())) < 2:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    daemon.connector.gate.set()
+    answers = [c.wait(i) for (c, i) in zip(clients, ids)]
+    assert [a["ok"] for a in answers] == [True, True]
+    assert answers[0]["messages"] == answers[1]["messages"] == [["success", "Mylist entry added."]]
+    assert daemon.connector.sent == ["MYLISTADD size=42&ed2k=abc&viewed=1&state=0"]
+    for c in clients:
+        c.close()
+
+
+def test_bad_requests_get_an_error(daemon):
+    client = DaemonClient(daemon.address)
+    assert client.call("ping")["ok"]
+    res = client.call("lookup", ed2k="abc")
+    assert not res["ok"] and "size" in res["error"]
+    res = client.call("hash", path="relative.mkv")
+    assert not res["ok"]
+    assert not client.call("frobnicate")["ok"]
+    out = flexmock.flexmock(success=lambda x: None)
+    assert DaemonMylistAddOperation(client, out, 0, False)({"ed2k": "abc", "size": 42})
+    client.close()
+
+
+def test_connect_if_running_without_daemon(tmp_path):
+    assert DaemonClient.connect_if_running(str(tmp_path / "nothing.sock")) is None
+
+
+def test_api_2x_answers_cache_hits_first(daemon):
+    daemon.connector.gate.clear()
+    daemon.connector.cached.add(FileKeyED2K("def", 43))
+    threading.Timer(0.5, daemon.connector.gate.set).start()
+    res = CliRunner().invoke(cli, ["api", "--api-2x"], obj={}, input="LOOKUP miss abc-42\nLOOKUP hit def-43\nLOOKUP abc-x\nEND\n",
+                             env={"ANIDBCLI_DAEMON_SOCKET": daemon.address})
+    assert res.exit_code == 0, res.output
+    lines = [line for line in res.stdout.splitlines() if line.startswith(("SUCC", "FAIL"))]
+    assert [line.split()[:3] for line in lines] == [["FAIL", "abc-x"], ["SUCC", "hit", "def-43"], ["SUCC", "miss", "abc-42"]]
+
+
+def test_api_refuses_options_that_would_change_the_daemon(daemon):
+    res = CliRunner().invoke(cli, ["api", "-a", "-u", "someone", "--cache-ttl", "volatile=1d", "--shortest-job-first"], obj={},
+                             env={"ANIDBCLI_DAEMON_SOCKET": daemon.address})
+    assert res.exit_code == 2
+    assert "--cache-ttl, --shortest-job-first" in res.output
+    assert "--username" not in res.output
+    assert "--no-daemon" in res.output
+
+
+def test_api_ignores_session_options_while_the_daemon_runs(daemon):
+    # the client is closed on the early "Nothing to do" return too
+    flexmock.flexmock(DaemonClient).should_call("close").once()
+    res = CliRunner().invoke(cli, ["api", "-u", "someone", "-p", "secret", "--persistent"], obj={},
+                             env={"ANIDBCLI_DAEMON_SOCKET": daemon.address})
+    assert res.exit_code == 0, res.output
+    assert "Ignoring --username, --password, --persistent" in res.output
+    assert "Nothing to do." in res.output
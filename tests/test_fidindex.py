@@ -0,0 +1,36 @@
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy
+from anidbcli.fidindex import AnidbCacheFidIndex, FidIndex, build_index
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileRequest
+
+FIELDS = [FileFmaskField.f.aid, FileFmaskField.f.crc32, FileAmaskField.f.a_romaji]
+
+
+def inject(cache, ed2k, body):
+    req = FileRequest(key=FileKeyED2K(ed2k, 42), fields=list(FIELDS))
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    cache.inject_cache(req, res)
+
+
+def test_build_and_update_index(tmp_path):
+    path = str(tmp_path / "fid-index.bin")
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    inject(cache, "0" * 31 + "1", "1001|5|23d62d71|Gintama")
+    inject(cache, "0" * 31 + "3", "1003|5|aaaaaaaa|Gintama")
+    assert build_index(cache, path) == (2, 2)
+    # rows updated in the same second as the watermark are re-read, so age them
+    cache._conn.exec_driver_sql("UPDATE anidb_objects SET updated = 0")
+
+    inject(cache, "0" * 31 + "2", "1002|6|bbbbbbbb|Mushishi")
+    assert build_index(cache, path) == (3, 1)
+
+    index = FidIndex.open(path)
+    assert len(index) == 3
+    assert index.lookup("0" * 31 + "2", 42)[0] == 1002
+    assert index.lookup("0" * 31 + "2", 43) is None
+    assert index.lookup("f" * 32, 42) is None
+
+    offline = AnidbCacheFidIndex(index)
+    for key in (FileKeyED2K("0" * 31 + "1", 42), FileKeyED2K("0" * 31 + "2", 42), FileKeyED2K("0" * 31 + "4", 42)):
+        assert offline.locally_service_field_values(key, FIELDS) == cache.locally_service_field_values(key, FIELDS)
+    offline.close()
@@ -0,0 +1,77 @@
+from anidbcli.fieldplanner import FieldPackingPlanner
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileKeyFID
+
+FIELDS = [
+    FileFmaskField.f.aid,
+    FileFmaskField.f.ed2k,
+    FileFmaskField.f.md5,
+    FileFmaskField.f.sha1,
+    FileFmaskField.f.filename,
+    FileAmaskField.f.a_romaji,
+    FileAmaskField.f.a_synonyms,
+]
+
+
+def test_plan_fits_capacity():
+    planner = FieldPackingPlanner(capacity=300)
+    packs = planner.plan(FIELDS)
+    assert 1 < len(packs)
+    assert sorted(f.name for pack in packs for f in pack) == sorted(f.name for f in FIELDS)
+    for pack in packs:
+        assert pack == sorted(pack, key=lambda f: f.to_sort_tuple())
+
+
+def test_plan_single_request_when_small():
+    planner = FieldPackingPlanner()
+    assert len(planner.plan(FIELDS)) == 1
+
+
+def test_truncated_fields_are_requested_again():
+    planner = FieldPackingPlanner()
+    req = planner.build_request(FileKeyED2K("abc", 42), [
+        FileFmaskField.f.aid,
+        FileFmaskField.f.filename,
+        FileAmaskField.f.a_romaji,
+    ])
+    body = "1234|99|" + "x" * 1400
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=1400)
+    res.decode_with_query(req, suppress_truncation_error=True)
+    assert res.decoded == {'fid': 1234, 'aid': 99}
+    planner.observe(req, res)
+
+    follow_up = req.next_request(res)
+    assert isinstance(follow_up.key, FileKeyFID)
+    assert follow_up.key.fid == 1234
+    assert FileFmaskField.f.filename in follow_up.fields + follow_up.deferred_fields
+    assert FileAmaskField.f.a_romaji in follow_up.fields + follow_up.deferred_fields
+    # the oversized field has to end up on its own now
+    assert 2 == len(planner.plan([FileFmaskField.f.filename, FileAmaskField.f.a_romaji]))
+
+
+def test_complete_response_has_no_follow_up():
+    planner = FieldPackingPlanner()
+    req = planner.build_request(FileKeyED2K("abc", 42), [FileFmaskField.f.aid, FileFmaskField.f.eid])
+    body = "1234|99|100"
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=20)
+    res.decode_with_query(req, suppress_truncation_error=True)
+    assert res.decoded == {'fid': 1234, 'aid': 99, 'eid': 100}
+    assert req.next_request(res) is None
+
+
+def test_wire_size_is_the_datagram_size():
+    req = FieldPackingPlanner().build_request(FileKeyED2K("abc", 42), [FileFmaskField.f.aid, FileFmaskField.f.eid])
+    # a full datagram, even though the text left after decrypting is shorter
+    res = AnidbResponse.parse("220 FILE\n1234|99|100", wire_size=1400)
+    assert res.wire_size == 1400
+    assert res.may_be_truncated(req)
+    assert AnidbResponse.parse("220 FILE\n1234|99|100").wire_size == len("220 FILE\n1234|99|100")
+
+
+def test_first_request_by_ed2k_only_asks_for_fmask_fields():
+    planner = FieldPackingPlanner()
+    req = planner.build_request(FileKeyED2K("abc", 42), [FileFmaskField.f.crc32, FileAmaskField.f.a_romaji, FileAmaskField.f.ep_no])
+    assert req.fields == [FileFmaskField.f.aid, FileFmaskField.f.eid, FileFmaskField.f.crc32]
+    assert req.deferred_fields == [FileAmaskField.f.a_romaji, FileAmaskField.f.ep_no]
+    # by fid, the cache already had its chance to fill in amask fields
+    req = planner.build_request(FileKeyFID(1001), [FileFmaskField.f.crc32, FileAmaskField.f.a_romaji])
+    assert req.fields == [FileFmaskField.f.crc32, FileAmaskField.f.a_romaji]
@@ -0,0 +1,121 @@
+import flexmock
+import pytest
+
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy
+from anidbcli.journal import (STAGE_HASHED, STAGE_LOOKED_UP, STAGE_MYLISTED, STAGE_RENAMED, JournaledOperation, RunJournal)
+from anidbcli.operations import MylistAddOperation
+from anidbcli.protocol import AnidbResponse
+
+
+def hashing(file):
+    file["ed2k"] = "ab" * 16
+    file["size"] = 5
+    return True
+
+
+def mylisting(file):
+    file["mylisted"] = True
+    return True
+
+
+def test_resume_skips_completed_stages(tmp_path):
+    media = tmp_path / "a.mkv"
+    media.write_bytes(b"12345")
+    path = str(tmp_path / "journal.jsonl")
+    journal = RunJournal(path)
+    JournaledOperation(hashing, journal, STAGE_HASHED)({"file_path": str(media)})
+    JournaledOperation(mylisting, journal, STAGE_MYLISTED)({"file_path": str(media)})
+    journal.close()
+
+    journal = RunJournal(path, resume=True)
+    assert journal.finished(str(media), [STAGE_HASHED, STAGE_MYLISTED])
+    never = flexmock.flexmock()
+    never.should_receive("__call__").never()
+    file = {"file_path": str(media)}
+    assert JournaledOperation(never, journal, STAGE_HASHED, skip=True)(file)
+    assert file["ed2k"] == "ab" * 16 and file["size"] == 5
+    # lookups aren't journaled with their answer, so they always run
+    looked_up = []
+    JournaledOperation(lambda f: looked_up.append(f) or True, journal, STAGE_LOOKED_UP, skip=True)(file)
+    assert looked_up
+    journal.close()
+
+
+def test_changed_files_are_done_again(tmp_path):
+    media = tmp_path / "a.mkv"
+    media.write_bytes(b"12345")
+    journal = RunJournal(str(tmp_path / "journal.jsonl"))
+    JournaledOperation(hashing, journal, STAGE_HASHED)({"file_path": str(media)})
+    media.write_bytes(b"123456")
+    assert journal.completed(str(media)) == {}
+    journal.close()
+
+
+def test_compaction_keeps_one_line_per_live_file(tmp_path):
+    (kept, gone) = (tmp_path / "kept.mkv", tmp_path / "gone.mkv")
+    for media in (kept, gone):
+        media.write_bytes(b"12345")
+    path = tmp_path / "journal.jsonl"
+    journal = RunJournal(str(path))
+    for media in (kept, gone):
+        JournaledOperation(hashing, journal, STAGE_HASHED)({"file_path": str(media)})
+        JournaledOperation(mylisting, journal, STAGE_MYLISTED)({"file_path": str(media)})
+    # the last line was cut short by a crash
+    journal._fh.write('{"path": "')
+    journal.close()
+    gone.unlink()
+
+    journal = RunJournal(str(path), resume=True)
+    assert path.read_text().count("\n") == 1
+    assert set(journal.completed(str(kept))) == {STAGE_HASHED, STAGE_MYLISTED}
+    journal.close()
+
+
+def test_renamed_files_are_kept_under_their_new_path(tmp_path):
+    media = tmp_path / "a.mkv"
+    media.write_bytes(b"12345")
+    target = tmp_path / "renamed" / "b.mkv"
+    path = str(tmp_path / "journal.jsonl")
+
+    def renaming(file):
+        target.parent.mkdir()
+        media.rename(target)
+        file["file_path"] = str(target)
+        return True
+    journal = RunJournal(path)
+    file = {"file_path": str(media)}
+    for (operation, stage) in ((hashing, STAGE_HASHED), (mylisting, STAGE_MYLISTED), (renaming, STAGE_RENAMED)):
+        JournaledOperation(operation, journal, stage)(file)
+    assert journal.finished(str(target), [STAGE_HASHED, STAGE_MYLISTED, STAGE_RENAMED])
+    journal.close()
+
+    # compacting on resume keeps it, so it's neither hashed nor added again
+    journal = RunJournal(path, resume=True)
+    assert journal.finished(str(target), [STAGE_HASHED, STAGE_MYLISTED, STAGE_RENAMED])
+    assert journal.completed(str(media)) == {}
+    journal.close()
+
+
+def quiet_output():
+    return flexmock.flexmock(info=lambda x: None, success=lambda x: None, warning=lambda x: None, error=lambda x: None)
+
+
+@pytest.mark.parametrize("send", [
+    lambda req: AnidbResponse.parse("505 ILLEGAL INPUT OR ACCESS DENIED"),
+    lambda req: (_ for _ in ()).throw(TimeoutError("no answer")),
+])
+def test_failed_mylist_adds_are_not_journaled(tmp_path, send):
+    media = tmp_path / "a.mkv"
+    media.write_bytes(b"12345")
+    journal = RunJournal(str(tmp_path / "journal.jsonl"))
+    connector = flexmock.flexmock(cache=AnidbCacheSqlAlchemy("sqlite://"), send_request=send)
+    file = {"file_path": str(media)}
+    JournaledOperation(hashing, journal, STAGE_HASHED)(file)
+    # the pipeline goes on, but a resumed run adds the file again
+    assert JournaledOperation(MylistAddOperation(connector, quiet_output(), 0, False), journal, STAGE_MYLISTED)(file)
+    assert set(journal.completed(str(media))) == {STAGE_HASHED}
+
+    connector.send_request = lambda req: AnidbResponse.parse("210 MYLIST ENTRY ADDED\n1234")
+    JournaledOperation(MylistAddOperation(connector, quiet_output(), 0, False), journal, STAGE_MYLISTED)(file)
+    assert set(journal.completed(str(media))) == {STAGE_HASHED, STAGE_MYLISTED}
+    journal.close()
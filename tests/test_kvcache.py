@@ -0,0 +1,79 @@
+import flexmock
+import pytest
+
+from anidbcli.kvcache import AnidbCacheKv, KvCacheError, _pack_object, _unpack_object
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileKeyFID, FileRequest
+
+FIELDS = [FileFmaskField.f.aid, FileFmaskField.f.crc32, FileAmaskField.f.a_romaji]
+
+
+def file_response(req, body):
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    return res
+
+
+def served(cache, key, fields=FIELDS):
+    return {f.name: v for (f, v) in cache.locally_service_field_values(key, fields)}
+
+
+def test_object_records_round_trip():
+    payload = {"aid": ["5", 1700000000], "a_romaji": ["Gintama 銀魂", 1700000001]}
+    assert _unpack_object(_pack_object(payload, 2, 3)) == (payload, 2, 3)
+
+
+def test_inject_then_serve(tmp_path):
+    path = str(tmp_path / "cache.kv")
+    cache = AnidbCacheKv(path)
+    key = FileKeyED2K("0123456789abcdef0123456789abcdef", 42)
+    req = FileRequest(key=key, fields=list(FIELDS))
+    cache.inject_cache(req, file_response(req, "1001|5|23d62d71|Gintama"))
+    other = FileKeyED2K("abc", 43)
+    req = FileRequest(key=other, fields=[FileFmaskField.f.aid])
+    cache.inject_cache(req, file_response(req, "1002|5"))
+    cache.close()
+
+    cache = AnidbCacheKv(path)
+    expected = {"fid": 1001, "aid": 5, "crc32": "23d62d71", "a_romaji": "Gintama"}
+    assert served(cache, key) == expected
+    assert served(cache, FileKeyFID(1001)) == expected
+    # the anime title is shared with the other file of the same anime
+    assert served(cache, other) == {"fid": 1002, "aid": 5, "a_romaji": "Gintama"}
+    found = cache.prefetch_file_keys([key, FileKeyED2K("def", 42)], FIELDS)
+    assert {f.name: v for (f, v) in found[key].values} == expected
+    assert found[FileKeyED2K("def", 42)].values == []
+    cache.close()
+
+
+def test_negative_cache_and_mylist(tmp_path):
+    cache = AnidbCacheKv(str(tmp_path / "cache.kv"))
+    key = FileKeyED2K("bad", 42)
+    assert not cache.check_negative_cache({"ed2k": "bad", "size": 42})
+    cache._inject_negative_cache_record(FileRequest(key=key, fields=[]))
+    assert cache.check_negative_cache({"ed2k": "bad", "size": 42})
+    assert cache.prefetch_file_keys([key], FIELDS)[key].negative
+
+    cache.record_mylist_entry(key, lid=7, state=1, viewed=0, fid=1001)
+    assert cache.lookup_mylist_entry(key)[:4] == (7, 1001, 1, 0)
+    cache.record_mylist_entry(key, lid=8, state=2, viewed=1)
+    assert cache.lookup_mylist_entry(key)[:4] == (8, None, 2, 1)
+    cache.forget_mylist_entry(key)
+    assert cache.lookup_mylist_entry(key) is None
+    cache.close()
+
+
+def test_one_process_at_a_time(tmp_path):
+    path = str(tmp_path / "cache.kv")
+    cache = AnidbCacheKv(path)
+    with pytest.raises(KvCacheError):
+        AnidbCacheKv(path)
+    cache.close()
+    AnidbCacheKv(path).close()
+
+
+def test_writes_are_synced_periodically(tmp_path):
+    cache = AnidbCacheKv(str(tmp_path / "cache.kv"), flush_every=2, flush_interval=3600)
+    flexmock.flexmock(cache).should_call('flush').once()
+    for lid in (7, 8, 9):
+        cache.record_mylist_entry(FileKeyED2K("bad", lid), lid=lid, state=1, viewed=0)
+    cache.close()
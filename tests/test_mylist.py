@@ -0,0 +1,79 @@
+import time
+
+import flexmock
+
+import anidbcli.operations as operations
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy, MYLIST_ENTRY_TTL
+from anidbcli.sqlcache import anidb_mylist
+from anidbcli.protocol import AnidbResponse, FileKeyED2K
+
+
+class FakeConnector:
+    def __init__(self, responses):
+        self.cache = AnidbCacheSqlAlchemy("sqlite://")
+        self.responses = list(responses)
+        self.sent = []
+
+    def send_request(self, req):
+        self.sent.append(req)
+        return AnidbResponse.parse(self.responses.pop(0))
+
+
+def quiet_output():
+    return flexmock.flexmock(success=lambda x: None, warning=lambda x: None, error=lambda x: None)
+
+
+def test_mylist_entry_roundtrip():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    key = FileKeyED2K("abc", 42)
+    assert cache.lookup_mylist_entry(key) is None
+    cache.record_mylist_entry(key, lid=7, fid=3, state=1, viewed=1)
+    entry = cache.lookup_mylist_entry(key)
+    assert (entry.lid, entry.fid, entry.state, entry.viewed) == (7, 3, 1, 1)
+    cache.forget_mylist_entry(key)
+    assert cache.lookup_mylist_entry(key) is None
+
+
+def test_add_then_skip_when_cached():
+    conn = FakeConnector(["210 MYLIST ENTRY ADDED\n1234"])
+    oper = operations.MylistAddOperation(conn, quiet_output(), 0, False)
+    f = {"size": 42, "ed2k": "abc"}
+    assert oper(f)
+    assert oper(f)
+    assert conn.sent == ["MYLISTADD size=42&ed2k=abc&viewed=1&state=0"]
+    assert conn.cache.lookup_mylist_entry(FileKeyED2K("abc", 42)).lid == 1234
+
+
+def test_known_entry_goes_straight_to_edit():
+    conn = FakeConnector(["311 MYLIST ENTRY EDITED\n1"])
+    conn.cache.record_mylist_entry(FileKeyED2K("abc", 42), lid=1234, fid=5, state=0, viewed=0)
+    oper = operations.MylistAddOperation(conn, quiet_output(), 0, False)
+    assert oper({"size": 42, "ed2k": "abc"})
+    assert conn.sent == ["MYLISTADD size=42&ed2k=abc&edit=1&viewed=1&state=0"]
+    assert conn.cache.lookup_mylist_entry(FileKeyED2K("abc", 42)).viewed == 1
+
+
+def test_already_in_mylist_with_matching_state_skips_edit():
+    conn = FakeConnector(["310 FILE ALREADY IN MYLIST\n1234|5|6|7|8|1500000000|0|1500000001|||||1"])
+    oper = operations.MylistAddOperation(conn, quiet_output(), 0, False)
+    assert oper({"size": 42, "ed2k": "abc"})
+    assert len(conn.sent) == 1
+    entry = conn.cache.lookup_mylist_entry(FileKeyED2K("abc", 42))
+    assert (entry.lid, entry.fid, entry.viewed) == (1234, 5, 1)
+
+
+def test_added_without_lid_is_not_mirrored():
+    conn = FakeConnector(["210 MYLIST ENTRY ADDED"])
+    oper = operations.MylistAddOperation(conn, quiet_output(), 0, False)
+    assert oper({"size": 42, "ed2k": "abc"})
+    assert conn.cache.lookup_mylist_entry(FileKeyED2K("abc", 42)) is None
+
+
+def test_expired_entry_is_checked_again():
+    conn = FakeConnector(["310 FILE ALREADY IN MYLIST\n1234|5|6|7|8|1500000000|0|1500000001|||||1"])
+    conn.cache.record_mylist_entry(FileKeyED2K("abc", 42), lid=1234, fid=5, state=0, viewed=1)
+    conn.cache._conn.execute(anidb_mylist.update().values(updated=int(time.time() - MYLIST_ENTRY_TTL.total_seconds()) - 1))
+    oper = operations.MylistAddOperation(conn, quiet_output(), 0, False)
+    assert oper({"size": 42, "ed2k": "abc"})
+    assert conn.sent == ["MYLISTADD size=42&ed2k=abc&viewed=1&state=0"]
+    assert conn.cache.lookup_mylist_entry(FileKeyED2K("abc", 42)).lid == 1234
@@ -0,0 +1,101 @@
+import os
+import tarfile
+import time
+
+import pytest
+from click.testing import CliRunner
+
+import anidbcli.sqlcache as sqlcache
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy
+from anidbcli.cli import cli
+from anidbcli.mylistexport import MylistExportError, iter_export_records
+from anidbcli.protocol import FileAmaskField, FileFmaskField, FileKeyED2K
+
+EXPORT = (
+    "lid|fid|aid|eid|gid|ed2k|size|state|viewdate|romaji_name|epno|group_name\n"
+    "11|1001|5|50|7|ABCDEF|1234|1|1500000000|Gintama|01|HS\n"
+    "12|1002|5|51|7|abcdf0|1235|1|0|Gintama|02|HS\n"
+)
+
+
+def write_export(tmp_path, exported=None):
+    table = tmp_path / "files.txt"
+    table.write_text(EXPORT, encoding="utf-8")
+    if exported is not None:
+        os.utime(table, (exported, exported))
+    archive = tmp_path / "export.tgz"
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(table, arcname="export/files.txt")
+    return archive
+
+
+def test_parse_export_archive(tmp_path):
+    records = list(iter_export_records(str(write_export(tmp_path))))
+    assert [(r.fid, r.ed2k, r.size, r.lid, r.viewed) for r in records] == [
+        (1001, "abcdef", 1234, 11, 1),
+        (1002, "abcdf0", 1235, 12, 0),
+    ]
+    assert records[0].fields[FileAmaskField.f.a_romaji] == "Gintama"
+    assert records[0].fields[FileAmaskField.f.ep_no] == "01"
+
+
+def test_bulk_import_serves_lookups_locally(tmp_path):
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    assert cache.bulk_import_export_records(iter_export_records(str(write_export(tmp_path))), batch_size=1) == (2, 0)
+    values = {f.name: v for (f, v) in cache.locally_service_field_values(
+        FileKeyED2K("abcdf0", 1235), [FileFmaskField.f.eid, FileAmaskField.f.g_name])}
+    assert values == {"fid": 1002, "eid": 51, "g_name": "HS"}
+    assert cache.lookup_mylist_entry(FileKeyED2K("abcdef", 1234)).lid == 11
+
+
+def test_records_with_invalid_values_are_skipped(tmp_path):
+    table = tmp_path / "files.txt"
+    table.write_text(EXPORT + "13|1003|x5|52|7|abcdf1|1236|1|0|Gintama|03|HS\n", encoding="utf-8")
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    assert cache.bulk_import_export_records(iter_export_records(str(table))) == (2, 1)
+    assert dict(cache.locally_service_field_values(FileKeyED2K("abcdf1", 1236), [FileFmaskField.f.aid])) == {}
+
+
+def test_invalid_identifiers_abort_the_import(tmp_path):
+    table = tmp_path / "files.txt"
+    table.write_text(EXPORT + "13|x|5|52|7|abcdf1|1236|1|0|Gintama|03|HS\n", encoding="utf-8")
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    with pytest.raises(MylistExportError, match="line 4"):
+        cache.bulk_import_export_records(iter_export_records(str(table)), batch_size=1)
+    cache.flush()
+    assert cache.lookup_mylist_entry(FileKeyED2K("abcdef", 1234)) is None
+
+
+def stale_after_serving(cache, key, fields):
+    cache.locally_service_field_values(key, fields)
+    return {f.name for fields in cache.take_stale_fields().values() for f in fields}
+
+
+@pytest.mark.parametrize(("age_days", "stale"), [(1, set()), (400, {"a_romaji", "g_name"})])
+def test_imported_values_count_as_fetched_when_exported(tmp_path, age_days, stale):
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    exported = int(time.time()) - age_days * 86400
+    records = list(iter_export_records(str(write_export(tmp_path, exported))))
+    assert records[0].exported == exported
+    cache.bulk_import_export_records(records)
+    fields = [FileFmaskField.f.aid, FileAmaskField.f.a_romaji, FileAmaskField.f.g_name]
+    assert stale_after_serving(cache, FileKeyED2K("abcdef", 1234), fields) == stale
+
+
+def test_values_of_an_export_of_unknown_age_are_stale(tmp_path):
+    table = tmp_path / "files.txt"
+    table.write_text(EXPORT, encoding="utf-8")
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    cache.bulk_import_export_records(iter_export_records(str(table)))
+    fields = [FileFmaskField.f.aid, FileAmaskField.f.a_romaji, FileAmaskField.f.g_name]
+    assert stale_after_serving(cache, FileKeyED2K("abcdef", 1234), fields) == {"a_romaji", "g_name"}
+
+
+def test_import_command_warns_about_skipped_records(tmp_path, monkeypatch):
+    table = tmp_path / "files.txt"
+    table.write_text(EXPORT + "13|1003|x5|52|7|abcdf1|1236|1|0|Gintama|03|HS\n", encoding="utf-8")
+    monkeypatch.setattr(sqlcache, "open_default_cache", lambda: AnidbCacheSqlAlchemy("sqlite://"))
+    res = CliRunner().invoke(cli, ["mylist", "import", str(table)], obj={})
+    assert res.exit_code == 0, res.output
+    assert "Skipped 1 files with invalid values." in res.output
+    assert "Imported 2 files" in res.output
@@ -124,4 +124,13 @@ def test_rename_works_with_subtitles():
     oper.Process(f)
     assert f["path"] != filename # Should be changed for next elements in pipeline
     f["path"] = filename
-    oper2.Process(f)
\ No newline at end of file
+    oper2.Process(f)
+def test_rename_keep_structure_records_the_destination(tmp_path):
+    media = tmp_path / "abcd.mkv"
+    media.write_bytes(b"12345")
+    f = {"file_path": str(media), "info": {"a_english": "Show", "ep_no": "01"}}
+    out = flexmock.flexmock(error=lambda x: print(x), warning=lambda x: None, success=lambda x: None)
+    oper = operations.RenameOperation(out, "%a_english%/%a_english% - %ep_no%", "%Y-%m-%d", False, True, False, False, False)
+    assert oper(f)
+    assert f["file_path"] == str(tmp_path / "Show" / "Show - 01.mkv")
+    assert os.path.exists(f["file_path"])
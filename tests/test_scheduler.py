@@ -0,0 +1,84 @@
+import threading
+import time
+
+from anidbcli.daemon import FairQueue
+from anidbcli.operations import DeferredOperation
+from anidbcli.scheduler import PriorityScheduler, RequestPriority
+
+
+def run_contended(scheduler, requests):
+    """Queues the (name, priority, cost) requests while the slot is taken, returns the order they went in."""
+    order = []
+    (holding, release) = (threading.Event(), threading.Event())
+
+    def hold():
+        with scheduler.slot(RequestPriority.INTERACTIVE):
+            holding.set()
+            release.wait()
+
+    def request(name, priority, cost):
+        with scheduler.slot(priority, cost):
+            order.append(name)
+    threads = [threading.Thread(target=hold)]
+    threads[0].start()
+    assert holding.wait(5)
+    for args in requests:
+        threads.append(threading.Thread(target=request, args=args))
+        threads[-1].start()
+    deadline = time.monotonic() + 5
+    while sum(scheduler.waiting().values()) < len(requests):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+    return order
+
+
+def test_fair_queue_serves_lower_priority_values_first():
+    queue = FairQueue()
+    queue.put("a", "a-mylist", RequestPriority.MYLIST)
+    queue.put("a", "a-lookup", RequestPriority.INTERACTIVE)
+    queue.put("b", "b-mylist", RequestPriority.MYLIST)
+    assert [queue.get() for _ in range(3)] == ["a-lookup", "a-mylist", "b-mylist"]
+
+
+def test_scheduler_grants_by_priority():
+    scheduler = PriorityScheduler(lambda: 0)
+    order = run_contended(scheduler, [("background", RequestPriority.BACKGROUND, 0), ("mylist", RequestPriority.MYLIST, 0),
+                                      ("lookup", RequestPriority.PIPELINE, 5), ("cheap lookup", RequestPriority.PIPELINE, 1)])
+    assert order == ["lookup", "cheap lookup", "mylist", "background"]
+    assert scheduler.granted[RequestPriority.PIPELINE] == 2
+
+
+def test_scheduler_shortest_job_first():
+    scheduler = PriorityScheduler(lambda: 0, shortest_job_first=True)
+    order = run_contended(scheduler, [("lookup", RequestPriority.PIPELINE, 5), ("cheap lookup", RequestPriority.PIPELINE, 1),
+                                      ("mylist", RequestPriority.MYLIST, 0)])
+    assert order == ["cheap lookup", "lookup", "mylist"]
+
+
+def test_scheduler_slot_is_reentrant():
+    scheduler = PriorityScheduler(lambda: 0)
+    with scheduler.slot(RequestPriority.PIPELINE):
+        with scheduler.slot(RequestPriority.PIPELINE):
+            pass
+    assert scheduler.granted[RequestPriority.PIPELINE] == 1
+
+
+def test_deferred_operation_runs_every_file_before_close_returns():
+    seen = []
+    oper = DeferredOperation(lambda f: seen.append(f["path"]))
+    files = [{"path": str(i)} for i in range(3)]
+    assert all(oper(f) for f in files)
+    oper.close()
+    assert seen == ["0", "1", "2"]
+
+
+def test_deferred_operation_reports_each_outcome():
+    done = []
+    oper = DeferredOperation(lambda f: f["path"] != "1", on_done=lambda f, res: done.append((f["path"], res)))
+    for i in range(3):
+        oper({"path": str(i)})
+    oper.close()
+    assert done == [("0", True), ("1", False), ("2", True)]
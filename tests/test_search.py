@@ -0,0 +1,42 @@
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileRequest
+from anidbcli.search import match_expression, search
+
+FIELDS = [
+    FileFmaskField.f.aid,
+    FileFmaskField.f.eid,
+    FileFmaskField.f.gid,
+    FileFmaskField.f.resolution,
+    FileAmaskField.f.a_romaji,
+    FileAmaskField.f.ep_no,
+    FileAmaskField.f.ep_english,
+    FileAmaskField.f.g_name,
+]
+
+
+def inject(cache, ed2k, body):
+    req = FileRequest(key=FileKeyED2K(ed2k, 42), fields=list(FIELDS))
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    cache.inject_cache(req, res)
+
+
+def test_match_expression():
+    assert match_expression('gin "tama') == '"gin"* """tama"*'
+
+
+def test_search_by_text_and_filters():
+    cache = AnidbCacheSqlAlchemy("sqlite://")
+    inject(cache, "a" * 32, "1001|5|70|7|1920x1080|Gintama|01|Heaven Is Running|HorribleSubs")
+    inject(cache, "b" * 32, "1002|5|71|8|1280x720|Gintama|02|Who Am I|Coalgirls")
+    inject(cache, "c" * 32, "1003|6|80|7|1920x1080|Mushishi|01|The Green Seat|HorribleSubs")
+
+    assert [r.fid for r in search(cache, "gint")] == [1001, 1002]
+    assert [r.fid for r in search(cache, "horrible")] == [1001, 1003]
+    assert [r.fid for r in search(cache, "green")] == [1003]
+    assert [r.fid for r in search(cache, resolution="1920x1080", gid=7)] == [1001, 1003]
+    assert search(cache, "gintama coalgirls")[0].ed2k == "b" * 32
+
+    # picked up by the next query without reindexing everything
+    inject(cache, "d" * 32, "1004|5|72|7|1920x1080|Gintama|03|Fitting Fate|HorribleSubs")
+    assert [r.fid for r in search(cache, "gintama", gid=7)] == [1001, 1004]
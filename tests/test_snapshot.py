@@ -0,0 +1,98 @@
+import gzip
+
+import pytest
+
+import anidbcli.snapshot as snapshot
+from anidbcli.anidbconnector import AnidbCacheSqlAlchemy, _decode_payload, _encode_payload
+from anidbcli.protocol import AnidbResponse, FileAmaskField, FileFmaskField, FileKeyED2K, FileRequest
+from anidbcli.snapshot import SnapshotCounts, SnapshotError, export_snapshot, import_snapshot, read_snapshot_header
+
+FIELDS = [FileFmaskField.f.aid, FileFmaskField.f.crc32, FileAmaskField.f.a_romaji]
+
+
+def inject(cache, ed2k, body):
+    req = FileRequest(key=FileKeyED2K(ed2k, 42), fields=list(FIELDS))
+    res = AnidbResponse(AnidbResponse.CODE_RESULT_FILE, "FILE\n" + body, extended="FILE", body=body, wire_size=len(body))
+    res.decode_with_query(req, suppress_truncation_error=True)
+    cache.inject_cache(req, res)
+
+
+def served(cache, ed2k):
+    return {f.name: v for (f, v) in cache.locally_service_field_values(FileKeyED2K(ed2k, 42), FIELDS)}
+
+
+def test_export_and_import(tmp_path):
+    path = str(tmp_path / "cache.snapshot.gz")
+    source = AnidbCacheSqlAlchemy("sqlite://")
+    inject(source, "a" * 32, "1001|5|23d62d71|Gintama")
+    source._inject_negative_cache_record(FileRequest(key=FileKeyED2K("b" * 32, 42), fields=[]))
+    source.record_mylist_entry(FileKeyED2K("a" * 32, 42), lid=7, state=1, viewed=0, fid=1001)
+    (header, counts) = export_snapshot(source, path)
+    assert header == read_snapshot_header(path)
+    assert counts == SnapshotCounts(files=1, objects=2, negative=1, mylist=1)
+
+    target = AnidbCacheSqlAlchemy("sqlite://")
+    assert import_snapshot(target, path)[1] == counts
+    assert served(target, "a" * 32) == {"fid": 1001, "aid": 5, "crc32": "23d62d71", "a_romaji": "Gintama"}
+    assert target.check_negative_cache({"ed2k": "b" * 32, "size": 42})
+    assert target.lookup_mylist_entry(FileKeyED2K("a" * 32, 42)).lid == 7
+    # importing the same snapshot again changes nothing
+    assert import_snapshot(target, path)[1] == SnapshotCounts(0, 0, 0, 0)
+
+
+def test_delta_merges_fields_by_fetch_time(tmp_path):
+    source = AnidbCacheSqlAlchemy("sqlite://")
+    inject(source, "a" * 32, "1001|5|23d62d71|Gintama")
+    source.flush()
+    for (object_type, object_id, payload) in source._conn.exec_driver_sql(
+            "SELECT object_type, object_id, payload FROM anidb_objects").all():
+        backdated = _encode_payload({name: [raw, 1] for (name, (raw, _)) in _decode_payload(payload).items()})
+        source._conn.exec_driver_sql("UPDATE anidb_objects SET payload = ? WHERE object_type = ? AND object_id = ?",
+                                     (backdated, object_type, object_id))
+    (header, _) = export_snapshot(source, str(tmp_path / "full.gz"))
+    source._conn.exec_driver_sql("UPDATE anidb_objects SET updated = 0")
+    source._conn.exec_driver_sql("UPDATE anidb_files SET expiration = 0")
+    inject(source, "c" * 32, "1003|6|aaaaaaaa|Mushishi")
+    (_, counts) = export_snapshot(source, str(tmp_path / "delta.gz"), since=header.watermark)
+    assert counts == SnapshotCounts(files=1, objects=2, negative=0, mylist=0)
+
+    target = AnidbCacheSqlAlchemy("sqlite://")
+    inject(target, "a" * 32, "1001|5|ffffffff|Gin Tama")
+    import_snapshot(target, str(tmp_path / "delta.gz"))
+    assert served(target, "c" * 32)["a_romaji"] == "Mushishi"
+    # the target's own values were fetched after those in the full snapshot
+    import_snapshot(target, str(tmp_path / "full.gz"))
+    assert served(target, "a" * 32)["crc32"] == "ffffffff"
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "bogus.gz"
+    with gzip.open(path, "wt") as fh:
+        fh.write('{"format": "something-else"}\n')
+    with pytest.raises(SnapshotError):
+        import_snapshot(AnidbCacheSqlAlchemy("sqlite://"), str(path))
+    path.write_bytes(b"not gzipped")
+    with pytest.raises(SnapshotError):
+        read_snapshot_header(str(path))
+
+
+@pytest.mark.parametrize("record", [
+    '["f","abc",42,1001]',
+    '["o","file",1001,"not a payload",0,0]',
+])
+def test_rejects_malformed_records(tmp_path, record):
+    path = tmp_path / "damaged.gz"
+    with gzip.open(path, "wt") as fh:
+        fh.write('{"format": "anidbcli-cache-snapshot", "version": 1, "since": 0, "watermark": 0}\n')
+        fh.write(record + '\n')
+    target = AnidbCacheSqlAlchemy("sqlite://")
+    with pytest.raises(SnapshotError):
+        import_snapshot(target, str(path))
+    assert target._conn.exec_driver_sql("SELECT count(*) FROM anidb_objects").scalar() == 0
+
+
+def test_failed_export_leaves_no_temporary_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "_iter_records", lambda conn, since: iter([["x", object()]]))
+    with pytest.raises(TypeError):
+        export_snapshot(AnidbCacheSqlAlchemy("sqlite://"), str(tmp_path / "cache.snapshot.gz"))
+    assert list(tmp_path.iterdir()) == []
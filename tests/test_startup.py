@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import anidbcli
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(anidbcli.__file__)))
+HEAVY_MODULES = ['sqlalchemy', 'Crypto', 'pyperclip', 'joblib', 'multiprocessing']
+# far above the ~100ms this takes, but well below the half second it took with
+# everything imported up front
+IMPORT_BUDGET_US = 400000
+
+
+def run_python(*args):
+    return subprocess.run([sys.executable, *args], cwd=PACKAGE_PARENT, capture_output=True, text=True, check=True)
+
+
+def loaded_heavy_modules(code):
+    res = run_python('-c', code + '\nimport sys\nprint(" ".join(m for m in %r if m in sys.modules))' % (HEAVY_MODULES,))
+    return res.stdout.split()
+
+
+def test_cli_import_is_light():
+    assert loaded_heavy_modules("import anidbcli.cli") == []
+
+
+def test_ed2k_command_is_light(tmp_path):
+    path = tmp_path / "episode.mkv"
+    path.write_bytes(b"\0" * 1000)
+    code = (
+        "import sys\n"
+        "import anidbcli.cli\n"
+        "try:\n"
+        "    anidbcli.cli.cli(['ed2k', %r], obj={}, standalone_mode=False)\n"
+        "except ValueError:\n"
+        "    pass  # hashlib without md4 (OpenSSL 3); only the imports matter here\n"
+    ) % (str(path),)
+    assert loaded_heavy_modules(code) == []
+
+
+def test_package_names_still_resolve():
+    res = run_python('-c', "import anidbcli; print(anidbcli.AnidbConnector.__name__, anidbcli.main.__name__)")
+    assert res.stdout.split() == ['AnidbConnector', 'main']
+
+
+def test_cli_import_time():
+    res = run_python('-X', 'importtime', '-c', 'import anidbcli.cli')
+    for line in res.stderr.splitlines():
+        parts = [p.strip() for p in line.split('|')]
+        if len(parts) == 3 and parts[2] == 'anidbcli.cli':
+            assert int(parts[1]) < IMPORT_BUDGET_US
+            return
+    raise AssertionError("anidbcli.cli missing from -X importtime output")
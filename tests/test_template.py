@@ -0,0 +1,73 @@
+import click
+import pytest
+
+from anidbcli.protocol import FileAmaskField, FileFmaskField
+from anidbcli.template import RenameTemplate, Literal, Field, TemplateEmptyTagError, TemplateSyntaxError
+
+
+def test_compile_segments():
+    template = RenameTemplate.compile("watched/%a_romaji%/%ep_no% [%unknown%]")
+    assert template.segments == [
+        Literal("watched/"),
+        Field("a_romaji"),
+        Literal("/"),
+        Field("ep_no"),
+        Literal(" ["),
+        Field("unknown"),
+        Literal("]"),
+    ]
+    assert template.tags() == {"a_romaji", "ep_no", "unknown"}
+
+
+def test_required_fields_minimal():
+    template = RenameTemplate.compile("%a_romaji% - %ep_no%")
+    assert template.required_fields() == [FileAmaskField.f.a_romaji, FileAmaskField.f.ep_no]
+
+
+def test_required_fields_derived():
+    template = RenameTemplate.compile("%a_english% (%year_start%) [%resolution_abbr%][%crc32%]")
+    assert template.required_fields() == [
+        FileFmaskField.f.crc32,
+        FileFmaskField.f.resolution,
+        FileAmaskField.f.year,
+        FileAmaskField.f.a_romaji,
+        FileAmaskField.f.a_english,
+    ]
+
+
+def test_render_single_pass():
+    template = RenameTemplate.compile("%a_romaji%/%ep_no% - %ep_english% [%unknown%]")
+    info = {"a_romaji": "Gintama", "ep_no": "01", "ep_english": "A/B", "unused": "x"}
+    assert template.render(info, sanitizer=lambda v: v.replace("/", " ")) == "Gintama/01 - A B [%unknown%]"
+
+
+def test_render_fallbacks_and_conditionals():
+    template = RenameTemplate.compile("%a_english|a_romaji%%?g_name% [%g_name%]%/g_name%")
+    assert template.render({"a_english": "", "a_romaji": "Gintama", "g_name": ""}) == "Gintama"
+    assert template.render({"a_english": "Silver Soul", "g_name": "HS"}) == "Silver Soul [HS]"
+    assert template.required_fields() == [FileAmaskField.f.a_romaji, FileAmaskField.f.a_english, FileAmaskField.f.g_name]
+
+
+def test_render_per_field_sanitizer_and_abort():
+    template = RenameTemplate.compile("%ep_no% %g_name%")
+    assert template.render({"ep_no": 1, "g_name": "HS"}, sanitizers={"ep_no": lambda v: f"{v:02d}"}) == "01 HS"
+    with pytest.raises(TemplateEmptyTagError) as e:
+        template.render({"ep_no": "1", "g_name": " "}, abort_on_empty=True)
+    assert e.value.tag == "g_name"
+
+
+def test_render_empty_values_as_nothing():
+    template = RenameTemplate.compile("%a_romaji% [%g_name%]")
+    assert template.render({"a_romaji": "Gintama", "g_name": None}) == "Gintama []"
+
+
+@pytest.mark.parametrize("fmt", ["%?g_name% [%g_name%]", "%g_name%%/g_name%"])
+def test_compile_rejects_unbalanced_conditionals(fmt):
+    with pytest.raises(TemplateSyntaxError):
+        RenameTemplate.compile(fmt)
+
+
+def test_cli_reports_bad_template():
+    from anidbcli.cli import compile_rename_template
+    with pytest.raises(click.BadParameter):
+        compile_rename_template("%?g_name% [%g_name%]")